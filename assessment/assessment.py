@@ -1,15 +1,12 @@
 import re
 import json
 import web
-import zipfile
 
 from bs4 import BeautifulSoup
 from bson.errors import InvalidId
 
-from cStringIO import StringIO
-
 from dlkit.runtime.errors import *
-from dlkit.runtime.primordium import Type, DataInputStream, DisplayText
+from dlkit.runtime.primordium import Type, DisplayText
 from dlkit.records.registry import ANSWER_GENUS_TYPES,\
     ASSESSMENT_TAKEN_RECORD_TYPES, COMMENT_RECORD_TYPES, BANK_RECORD_TYPES,\
     QUESTION_RECORD_TYPES, ANSWER_RECORD_TYPES, ITEM_RECORD_TYPES, ITEM_GENUS_TYPES,\
@@ -100,6 +97,7 @@ MULTI_LANGUAGE_FEEDBACK_ANSWER_RECORD = Type(**ANSWER_RECORD_TYPES['multi-langua
 urls = (
     "/banks/(.*)/assessmentsoffered/(.*)/assessmentstaken/?", "AssessmentsTaken",
     "/banks/(.*)/assessmentsoffered/(.*)/results/?", "AssessmentOfferedResults",
+    "/banks/(.*)/assessmentsoffered/(.*)/statistics/?", "AssessmentOfferedStatistics",
     "/banks/(.*)/assessmentstaken/(.*)/questions/(.*)/qti/?", "AssessmentTakenQuestionQTIDetails",
     "/banks/(.*)/assessmentstaken/(.*)/questions/(.*)/status/?", "AssessmentTakenQuestionStatus",
     "/banks/(.*)/assessmentstaken/(.*)/questions/(.*)/submit/?", "AssessmentTakenQuestionSubmit",
@@ -116,6 +114,8 @@ urls = (
     "/banks/(.*)/assessments/(.*)/items/?", "AssessmentItemsList",
     "/banks/(.*)/assessments/(.*[^/])/?", "AssessmentDetails",
     "/banks/(.*)/assessments/?", "AssessmentsList",
+    "/banks/(.*)/items/import/(.*[^/])/?", "ItemsImportDetails",
+    "/banks/(.*)/items/import/?", "ItemsImport",
     "/banks/(.*)/items/(.*)/videoreplacement/?", "ItemVideoTagReplacement",
     "/banks/(.*)/items/(.*)/qti/?", "ItemQTIDetails",
     "/banks/(.*)/items/(.*[^/])/?", "ItemDetails",
@@ -167,7 +167,8 @@ class AssessmentBanksList(utilities.BaseClass):
                 assessment_banks = am.get_banks_by_query(querier)
             else:
                 assessment_banks = am.banks
-            banks = utilities.extract_items(assessment_banks)
+            banks = utilities.extract_items(assessment_banks,
+                                            fields=utilities.get_requested_fields(inputs))
             return banks
         except Exception as ex:
             utilities.handle_exceptions(ex)
@@ -257,7 +258,8 @@ class AssessmentBankDetails(utilities.BaseClass):
         try:
             am = autils.get_assessment_manager()
             assessment_bank = am.get_bank(utilities.clean_id(bank_id))
-            bank = utilities.convert_dl_object(assessment_bank)
+            bank = utilities.convert_dl_object(assessment_bank,
+                                               fields=utilities.get_requested_fields(self.data()))
             return bank
         except Exception as ex:
             utilities.handle_exceptions(ex)
@@ -329,7 +331,9 @@ class AssessmentsList(utilities.BaseClass):
             else:
                 assessments = assessment_bank.get_assessments()
 
-            data = utilities.extract_items(assessments)
+            assessments = utilities.paginate(assessments, inputs)
+            data = utilities.extract_items(assessments,
+                                           fields=utilities.get_requested_fields(inputs))
             return data
         except Exception as ex:
             utilities.handle_exceptions(ex)
@@ -432,14 +436,20 @@ class ItemsList(utilities.BaseClass):
             else:
                 items = assessment_bank.get_items()
 
-            results = []
+            items = utilities.paginate(items, params)
+            fields = utilities.get_requested_fields(params)
 
-            for item in items:
+            unshuffle = 'unshuffled' in params and utilities.field_requested(fields, 'question')
+
+            def get_item_map(item):
+                if unshuffle:
+                    # before anything shuffles the choices
+                    canonical_orders = autils.get_canonical_choice_orders(item)
                 item_qti = None
-                if 'qti' in params:
+                if 'qti' in params and utilities.field_requested(fields, 'qti'):
                     # do this first to not mess up unrandomized MC choices
                     try:
-                        item_qti = item.get_qti_xml(media_file_root_path=autils.get_media_path(assessment_bank))
+                        item_qti = autils.get_qti_xml(item, autils.get_media_path(assessment_bank))
                     except AttributeError:
                         pass  # not a qti question
                 item_map = item.object_map
@@ -447,14 +457,15 @@ class ItemsList(utilities.BaseClass):
                 if item_qti is not None:
                     item_map['qti'] = item_qti
 
-                if 'wronganswers' in params:
+                if 'wronganswers' in params and utilities.field_requested(fields, 'answers'):
                     item_map = autils.update_item_json_answers(item, item_map)
-                if 'unshuffled' in params:
-                    item_map = autils.update_item_json_random_choices(assessment_bank, item, item_map)
+                if unshuffle:
+                    item_map = autils.update_item_json_random_choices(assessment_bank, item, item_map,
+                                                                      canonical_orders=canonical_orders)
 
-                results.append(item_map)
+                return utilities.project_fields(item_map, fields)
 
-            return json.dumps(results)
+            return utilities.stream_json_list(items, convert=get_item_map)
         except Exception as ex:
             utilities.handle_exceptions(ex)
 
@@ -651,213 +662,15 @@ class ItemsList(utilities.BaseClass):
                             afc = autils.set_answer_form_genus_and_feedback(answer, afc)
                             new_answer = bank.create_answer(afc)
             else:
-                # get each set of files individually, because
-                # we are doing this in memory, so the file pointer changes
-                # once we read in a file
-                # https://docs.python.org/2/library/zipfile.html
-                keywords = []
-                description = ''
-                learning_objective = None
-                media_files = {}
-                qti_file = None
-
-                # get manifest keywords first
-                with zipfile.ZipFile(x['qtiFile'].file) as qti_zip:
-                    for zip_file_name in qti_zip.namelist():
-                        if zip_file_name == 'imsmanifest.xml':
-                            manifest = qti_zip.open(zip_file_name)
-                            manifest_xml = manifest.read()
-                            manifest_soup = BeautifulSoup(manifest_xml, 'lxml-xml')
-                            if manifest_soup.resources.resource.metadata.general.description:
-                                for keyword in manifest_soup.resources.resource.metadata.general.description:
-                                    if keyword is not None and keyword.string is not None:
-                                        if '[type]' in keyword.string:
-                                            split_keywords = keyword.string.split('}')
-                                            type_tag = split_keywords[0]
-                                            keywords.append(type_tag.replace('[type]', '').replace('<', '').replace('>', '').replace('{', '').replace('}', ''))
-                                            if len(split_keywords) > 1:
-                                                description += '\n'.join(split_keywords[1::]).strip()
-                                        else:
-                                            description += keyword.string
-                            if manifest_soup.resources.lom:
-                                for classification in manifest_soup.resources.lom.find_all('classification'):
-                                    if classification.purpose.value.string == 'target audience':
-                                        learning_objective = classification.taxonPath.taxon.entry.string.string
-
-                # now get media files
-                with zipfile.ZipFile(x['qtiFile'].file) as qti_zip:
-                    for zip_file_name in qti_zip.namelist():
-                        if 'media/' in zip_file_name and zip_file_name != 'media/':
-                            # this method must match what is in the QTI QuestionFormRecord
-                            file_name = zip_file_name.replace('media/', '').replace('.', '_')
-                            file_obj = DataInputStream(StringIO(qti_zip.open(zip_file_name).read()))
-                            file_obj.name = zip_file_name
-                            media_files[file_name] = file_obj
-                # now deal with the question xml
-                with zipfile.ZipFile(x['qtiFile'].file) as qti_zip:
-                    for zip_file_name in qti_zip.namelist():
-                        if ('.xml' in zip_file_name and
-                                'media/' not in zip_file_name and
-                                zip_file_name != 'imsmanifest.xml'):
-                            qti_file = qti_zip.open(zip_file_name, 'rU')
-
-                    qti_xml = qti_file.read()
-
-                    # to handle video tags, we need to do a blanket replace
-                    # of  &lt; => <
-                    # and &gt; => >
-                    # with the assumption that will not break anything else ...
-                    # clean_qti_xml = qti_xml.replace('&lt;', '<').replace('&gt;', '>')
-                    # deprecated
-                    clean_qti_xml = qti_xml
-
-                    soup = BeautifulSoup(clean_qti_xml, 'xml')
-
-                    # QTI ID alias check to see if this item exists already
-                    # if so, create a new item and provenance it...
-                    original_qti_id = utilities.construct_qti_id(soup.assessmentItem['identifier'])
-                    try:
-                        parent_item = bank.get_item(original_qti_id)
-                        add_provenance_parent = True
-                    except (NotFound, InvalidId):
-                        parent_item = None
-                        add_provenance_parent = False
-
-                    # if this is a numeric response, do not add the wrong answer item
-                    # record, because need that to go through the magical items
-                    if soup.itemBody.textEntryInteraction and soup.templateDeclaration:
-                        items_records_list = [QTI_ITEM,
-                                              PROVENANCE_ITEM_RECORD,
-                                              MULTI_LANGUAGE_ITEM_RECORD]
-                    else:
-                        items_records_list = [QTI_ITEM,
-                                              PROVENANCE_ITEM_RECORD,
-                                              WRONG_ANSWER_ITEM,
-                                              MULTI_LANGUAGE_ITEM_RECORD]
-                    form = bank.get_item_form_for_create(items_records_list)
-
-                    # in order to support multi-languages, let's keep the title
-                    # but minus the last language code
-                    # i.e. ee_u1l01a01q01_en
-                    # keep ee_u1l01a01q01 as the item name
-                    item_name = soup.assessmentItem['title']
-                    language_code = None
-                    if any(lang_code in item_name for lang_code in ['en', 'hi', 'te']):
-                        language_code = item_name.split('_')[-1]
-                        item_name = '_'.join(item_name.split('_')[0:-1])
-
-                    form.add_display_name(utilities.create_display_text(item_name,
-                                                                        language_code))
-
-                    form.add_description(utilities.create_display_text(description or 'QTI AssessmentItem',
-                                                                       language_code))
-                    form.load_from_qti_item(clean_qti_xml,
-                                            keywords=keywords)
-                    if learning_objective is not None:
-                        # let's use unicode by default ...
-                        form.set_learning_objectives([utilities.clean_id(u'learning.Objective%3A{0}%40CLIX.TISS.EDU'.format(learning_objective).encode('utf8'))])
-                    if add_provenance_parent:
-                        form.set_provenance(str(parent_item.ident))
-                        # and also archive the parent
-                        autils.archive_item(bank, parent_item)
-                    new_item = bank.create_item(form)
-
-                    # ID Alias with the QTI ID from Onyx
-                    bank.alias_item(new_item.ident,
-                                    original_qti_id)
-
-                    q_form = bank.get_question_form_for_create(new_item.ident, [QTI_QUESTION,
-                                                                                MULTI_LANGUAGE_QUESTION_RECORD])
-                    if len(media_files) == 0:
-                        media_files = None
-
-                    q_form.load_from_qti_item(clean_qti_xml,
-                                              media_files=media_files,
-                                              keywords=keywords)
-                    question = bank.create_question(q_form)
-
-                    local_map = {
-                        'type': str(new_item.genus_type)
-                    }
-                    if (autils.is_multiple_choice(local_map) or
-                            autils.is_ordered_choice(local_map)):
-                        choices = question.get_choices()
-                    else:
-                        choices = None
-                    answer_record_types = [QTI_ANSWER,
-                                           MULTI_LANGUAGE_FEEDBACK_ANSWER_RECORD,
-                                           FILES_ANSWER_RECORD]
-                    # correct answer
-                    # need a default one, even for extended text interaction
-                    a_form = bank.get_answer_form_for_create(new_item.ident, answer_record_types)
-                    a_form.load_from_qti_item(clean_qti_xml,
-                                              keywords=keywords,
-                                              correct=True,
-                                              feedback_choice_id='correct',
-                                              media_files=media_files)
-                    answer = bank.create_answer(a_form)
-
-                    # now let's do the incorrect answers with feedback, if available
-                    if choices is not None:
-                        # what if there are multiple right answer choices,
-                        #  i.e. movable words?
-                        right_answers = answer.object_map['choiceIds']
-                        wrong_answers = [c for c in choices if c['id'] not in right_answers]
-
-                        # survey questions should mark all choices as correct,
-                        # because Onyx only lets you pick one ... so let's fix that ...
-                        if autils.is_survey(local_map):
-                            for wrong_answer in wrong_answers:
-                                a_form = bank.get_answer_form_for_create(new_item.ident, answer_record_types)
-                                # force to True in load_from_qti_item, once the choiceId is set
-                                a_form.load_from_qti_item(clean_qti_xml,
-                                                          keywords=keywords,
-                                                          correct=False,
-                                                          feedback_choice_id=wrong_answer['id'],
-                                                          media_files=media_files)
-
-                                bank.create_answer(a_form)
-                        else:
-                            # for now only support a generic wrong answer feedback for
-                            # mc multi-select ... otherwise have to do scoring somehow
-                            if (len(wrong_answers) > 0 and
-                                    str(new_item.genus_type) != str(CHOICE_INTERACTION_MULTI_GENUS)):
-                                for wrong_answer in wrong_answers:
-                                    a_form = bank.get_answer_form_for_create(new_item.ident, answer_record_types)
-                                    a_form.load_from_qti_item(clean_qti_xml,
-                                                              keywords=keywords,
-                                                              correct=False,
-                                                              feedback_choice_id=wrong_answer['id'],
-                                                              media_files=media_files)
-
-                                    bank.create_answer(a_form)
-                            else:
-                                # create a generic one
-                                a_form = bank.get_answer_form_for_create(new_item.ident, answer_record_types)
-                                a_form.load_from_qti_item(clean_qti_xml,
-                                                          keywords=keywords,
-                                                          correct=False,
-                                                          feedback_choice_id='incorrect',
-                                                          media_files=media_files)
-
-                                bank.create_answer(a_form)
-                    elif str(new_item.genus_type) in [str(INLINE_CHOICE_INTERACTION_GENUS),
-                                                      str(NUMERIC_RESPONSE_INTERACTION_GENUS)]:
-                        # create a generic one
-                        a_form = bank.get_answer_form_for_create(new_item.ident, answer_record_types)
-                        a_form.load_from_qti_item(clean_qti_xml,
-                                                  keywords=keywords,
-                                                  correct=False,
-                                                  feedback_choice_id='incorrect',
-                                                  media_files=media_files)
-
-                        bank.create_answer(a_form)
+                new_item = autils.import_qti_package(bank, x['qtiFile'].file)
 
             full_item = bank.get_item(new_item.ident)
+            canonical_orders = autils.get_canonical_choice_orders(full_item)
             return_data = utilities.convert_dl_object(full_item)
 
             return_data = autils.update_item_json_answers(full_item, return_data)
-            return_data = autils.update_item_json_random_choices(bank, full_item, return_data)
+            return_data = autils.update_item_json_random_choices(bank, full_item, return_data,
+                                                                 canonical_orders=canonical_orders)
 
             return return_data
         except Exception as ex:
@@ -895,7 +708,8 @@ class AssessmentDetails(utilities.BaseClass):
             am = autils.get_assessment_manager()
             als = am.get_assessment_lookup_session(proxy=am._proxy)
             als.use_federated_bank_view()
-            data = utilities.convert_dl_object(als.get_assessment(utilities.clean_id(sub_id)))
+            data = utilities.convert_dl_object(als.get_assessment(utilities.clean_id(sub_id)),
+                                               fields=utilities.get_requested_fields(self.data()))
             return data
         except Exception as ex:
             utilities.handle_exceptions(ex)
@@ -1172,6 +986,8 @@ class ItemDetails(utilities.BaseClass):
             am = autils.get_assessment_manager()
             bank = am.get_bank(utilities.clean_id(bank_id))
             data = bank.delete_item(utilities.clean_id(sub_id))
+            autils.invalidate_rendered_qti(utilities.clean_id(sub_id))
+            autils.invalidate_taken_results()
             return utilities.success()
         except IllegalState as ex:
             utilities.handle_exceptions(type(ex)('This Item is being used in one or more '
@@ -1188,10 +1004,18 @@ class ItemDetails(utilities.BaseClass):
             ils.use_federated_bank_view()
 
             item = ils.get_item(utilities.clean_id(sub_id))
+            fields = utilities.get_requested_fields(self.data())
+            canonical_orders = autils.get_canonical_choice_orders(item)
             data = utilities.convert_dl_object(item)
 
-            data = autils.update_item_json_answers(item, data)
-            data = autils.update_item_json_random_choices(ils, item, data)
+            if utilities.field_requested(fields, 'answers'):
+                data = autils.update_item_json_answers(item, data)
+            if utilities.field_requested(fields, 'question'):
+                data = autils.update_item_json_random_choices(ils, item, data,
+                                                              canonical_orders=canonical_orders)
+
+            if fields is not None:
+                data = json.dumps(utilities.project_fields(json.loads(data), fields))
 
             return data
         except Exception as ex:
@@ -1301,11 +1125,15 @@ class ItemDetails(utilities.BaseClass):
                             afc = autils.update_answer_form(answer, afc)
                         afc = autils.update_answer_form_with_files(afc, answer)
                         bank.create_answer(afc)
+            autils.invalidate_rendered_qti(utilities.clean_id(sub_id))
+            autils.invalidate_taken_results()
             full_item = bank.get_item(utilities.clean_id(sub_id))
+            canonical_orders = autils.get_canonical_choice_orders(full_item)
             return_data = utilities.convert_dl_object(full_item)
 
             return_data = autils.update_item_json_answers(full_item, return_data)
-            return_data = autils.update_item_json_random_choices(bank, full_item, return_data)
+            return_data = autils.update_item_json_random_choices(bank, full_item, return_data,
+                                                                 canonical_orders=canonical_orders)
 
             return return_data
         except Exception as ex:
@@ -1335,9 +1163,18 @@ class ItemQTIDetails(utilities.BaseClass):
             item_bank = am.get_bank(utilities.clean_id(item._my_map['assignedBankIds'][0]))
 
             try:
-                return item.get_qti_xml(media_file_root_path=autils.get_media_path(item_bank))
+                qti_xml = autils.get_qti_xml(item, autils.get_media_path(item_bank))
             except AttributeError:
                 return ''
+
+            # the XML differs by locale and media host, and shuffled items
+            # differ on every request, so tag the rendered XML itself
+            etag = utilities.get_etag(qti_xml)
+            utilities.set_cache_validators(etag, cache_control='private, no-cache')
+            if utilities.is_not_modified(etag):
+                web.ctx.status = '304 Not Modified'
+                return ''
+            return qti_xml
         except Exception as ex:
             utilities.handle_exceptions(ex)
 
@@ -1366,12 +1203,14 @@ class AssessmentItemsList(utilities.BaseClass):
 
             data = []
             params = self.data()
+            fields = utilities.get_requested_fields(params)
             for item in items:
+                canonical_orders = autils.get_canonical_choice_orders(item)
                 item_qti = None
-                if 'qti' in params:
+                if 'qti' in params and utilities.field_requested(fields, 'qti'):
                     try:
                         # do this first to not mess up unrandomized MC choices
-                        item_qti = item.get_qti_xml(media_file_root_path=autils.get_media_path(bank))
+                        item_qti = autils.get_qti_xml(item, autils.get_media_path(bank))
                     except AttributeError:
                         pass  # not a QTI item
 
@@ -1380,20 +1219,25 @@ class AssessmentItemsList(utilities.BaseClass):
                 if item_qti is not None:
                     item_map['qti'] = item_qti
 
-                item_map = autils.update_item_json_answers(item, item_map)
-                item_map = autils.update_item_json_random_choices(bank, item, item_map)
+                if utilities.field_requested(fields, 'answers'):
+                    item_map = autils.update_item_json_answers(item, item_map)
+                if utilities.field_requested(fields, 'question'):
+                    item_map = autils.update_item_json_random_choices(bank, item, item_map,
+                                                                      canonical_orders=canonical_orders)
 
                 data.append(item_map)
 
-            if 'files' in web.input():
+            if 'files' in web.input() and (utilities.field_requested(fields, 'files') or
+                                           utilities.field_requested(fields, 'question')):
                 for item in data:
                     dlkit_item = bank.get_item(utilities.clean_id(item['id']))
 
-                    if 'fileIds' in item:
+                    if 'fileIds' in item and utilities.field_requested(fields, 'files'):
                         item['files'] = dlkit_item.get_files()
-                    if item['question'] and 'fileIds' in item['question']:
+                    if (utilities.field_requested(fields, 'question') and
+                            item['question'] and 'fileIds' in item['question']):
                         item['question']['files'] = dlkit_item.get_question().get_files()
-            return data
+            return [utilities.project_fields(obj_map, fields) for obj_map in data]
         except Exception as ex:
             utilities.handle_exceptions(ex)
 
@@ -1423,9 +1267,11 @@ class AssessmentItemsList(utilities.BaseClass):
             items = bank.get_assessment_items(utilities.clean_id(sub_id))
             data = []
             for item in items:
+                canonical_orders = autils.get_canonical_choice_orders(item)
                 item_map = item.object_map
                 item_map = autils.update_item_json_answers(item, item_map)
-                item_map = autils.update_item_json_random_choices(bank, item, item_map)
+                item_map = autils.update_item_json_random_choices(bank, item, item_map,
+                                                                  canonical_orders=canonical_orders)
                 data.append(item_map)
 
             return json.dumps(data)
@@ -1464,9 +1310,11 @@ class AssessmentItemsList(utilities.BaseClass):
 
             data = []
             for item in items:
+                canonical_orders = autils.get_canonical_choice_orders(item)
                 item_map = item.object_map
                 item_map = autils.update_item_json_answers(item, item_map)
-                item_map = autils.update_item_json_random_choices(bank, item, item_map)
+                item_map = autils.update_item_json_random_choices(bank, item, item_map,
+                                                                  canonical_orders=canonical_orders)
                 data.append(item_map)
 
             return json.dumps(data)
@@ -1535,7 +1383,9 @@ class AssessmentsOffered(utilities.BaseClass):
                     offerings = bank.get_assessments_offered_for_assessment(sub_id)
                 else:
                     offerings = bank.get_assessments_offered()
-            data = utilities.extract_items(offerings)
+            offerings = utilities.paginate(offerings, inputs)
+            data = utilities.extract_items(offerings,
+                                           fields=utilities.get_requested_fields(inputs))
             return data
         except Exception as ex:
             utilities.handle_exceptions(ex)
@@ -1610,7 +1460,8 @@ class AssessmentOfferedDetails(utilities.BaseClass):
             aols.use_federated_bank_view()
 
             offering = aols.get_assessment_offered(utilities.clean_id(offering_id))
-            data = utilities.convert_dl_object(offering)
+            data = utilities.convert_dl_object(offering,
+                                               fields=utilities.get_requested_fields(self.data()))
             return data
         except Exception as ex:
             utilities.handle_exceptions(ex)
@@ -1650,19 +1501,13 @@ class AssessmentOfferedResults(utilities.BaseClass):
 
     GET
     GET to view a specific offering
+
+    Each taken's results are materialized (see
+    autils.TAKEN_RESULTS_CACHE), so only takens that changed since the
+    last read get rebuilt.
     """
     @utilities.format_response
     def GET(self, bank_id, offering_id):
-        def taken_map(_taken):
-            t_map = _taken.object_map
-            t_map.update({
-                'sections': autils.get_taken_section_map(_taken,
-                                                         update=False,
-                                                         bank=bank,
-                                                         with_additional_attempts=with_additional_attempts)
-            })
-            return t_map
-
         try:
             am = autils.get_assessment_manager()
             bank = am.get_bank(utilities.clean_id(bank_id))
@@ -1686,11 +1531,12 @@ class AssessmentOfferedResults(utilities.BaseClass):
                     taken = takens.next()
                 # we need to replicate the sections data, so we can populate the
                 # directives and target carousels
-                data = autils.get_taken_section_map(taken, update=False)
+                data = autils.get_taken_results_map(taken, bank)['sections']
             else:
                 takens = bank.get_assessments_taken_for_assessment_offered(utilities.clean_id(offering_id))
 
-                data = [taken_map(t) for t in takens]
+                data = [autils.get_taken_results_map(t, bank, with_additional_attempts)
+                        for t in takens]
 
             data = utilities.extract_items(data)
             return data
@@ -1698,6 +1544,27 @@ class AssessmentOfferedResults(utilities.BaseClass):
             utilities.handle_exceptions(ex)
 
 
+class AssessmentOfferedStatistics(utilities.BaseClass):
+    """
+    Get the item statistics for an assessment offered: per question the
+    p-value, point-biserial discrimination and choice counts, plus the
+    offering's Cronbach's alpha
+    api/v2/assessment/banks/<bank_id>/assessmentsoffered/<offered_id>/statistics
+
+    GET
+    """
+    @utilities.format_response
+    def GET(self, bank_id, offering_id):
+        try:
+            am = autils.get_assessment_manager()
+            bank = am.get_bank(utilities.clean_id(bank_id))
+            matrices = autils.get_offered_response_matrices(bank,
+                                                            utilities.clean_id(offering_id))
+            return autils.get_item_statistics(matrices)
+        except Exception as ex:
+            utilities.handle_exceptions(ex)
+
+
 class AssessmentsTaken(utilities.BaseClass):
     """
     Get or link takens of an assessment. Input can be from an offering or from an assessment --
@@ -1732,8 +1599,9 @@ class AssessmentsTaken(utilities.BaseClass):
                     utilities.clean_id(sub_id))
             else:
                 takens = bank.get_assessments_taken_for_assessment(utilities.clean_id(sub_id))
-            data = utilities.extract_items(takens)
-            return data
+            takens = utilities.paginate(takens, self.data())
+            return utilities.stream_items(takens,
+                                          fields=utilities.get_requested_fields(self.data()))
         except Exception as ex:
             utilities.handle_exceptions(ex)
 
@@ -1815,6 +1683,7 @@ class AssessmentTakenDetails(utilities.BaseClass):
             am = autils.get_assessment_manager()
             bank = am.get_bank(utilities.clean_id(bank_id))
             data = bank.delete_assessment_taken(utilities.clean_id(taken_id))
+            autils.invalidate_taken_results(utilities.clean_id(taken_id))
             return utilities.success()
         except Exception as ex:
             utilities.handle_exceptions(ex)
@@ -1826,7 +1695,8 @@ class AssessmentTakenDetails(utilities.BaseClass):
             atls = am.get_assessment_taken_lookup_session(proxy=am._proxy)
             atls.use_federated_bank_view()
             taken = atls.get_assessment_taken(utilities.clean_id(taken_id))
-            data = utilities.convert_dl_object(taken)
+            data = utilities.convert_dl_object(taken,
+                                               fields=utilities.get_requested_fields(self.data()))
             return data
         except Exception as ex:
             utilities.handle_exceptions(ex)
@@ -1842,6 +1712,7 @@ class AssessmentTakenDetails(utilities.BaseClass):
 
             form = utilities.set_form_basics(form, data)
             updated_taken = bank.update_assessment_taken(form)
+            autils.invalidate_taken_results(updated_taken.ident)
 
             updated_taken = utilities.convert_dl_object(updated_taken)
             return updated_taken
@@ -1864,6 +1735,8 @@ class FinishAssessmentTaken(utilities.BaseClass):
             # "finish" the assessment section
             # bank.finished_assessment_section(first_section.ident)
             assessment_session.finish_assessment(utilities.clean_id(taken_id))
+            autils.refresh_taken_results(am.get_bank(utilities.clean_id(bank_id)),
+                                         utilities.clean_id(taken_id))
             data = {
                 'success': True
             }
@@ -1896,7 +1769,7 @@ class AssessmentTakenQuestions(utilities.BaseClass):
                 for question in questions:
                     try:
                         # do this first, to not mess up unrandomized choices
-                        question_qti = question.get_qti_xml(media_file_root_path=autils.get_media_path(bank))
+                        question_qti = autils.get_qti_xml(question, autils.get_media_path(bank))
                     except AttributeError:
                         # drag and drop doesn't support QTI
                         question_qti = None
@@ -1960,7 +1833,7 @@ class AssessmentTakenQuestionQTIDetails(utilities.BaseClass):
             first_section = bank.get_first_assessment_section(utilities.clean_id(taken_id))
             question = bank.get_question(first_section.ident,
                                          utilities.clean_id(question_id))
-            data = question.get_qti_xml(media_file_root_path=autils.get_media_path(bank))
+            data = autils.get_qti_xml(question, autils.get_media_path(bank))
             # if 'fileIds' in data:
             #     data['files'] = question.get_files()
             return data
@@ -2065,6 +1938,7 @@ class AssessmentTakenQuestionSubmit(utilities.BaseClass):
                 update_form = response_form
             bank.submit_response(first_section.ident, question.ident, update_form)
             # the above code logs the response in Mongo
+            autils.refresh_taken_results(bank, utilities.clean_id(taken_id))
 
             response = bank.get_response(first_section.ident, question.ident)
             correct = response.is_correct()
@@ -2142,6 +2016,7 @@ class AssessmentTakenQuestionSurrender(utilities.BaseClass):
             response_form.display_name = 'I surrendered'
             bank.submit_response(first_section.ident, question.ident, response_form)
             # the above code logs the response in Mongo
+            autils.refresh_taken_results(bank, utilities.clean_id(taken_id))
 
             answers = bank.get_answers(first_section.ident, question.ident)
             data = utilities.extract_items(answers)
@@ -2151,6 +2026,61 @@ class AssessmentTakenQuestionSurrender(utilities.BaseClass):
             utilities.handle_exceptions(ex)
 
 
+class ItemsImport(utilities.BaseClass):
+    """
+    Bulk import of QTI packages
+    api/v1/assessment/banks/<bank_id>/items/import
+
+    POST
+    POST one or more qtiFiles, each either a QTI zip file or a zip of
+    QTI zip files. The packages are imported in the background; GET
+    the returned job (ItemsImportDetails) for the per-package results.
+    """
+    @utilities.format_response
+    def POST(self, bank_id):
+        try:
+            am = autils.get_assessment_manager()
+            bank = am.get_bank(utilities.clean_id(bank_id))
+
+            uploads = web.webapi.rawinput('post').get('qtiFiles')
+            if uploads is None:
+                raise NullArgument('qtiFiles')
+            if not isinstance(uploads, list):
+                uploads = [uploads]
+            if any(isinstance(upload, basestring) for upload in uploads):
+                raise InvalidArgument('qtiFiles must be files')
+
+            packages = autils.get_qti_packages([(upload.filename, upload.file)
+                                                for upload in uploads])
+            return json.dumps(autils.start_qti_import(bank, packages))
+        except NotFound as ex:
+            # an unknown bank
+            raise web.NotFound(str(ex))
+        except Exception as ex:
+            utilities.handle_exceptions(ex)
+
+
+class ItemsImportDetails(utilities.BaseClass):
+    """
+    Progress and per-package results of a bulk QTI import
+    api/v1/assessment/banks/<bank_id>/items/import/<job_id>
+
+    GET
+    """
+    @utilities.format_response
+    def GET(self, bank_id, job_id):
+        try:
+            job = autils.get_qti_import_job(job_id)
+            if job['bankId'] != str(utilities.clean_id(bank_id)):
+                raise NotFound('QTI import job')
+            return json.dumps(job)
+        except NotFound as ex:
+            # an unknown (or expired) job, or one of another bank
+            raise web.NotFound(str(ex))
+        except Exception as ex:
+            utilities.handle_exceptions(ex)
+
+
 class ItemVideoTagReplacement(utilities.BaseClass):
     """
     If a `[type]{video}` text tag is found in the item QTI / question text, this will
@@ -2253,6 +2183,8 @@ class ItemVideoTagReplacement(utilities.BaseClass):
                     form.set_text(str(soup.itemBody))
 
                 bank.update_question(form)
+                autils.invalidate_rendered_qti(item.ident)
+                autils.invalidate_taken_results()
                 item = bank.get_item(item.ident)
 
         return utilities.convert_dl_object(item)
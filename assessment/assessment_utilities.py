@@ -1,21 +1,28 @@
+import copy
 import json
+import numpy as np
 import os
 import re
+import shutil
+import tempfile
+import threading
 import web
+import zipfile
 
 from bs4 import BeautifulSoup
 from bson import ObjectId
+from collections import OrderedDict
+from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
 from bson.errors import InvalidId
 
 from dlkit.abstract_osid.osid.objects import OsidObjectForm
 from dlkit.json_ import types
-from dlkit.runtime import PROXY_SESSION, RUNTIME
+from dlkit.json_.utilities import JSONClientValidated
 from dlkit.runtime.errors import InvalidArgument, Unsupported, NotFound, NullArgument,\
     IllegalState
-from dlkit.runtime.primitives import InitializableLocale
 from dlkit.runtime.primordium import Duration, DateTime, Id, Type,\
     DataInputStream, DisplayText, RectangularSpatialUnit, BasicCoordinate
-from dlkit.runtime.proxy_example import SimpleRequest
 
 from inflection import underscore
 
@@ -40,6 +47,8 @@ EDX_MULTI_CHOICE_PROBLEM_TYPE = Type(**ITEM_GENUS_TYPES['multi-choice-edx'])
 EDX_NUMERIC_RESPONSE_PROBLEM_GENUS_TYPE = Type(**ITEM_GENUS_TYPES['numeric-response-edx'])
 GENERIC_ASSET_CONTENT_GENUS_TYPE = Type(**ASSET_CONTENT_GENUS_TYPES['generic'])
 ITEM_WITH_WRONG_ANSWERS_RECORD_TYPE = Type(**ITEM_RECORD_TYPES['wrong-answer'])
+MULTI_LANGUAGE_ITEM_RECORD = Type(**ITEM_RECORD_TYPES['multi-language'])
+PROVENANCE_ITEM_RECORD = Type(**ITEM_RECORD_TYPES['provenance'])
 JAVASCRIPT_ASSET_CONTENT_GENUS_TYPE = Type(**ASSET_CONTENT_GENUS_TYPES['javascript'])
 JPG_ASSET_CONTENT_GENUS_TYPE = Type(**ASSET_CONTENT_GENUS_TYPES['jpg'])
 JSON_ASSET_CONTENT_GENUS_TYPE = Type(**ASSET_CONTENT_GENUS_TYPES['json'])
@@ -141,6 +150,108 @@ DEFAULT_LANGUAGE_TYPE = Type(**types.Language().get_type_data('DEFAULT'))
 DEFAULT_SCRIPT_TYPE = Type(**types.Script().get_type_data('DEFAULT'))
 DEFAULT_FORMAT_TYPE = Type(**types.Format().get_type_data('DEFAULT'))
 
+# question map keys that randomized question records shuffle
+RANDOMIZED_QUESTION_KEYS = ['choices', 'droppables', 'targets', 'zones']
+
+# bank id -> id of the repository that holds the bank's media. The mapping
+# never changes, so entries do not expire.
+BANK_REPOSITORY_ID_CACHE = utilities.LRUCache(1024)
+utilities.CACHES['bankRepositoryIds'] = BANK_REPOSITORY_ID_CACHE
+
+# web.ctx key for the media paths already resolved in this request
+MEDIA_PATHS_KEY = '_qbank_media_paths'
+
+# (item identifier, object id, media root, locale) -> rendered QTI XML, up to
+# RENDERED_QTI_CACHE_BYTES of it. dlkit keeps no revision stamp, so the
+# handlers that edit items, questions and answers drop the item's entries
+# (and its takens' questions') right away; the TTL bounds how stale an edit
+# made by another process can be.
+RENDERED_QTI_CACHE_BYTES = 64 * 1024 * 1024
+RENDERED_QTI_CACHE = utilities.LRUCache(4096, ttl=300, max_bytes=RENDERED_QTI_CACHE_BYTES)
+utilities.CACHES['renderedQti'] = RENDERED_QTI_CACHE
+
+# bytes decompressed at a time when seeking forward in a zip member
+ZIP_MEMBER_SKIP_SIZE = 64 * 1024
+
+# Bulk QTI imports run in a process-wide pool of QTI_IMPORT_WORKERS
+# threads (the QTI_IMPORT_WORKERS environment variable). Jobs (and their
+# per-package results) can be polled for a day. Packages are read and
+# parsed in parallel, but the JSON datastore does not write its files
+# atomically, so on it the datastore work of one import at a time holds
+# QTI_IMPORT_DATASTORE_LOCK; on MongoDB, imports write in parallel too.
+QTI_IMPORT_WORKERS = int(os.environ.get('QTI_IMPORT_WORKERS', 4))
+QTI_IMPORT_JOBS = utilities.LRUCache(256, ttl=24 * 60 * 60)
+QTI_IMPORT_LOCK = threading.Lock()
+QTI_IMPORT_DATASTORE_LOCK = threading.Lock()
+_qti_import_pool = None
+
+# (taken id, locale, with additional attempts) -> the taken's results map (its
+# object map plus its sections), as AssessmentOfferedResults returns it. The
+# maps carry display texts in the request's language, hence the locale;
+# readers get copies, so that projecting fields cannot change the cached map.
+# Submitting, surrendering and finishing refresh a taken's entries in place
+# (those in the taker's language; the others are dropped); item edits clear
+# them all, since the section maps copy in the items' questions. Each refresh
+# bumps the taken's generation, so that a results map built from older data
+# is not stored over a newer one.
+TAKEN_RESULTS_CACHE = utilities.LRUCache(16384)
+utilities.CACHES['takenResults'] = TAKEN_RESULTS_CACHE
+TAKEN_RESULTS_LOCK = threading.Lock()
+_taken_results_generations = {}
+
+# assessment offered id -> the takens x questions matrices that its item
+# statistics are computed from. An entry is re-used as long as the offering's
+# takens still have the same materialized results it was built from.
+OFFERED_RESPONSE_MATRICES_CACHE = utilities.LRUCache(256)
+utilities.CACHES['offeredResponseMatrices'] = OFFERED_RESPONSE_MATRICES_CACHE
+
+# cells of the response matrices for questions that a taken never got, and
+# for questions answered without a choice
+NOT_PRESENTED = -1
+NO_CHOICE = -1
+
+
+class ZipMemberFile(object):
+    """Read-only file for one member of an open ``zipfile.ZipFile``.
+    The member is decompressed as it is read, rather than being copied into
+    memory up front. Seeking back re-opens the member, since the datastore
+    rewinds each file before saving it. Members of the same zip share its
+    file pointer, so read them one at a time.
+    """
+    def __init__(self, zip_file, zip_info):
+        self.name = zip_info.filename
+        self.closed = False
+        self._zip_file = zip_file
+        self._zip_info = zip_info
+        self._member = None
+        self._position = 0
+
+    def close(self):
+        self._member = None
+        self.closed = True
+
+    def read(self, size=-1):
+        if self._member is None:
+            self._member = self._zip_file.open(self._zip_info)
+        data = self._member.read(size)
+        self._position += len(data)
+        return data
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self._position
+        elif whence == 2:
+            offset += self._zip_info.file_size
+        if offset < self._position:
+            self._member = None
+            self._position = 0
+        while self._position < offset:
+            if not self.read(min(ZIP_MEMBER_SKIP_SIZE, offset - self._position)):
+                break
+
+    def tell(self):
+        return self._position
+
 
 def add_file_ids_to_form(form, file_ids):
     """
@@ -402,6 +513,154 @@ def create_new_item(bank, data):
     return new_item
 
 
+def create_qti_item(bank, soup, clean_qti_xml, media_files, keywords, description,
+                    learning_objective, repository_manager=None):
+    """Create the item, question and answers of a parsed QTI package (see
+    import_qti_package). ``media_files`` are read while they are stored, so
+    the package must still be open."""
+    # QTI ID alias check to see if this item exists already
+    # if so, create a new item and provenance it...
+    original_qti_id = utilities.construct_qti_id(soup.assessmentItem['identifier'])
+    try:
+        parent_item = bank.get_item(original_qti_id)
+        add_provenance_parent = True
+    except (NotFound, InvalidId):
+        parent_item = None
+        add_provenance_parent = False
+
+    # if this is a numeric response, do not add the wrong answer item
+    # record, because need that to go through the magical items
+    if soup.itemBody.textEntryInteraction and soup.templateDeclaration:
+        items_records_list = [QTI_ITEM_RECORD,
+                              PROVENANCE_ITEM_RECORD,
+                              MULTI_LANGUAGE_ITEM_RECORD]
+    else:
+        items_records_list = [QTI_ITEM_RECORD,
+                              PROVENANCE_ITEM_RECORD,
+                              ITEM_WITH_WRONG_ANSWERS_RECORD_TYPE,
+                              MULTI_LANGUAGE_ITEM_RECORD]
+    form = bank.get_item_form_for_create(items_records_list)
+
+    # in order to support multi-languages, let's keep the title
+    # but minus the last language code
+    # i.e. ee_u1l01a01q01_en
+    # keep ee_u1l01a01q01 as the item name
+    item_name = soup.assessmentItem['title']
+    language_code = None
+    if any(lang_code in item_name for lang_code in ['en', 'hi', 'te']):
+        language_code = item_name.split('_')[-1]
+        item_name = '_'.join(item_name.split('_')[0:-1])
+
+    form.add_display_name(utilities.create_display_text(item_name,
+                                                        language_code))
+
+    form.add_description(utilities.create_display_text(description or 'QTI AssessmentItem',
+                                                       language_code))
+    form.load_from_qti_item(clean_qti_xml,
+                            keywords=keywords)
+    if learning_objective is not None:
+        # let's use unicode by default ...
+        form.set_learning_objectives([utilities.clean_id(u'learning.Objective%3A{0}%40CLIX.TISS.EDU'.format(learning_objective).encode('utf8'))])
+    if add_provenance_parent:
+        form.set_provenance(str(parent_item.ident))
+        # and also archive the parent
+        archive_item(bank, parent_item)
+    new_item = bank.create_item(form)
+
+    # ID Alias with the QTI ID from Onyx
+    bank.alias_item(new_item.ident,
+                    original_qti_id)
+
+    q_form = bank.get_question_form_for_create(new_item.ident, [QTI_QUESTION,
+                                                                MULTI_LANGUAGE_QUESTION_RECORD])
+    if len(media_files) == 0:
+        media_files = None
+
+    q_form.load_from_qti_item(clean_qti_xml,
+                              media_files=media_files,
+                              keywords=keywords)
+    question = bank.create_question(q_form)
+    qti_objects = [question]
+
+    local_map = {
+        'type': str(new_item.genus_type)
+    }
+    if (is_multiple_choice(local_map) or
+            is_ordered_choice(local_map)):
+        choices = question.get_choices()
+    else:
+        choices = None
+    answer_record_types = [QTI_ANSWER,
+                           MULTI_LANGUAGE_FEEDBACK_ANSWER_RECORD,
+                           FILES_ANSWER_RECORD]
+    # correct answer
+    # need a default one, even for extended text interaction
+    a_form = bank.get_answer_form_for_create(new_item.ident, answer_record_types)
+    a_form.load_from_qti_item(clean_qti_xml,
+                              keywords=keywords,
+                              correct=True,
+                              feedback_choice_id='correct',
+                              media_files=media_files)
+    answer = bank.create_answer(a_form)
+    qti_objects.append(answer)
+
+    # now let's do the incorrect answers with feedback, if available
+    if choices is not None:
+        # what if there are multiple right answer choices,
+        #  i.e. movable words?
+        right_answers = answer.object_map['choiceIds']
+        wrong_answers = [c for c in choices if c['id'] not in right_answers]
+
+        # survey questions should mark all choices as correct,
+        # because Onyx only lets you pick one ... so let's fix that ...
+        if is_survey(local_map):
+            for wrong_answer in wrong_answers:
+                a_form = bank.get_answer_form_for_create(new_item.ident, answer_record_types)
+                # force to True in load_from_qti_item, once the choiceId is set
+                a_form.load_from_qti_item(clean_qti_xml,
+                                          keywords=keywords,
+                                          correct=False,
+                                          feedback_choice_id=wrong_answer['id'],
+                                          media_files=media_files)
+                qti_objects.append(bank.create_answer(a_form))
+        else:
+            # for now only support a generic wrong answer feedback for
+            # mc multi-select ... otherwise have to do scoring somehow
+            if (len(wrong_answers) > 0 and
+                    str(new_item.genus_type) != str(CHOICE_INTERACTION_MULTI_GENUS)):
+                for wrong_answer in wrong_answers:
+                    a_form = bank.get_answer_form_for_create(new_item.ident, answer_record_types)
+                    a_form.load_from_qti_item(clean_qti_xml,
+                                              keywords=keywords,
+                                              correct=False,
+                                              feedback_choice_id=wrong_answer['id'],
+                                              media_files=media_files)
+                    qti_objects.append(bank.create_answer(a_form))
+            else:
+                # create a generic one
+                a_form = bank.get_answer_form_for_create(new_item.ident, answer_record_types)
+                a_form.load_from_qti_item(clean_qti_xml,
+                                          keywords=keywords,
+                                          correct=False,
+                                          feedback_choice_id='incorrect',
+                                          media_files=media_files)
+                qti_objects.append(bank.create_answer(a_form))
+    elif str(new_item.genus_type) in [str(INLINE_CHOICE_INTERACTION_GENUS),
+                                      str(NUMERIC_RESPONSE_INTERACTION_GENUS)]:
+        # create a generic one
+        a_form = bank.get_answer_form_for_create(new_item.ident, answer_record_types)
+        a_form.load_from_qti_item(clean_qti_xml,
+                                  keywords=keywords,
+                                  correct=False,
+                                  feedback_choice_id='incorrect',
+                                  media_files=media_files)
+        qti_objects.append(bank.create_answer(a_form))
+
+    if media_files is not None:
+        share_qti_media_files(bank, qti_objects, repository_manager=repository_manager)
+    return new_item
+
+
 def evaluate_inline_choice(answers, submission):
     correct = False
     right_answers = [a for a in answers
@@ -482,35 +741,33 @@ def get_answer_records(answer):
 
 
 def get_assessment_manager():
-    condition = PROXY_SESSION.get_proxy_condition()
-    dummy_request = SimpleRequest(username=web.ctx.env.get('HTTP_X_API_PROXY', 'student@tiss.edu'),
-                                  authenticated=True)
-    condition.set_http_request(dummy_request)
-
-    if 'HTTP_X_API_LOCALE' in web.ctx.env:
-        language_code = web.ctx.env['HTTP_X_API_LOCALE'].lower()
-        if language_code in ['en', 'hi', 'te']:
-            if language_code == 'en':
-                language_code = 'ENG'
-                script_code = 'LATN'
-            elif language_code == 'hi':
-                language_code = 'HIN'
-                script_code = 'DEVA'
-            else:
-                language_code = 'TEL'
-                script_code = 'TELU'
-        else:
-            language_code = DEFAULT_LANGUAGE_TYPE.identifier
-            script_code = DEFAULT_SCRIPT_TYPE.identifier
+    return utilities.get_service_manager('ASSESSMENT')
 
-        locale = InitializableLocale(language_type_identifier=language_code,
-                                     script_type_identifier=script_code)
 
-        condition.set_locale(locale)
-
-    proxy = PROXY_SESSION.get_proxy(condition)
-    return RUNTIME.get_service_manager('ASSESSMENT',
-                                       proxy=proxy)
+def get_canonical_choice_orders(item):
+    """Get the stored (unshuffled) order of the item's question choices,
+    droppables, targets and zones, as lists of ids ({region: [ids]} for
+    inline choice regions). Building the question (``object_map``,
+    ``get_qti_xml()``, ``get_question()``) shuffles these lists in place
+    on the item, so call this on a freshly fetched item, before any of those.
+    """
+    try:
+        question_map = item._my_map['question']
+    except (AttributeError, KeyError, TypeError):
+        return {}
+    orders = {}
+    if not isinstance(question_map, dict):
+        return orders
+    for key in RANDOMIZED_QUESTION_KEYS:
+        try:
+            if isinstance(question_map[key], dict):
+                orders[key] = dict((region, [o['id'] for o in region_objects])
+                                   for region, region_objects in question_map[key].iteritems())
+            else:
+                orders[key] = [o['id'] for o in question_map[key]]
+        except (KeyError, TypeError):
+            pass
+    return orders
 
 
 def get_choice_files(files):
@@ -530,11 +787,257 @@ def get_drop_behavior_as_string(object_map):
 
 
 def get_media_path(bank):
-    host_path = web.ctx.get('homedomain', '')
-    rm = rutils.get_repository_manager()
-    repo = rm.get_repository(bank.ident)
-    return '{0}/api/v1/repository/repositories/{1}/assets'.format(host_path,
-                                                                  str(repo.ident))
+    # QTI listings call this once per item, so memoize it for the request,
+    # and keep the bank -> repository lookup for the whole process
+    if MEDIA_PATHS_KEY not in web.ctx:
+        web.ctx[MEDIA_PATHS_KEY] = {}
+    media_paths = web.ctx[MEDIA_PATHS_KEY]
+
+    bank_id = str(bank.ident)
+    if bank_id not in media_paths:
+        repository_id = BANK_REPOSITORY_ID_CACHE.get(bank_id)
+        if repository_id is None:
+            rm = rutils.get_repository_manager()
+            repository_id = str(rm.get_repository(bank.ident).ident)
+            BANK_REPOSITORY_ID_CACHE.set(bank_id, repository_id)
+        host_path = web.ctx.get('homedomain', '')
+        media_paths[bank_id] = '{0}/api/v1/repository/repositories/{1}/assets'.format(
+            host_path,
+            repository_id)
+    return media_paths[bank_id]
+
+
+def get_qti_xml(osid_object, media_file_root_path):
+    """Render an item or a taken's question as QTI XML, re-using an
+    earlier render until the item is edited. A taken's question already has its
+    choices in the order that taken was given (and its own id), so it is
+    safe to cache; an item that shuffles its choices on every fetch is not.
+    """
+    obj_map = osid_object._my_map
+    if 'itemId' in obj_map:
+        item_identifier = Id(obj_map['itemId']).identifier
+    else:
+        item_identifier = str(obj_map['_id'])
+        if is_shuffled(obj_map.get('question') or {}):
+            return osid_object.get_qti_xml(media_file_root_path=media_file_root_path)
+
+    key = (item_identifier,
+           str(osid_object.ident),
+           media_file_root_path,
+           web.ctx.env.get('HTTP_X_API_LOCALE', '').lower())
+    qti = RENDERED_QTI_CACHE.get(key)
+    if qti is None:
+        qti = osid_object.get_qti_xml(media_file_root_path=media_file_root_path)
+        RENDERED_QTI_CACHE.set(key, qti)
+    return qti
+
+
+def import_qti_package(bank, qti_package, repository_manager=None):
+    """Create an item, with its question and answers, from an Onyx QTI zip
+    package (a file-like object). If an item with the same QTI identifier
+    exists already, it is archived and set as the new item's provenance.
+    Media files are shared through ``repository_manager``, by default the
+    current request's.
+    """
+    keywords = []
+    description = ''
+    learning_objective = None
+    media_files = {}
+    qti_file_name = None
+
+    # index the zip's central directory once. Media members are
+    # only decompressed when a form stores them in the datastore,
+    # so they are never all held in memory at once.
+    # https://docs.python.org/2/library/zipfile.html
+    with zipfile.ZipFile(qti_package) as qti_zip:
+        for zip_info in qti_zip.infolist():
+            zip_file_name = zip_info.filename
+            if zip_file_name == 'imsmanifest.xml':
+                # get manifest keywords
+                manifest_xml = qti_zip.read(zip_info)
+                manifest_soup = BeautifulSoup(manifest_xml, 'lxml-xml')
+                if manifest_soup.resources.resource.metadata.general.description:
+                    for keyword in manifest_soup.resources.resource.metadata.general.description:
+                        if keyword is not None and keyword.string is not None:
+                            if '[type]' in keyword.string:
+                                split_keywords = keyword.string.split('}')
+                                type_tag = split_keywords[0]
+                                keywords.append(type_tag.replace('[type]', '').replace('<', '').replace('>', '').replace('{', '').replace('}', ''))
+                                if len(split_keywords) > 1:
+                                    description += '\n'.join(split_keywords[1::]).strip()
+                            else:
+                                description += keyword.string
+                if manifest_soup.resources.lom:
+                    for classification in manifest_soup.resources.lom.find_all('classification'):
+                        if classification.purpose.value.string == 'target audience':
+                            learning_objective = classification.taxonPath.taxon.entry.string.string
+            elif 'media/' in zip_file_name:
+                if zip_file_name != 'media/':
+                    # this method must match what is in the QTI QuestionFormRecord
+                    file_name = zip_file_name.replace('media/', '').replace('.', '_')
+                    media_files[file_name] = DataInputStream(ZipMemberFile(qti_zip, zip_info))
+            elif '.xml' in zip_file_name:
+                qti_file_name = zip_file_name
+
+        # now deal with the question xml
+        qti_xml = qti_zip.open(qti_file_name, 'rU').read()
+
+        # to handle video tags, we need to do a blanket replace
+        # of  &lt; => <
+        # and &gt; => >
+        # with the assumption that will not break anything else ...
+        # clean_qti_xml = qti_xml.replace('&lt;', '<').replace('&gt;', '>')
+        # deprecated
+        clean_qti_xml = qti_xml
+
+        soup = BeautifulSoup(clean_qti_xml, 'xml')
+
+        # only the package has been read so far, so packages are parsed in
+        # parallel; the datastore writes are serialized where they conflict
+        with qti_import_datastore_writes(bank):
+            return create_qti_item(bank, soup, clean_qti_xml, media_files,
+                                   keywords, description, learning_objective,
+                                   repository_manager=repository_manager)
+
+
+def import_qti_packages(job, bank_id, username, language_code, packages):
+    """Import (index, QTI package) pairs in order, recording each outcome
+    in ``job['results'][index]``. Runs in a QTI import pool thread, which
+    has no request (and no web.ctx) of its own, so the managers are got for
+    the proxy user and locale of the request that started the job."""
+    bank = None
+    for index, qti_package in packages:
+        try:
+            if bank is None:
+                with_locale = language_code is not None
+                am = utilities.get_service_manager('ASSESSMENT',
+                                                   with_locale=with_locale,
+                                                   username=username,
+                                                   language_code=language_code)
+                bank = am.get_bank(bank_id)
+                bank.use_isolated_bank_view()
+                rm = utilities.get_service_manager('REPOSITORY',
+                                                   with_locale=with_locale,
+                                                   username=username,
+                                                   language_code=language_code)
+            new_item = import_qti_package(bank, qti_package, repository_manager=rm)
+            result = {
+                'status': 'created',
+                'itemId': str(new_item.ident)
+            }
+        except Exception as ex:
+            try:
+                message = str(ex)
+            except UnicodeError:
+                message = unicode(ex)
+            result = {
+                'status': 'failed',
+                'error': type(ex).__name__,
+                'message': message
+            }
+        finally:
+            qti_package.close()
+        with QTI_IMPORT_LOCK:
+            job['results'][index].update(result)
+            job['completed'] += 1
+            if job['completed'] == job['total']:
+                job['status'] = 'complete'
+
+
+def invalidate_rendered_qti(item_id):
+    """Drop the cached QTI renders of an item and of the takens' questions
+    made from it"""
+    item_identifier = item_id.identifier
+    RENDERED_QTI_CACHE.invalidate_where(lambda key: key[0] == item_identifier)
+
+
+def invalidate_taken_results(taken_id=None):
+    """Drop the materialized results of a taken, or of every taken"""
+    with TAKEN_RESULTS_LOCK:
+        if taken_id is None:
+            TAKEN_RESULTS_CACHE.clear()
+            _taken_results_generations.clear()
+        else:
+            taken_id = str(taken_id)
+            _taken_results_generations[taken_id] = _taken_results_generations.get(taken_id, 0) + 1
+            TAKEN_RESULTS_CACHE.invalidate_where(lambda key: key[0] == taken_id)
+
+
+def is_shuffled(question_map):
+    """True if the question's randomized lists get re-shuffled every time
+    the question is fetched"""
+    if not question_map.get('shuffle', True):
+        return False
+    return any(question_map.get(key) for key in RANDOMIZED_QUESTION_KEYS)
+
+
+def get_item_statistics(matrices):
+    """Classical item analysis of an offering's response matrices (see
+    get_offered_response_matrices), computed a whole matrix at a time.
+
+    Per question: the p-value (share of the takens that got the question who
+    answered it right), the point-biserial correlation of the question with
+    the rest of the test, and how often each choice was picked. Cronbach's
+    alpha only counts the takens that got every question. Statistics that
+    are undefined (e.g. nobody got the question) are null.
+    """
+    scores = matrices['scores']
+    choices = matrices['choices']
+    taken_count, question_count = scores.shape
+
+    presented = scores != NOT_PRESENTED
+    correct = (scores == 1).astype(np.float64)
+    presented_counts = presented.sum(axis=0)
+    totals = correct.sum(axis=1)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        p_values = correct.sum(axis=0) / presented_counts
+
+        rest_scores = totals[:, np.newaxis] - correct
+        rest_means = (rest_scores * presented).sum(axis=0) / presented_counts
+        item_deviations = (correct - p_values) * presented
+        rest_deviations = (rest_scores - rest_means) * presented
+        point_biserials = ((item_deviations * rest_deviations).sum(axis=0) /
+                           np.sqrt((item_deviations ** 2).sum(axis=0) *
+                                   (rest_deviations ** 2).sum(axis=0)))
+
+        complete = presented.all(axis=1)
+        complete_correct = correct[complete]
+        alpha = np.nan
+        if question_count > 1 and len(complete_correct) > 1:
+            item_variance = complete_correct.var(axis=0, ddof=1).sum()
+            total_variance = complete_correct.sum(axis=1).var(ddof=1)
+            alpha = (question_count / (question_count - 1.0) *
+                     (1 - item_variance / total_variance))
+
+    # one bincount over (question, choice) pairs for every choice table
+    width = max([len(ids) for ids in matrices['choice_ids']] + [1])
+    answered = choices != NO_CHOICE
+    columns = np.nonzero(answered)[1]
+    choice_counts = np.bincount(columns * width + choices[answered],
+                                minlength=question_count * width).reshape(question_count, width)
+
+    questions = []
+    for column, item_id in enumerate(matrices['item_ids']):
+        questions.append({
+            'itemId': item_id,
+            'presented': int(presented_counts[column]),
+            'pValue': round_statistic(p_values[column]),
+            'pointBiserial': round_statistic(point_biserials[column]),
+            'choices': [{
+                'id': choice_id,
+                'name': matrices['choice_names'][column][index],
+                'count': int(choice_counts[column, index])
+            } for index, choice_id in enumerate(matrices['choice_ids'][column])]
+        })
+
+    return {
+        'takens': taken_count,
+        'completeTakens': int(complete.sum()),
+        'meanScore': round_statistic(totals.mean() if taken_count > 0 else np.nan),
+        'cronbachAlpha': round_statistic(alpha),
+        'questions': questions
+    }
 
 
 def get_object_bank(manager, object_id, object_type='item', bank_id=None):
@@ -548,6 +1051,87 @@ def get_object_bank(manager, object_id, object_type='item', bank_id=None):
     return manager.get_bank(utilities.clean_id(bank_id))
 
 
+def get_offered_response_matrices(bank, offered_id):
+    """The takens x questions matrices of an offering, built from its takens'
+    materialized results (see get_taken_results_map) and cached until those
+    change:
+
+      * ``scores``: int8, 1 if answered right, 0 if wrong or not answered,
+        NOT_PRESENTED if the taken never got the question
+      * ``choices``: int16, the column's ``choice_ids`` index of the first
+        choice picked, or NO_CHOICE
+
+    Columns are labelled by ``item_ids`` (in the order they are first seen),
+    ``choice_ids`` and ``choice_names``. Takens that have not got their
+    questions yet are left out.
+    """
+    takens = bank.get_assessments_taken_for_assessment_offered(offered_id)
+    results_maps = [_get_taken_results_map(taken, bank) for taken in takens]
+    results_maps = [results_map for results_map in results_maps
+                    if len(results_map['sections']) > 0]
+
+    matrices = OFFERED_RESPONSE_MATRICES_CACHE.get(str(offered_id))
+    if (matrices is not None and
+            len(matrices['results_maps']) == len(results_maps) and
+            all(built is current
+                for built, current in zip(matrices['results_maps'], results_maps))):
+        return matrices
+
+    item_ids = []
+    item_columns = {}
+    choice_ids = []
+    choice_names = []
+    rows, columns, scores, choices = [], [], [], []
+    for row, results_map in enumerate(results_maps):
+        for section in results_map['sections']:
+            for question in section['questions']:
+                item_id = question.get('itemId', question.get('id'))
+                if item_id not in item_columns:
+                    item_columns[item_id] = len(item_ids)
+                    item_ids.append(item_id)
+                    choice_ids.append([])
+                    choice_names.append([])
+                column = item_columns[item_id]
+
+                column_choice_ids = choice_ids[column]
+                question_choices = question.get('choices')
+                if isinstance(question_choices, list):
+                    for choice in question_choices:
+                        if (isinstance(choice, dict) and 'id' in choice and
+                                choice['id'] not in column_choice_ids):
+                            column_choice_ids.append(choice['id'])
+                            choice_names[column].append(choice.get('name'))
+
+                choice = NO_CHOICE
+                response = question.get('response')
+                if isinstance(response, dict) and response.get('choiceIds'):
+                    choice_id = response['choiceIds'][0]
+                    if choice_id not in column_choice_ids:
+                        column_choice_ids.append(choice_id)
+                        choice_names[column].append(None)
+                    choice = column_choice_ids.index(choice_id)
+
+                rows.append(row)
+                columns.append(column)
+                scores.append(1 if question.get('isCorrect') else 0)
+                choices.append(choice)
+
+    shape = (len(results_maps), len(item_ids))
+    matrices = {
+        'item_ids': item_ids,
+        'choice_ids': choice_ids,
+        'choice_names': choice_names,
+        'results_maps': results_maps,
+        'scores': np.full(shape, NOT_PRESENTED, dtype=np.int8),
+        'choices': np.full(shape, NO_CHOICE, dtype=np.int16)
+    }
+    if len(rows) > 0:
+        matrices['scores'][rows, columns] = scores
+        matrices['choices'][rows, columns] = choices
+    OFFERED_RESPONSE_MATRICES_CACHE.set(str(offered_id), matrices)
+    return matrices
+
+
 def get_ovs_file_set(files, index):
     choice_files = get_choice_files(files)
     if len(choice_files.keys()) % 2 != 0:
@@ -744,6 +1328,67 @@ def get_question_records_from_item_genus(item_genus_type):
     return question_record_types
 
 
+def get_qti_import_job(job_id):
+    """A snapshot of a bulk QTI import job, safe to serialize while the
+    job is still running"""
+    job = QTI_IMPORT_JOBS.get(job_id)
+    if job is None:
+        raise NotFound('QTI import job')
+    with QTI_IMPORT_LOCK:
+        return dict(job, results=[dict(result) for result in job['results']])
+
+
+def get_qti_import_pool():
+    global _qti_import_pool
+    with QTI_IMPORT_LOCK:
+        if _qti_import_pool is None:
+            _qti_import_pool = ThreadPool(QTI_IMPORT_WORKERS)
+    return _qti_import_pool
+
+
+def get_qti_packages(uploads):
+    """Turn (file name, file) uploads into (file name, QTI package) pairs.
+    An upload is either one Onyx QTI zip package, or a zip of packages;
+    those are copied out to temporary files, one member at a time.
+    """
+    packages = []
+    for file_name, upload in uploads:
+        try:
+            with zipfile.ZipFile(upload) as upload_zip:
+                inner_packages = [zip_info for zip_info in upload_zip.infolist()
+                                  if zip_info.filename.lower().endswith('.zip')]
+                if 'imsmanifest.xml' in upload_zip.namelist() or len(inner_packages) == 0:
+                    packages.append((file_name, upload))
+                for zip_info in inner_packages:
+                    package = tempfile.TemporaryFile()
+                    shutil.copyfileobj(upload_zip.open(zip_info), package)
+                    package.seek(0)
+                    packages.append((zip_info.filename, package))
+        except zipfile.BadZipfile:
+            raise InvalidArgument('{0} is not a zip file'.format(file_name))
+        upload.seek(0)
+    return packages
+
+
+def get_qti_package_identifier(qti_package):
+    """The QTI identifier of the item in a package, without parsing the XML"""
+    identifier = None
+    try:
+        with zipfile.ZipFile(qti_package) as qti_zip:
+            for zip_file_name in qti_zip.namelist():
+                if ('.xml' in zip_file_name and
+                        'media/' not in zip_file_name and
+                        zip_file_name != 'imsmanifest.xml'):
+                    match = re.search(r'<assessmentItem\b[^>]*\sidentifier="([^"]*)"',
+                                      qti_zip.read(zip_file_name))
+                    if match is not None:
+                        identifier = match.group(1)
+    except zipfile.BadZipfile:
+        pass
+    qti_package.seek(0)
+    return identifier
+
+
 def get_question_status(bank, section, question_id):
     """
     Return the question status of answered or not, and if so, right or wrong
@@ -902,6 +1547,35 @@ def get_taken_section_map(taken, update=False, with_files=False, bank=None, with
     return section_maps
 
 
+def get_taken_results_map(taken, bank, with_additional_attempts=False):
+    """The taken's object map with its sections, from the materialized
+    results if they are there"""
+    return copy.deepcopy(_get_taken_results_map(taken, bank, with_additional_attempts))
+
+
+def _get_taken_results_map(taken, bank, with_additional_attempts=False):
+    """get_taken_results_map without the copy, for callers that only read
+    the map"""
+    taken_id = str(taken.ident)
+    key = (taken_id, utilities.get_locale_code(), with_additional_attempts)
+    results_map = TAKEN_RESULTS_CACHE.get(key)
+    if results_map is None:
+        with TAKEN_RESULTS_LOCK:
+            generation = _taken_results_generations.get(taken_id, 0)
+        results_map = taken.object_map
+        results_map['sections'] = get_taken_section_map(taken,
+                                                        update=False,
+                                                        bank=bank,
+                                                        with_additional_attempts=with_additional_attempts)
+        # the sections only get made once the taker first gets the questions,
+        # which does not refresh the results, so wait until then
+        if len(results_map['sections']) > 0:
+            with TAKEN_RESULTS_LOCK:
+                if _taken_results_generations.get(taken_id, 0) == generation:
+                    TAKEN_RESULTS_CACHE.set(key, results_map)
+    return results_map
+
+
 def get_text_as_display_text(object_map):
     if 'text' in object_map:
         text = object_map['text']
@@ -1116,6 +1790,41 @@ def match_submission_to_answer(answers, response):
         return answer_match
 
 
+@contextmanager
+def qti_import_datastore_writes(bank):
+    """Hold QTI_IMPORT_DATASTORE_LOCK around the datastore work of a QTI
+    import, when ``bank`` is in the JSON file datastore"""
+    collection = JSONClientValidated('assessment',
+                                     collection='Item',
+                                     runtime=bank._catalog._runtime)
+    if isinstance(collection.raw(), basestring):
+        with QTI_IMPORT_DATASTORE_LOCK:
+            yield
+    else:
+        yield
+
+
+def refresh_taken_results(bank, taken_id):
+    """Rebuild the materialized results of a taken after it changed. Only
+    the variants that were already materialized are rebuilt, so takens
+    that nobody reads the results of cost nothing extra."""
+    locale = utilities.get_locale_code()
+    cached = [with_additional_attempts
+              for with_additional_attempts in (False, True)
+              if (str(taken_id), locale, with_additional_attempts) in TAKEN_RESULTS_CACHE]
+    invalidate_taken_results(taken_id)
+    if len(cached) == 0:
+        return
+    try:
+        taken = bank.get_assessment_taken(taken_id)
+        for with_additional_attempts in cached:
+            _get_taken_results_map(taken, bank, with_additional_attempts)
+    except Exception:
+        # the results are rebuilt on the next read instead; this should
+        # never fail the taker's request
+        pass
+
+
 def remove_language_type(object_map):
     return 'removeLanguageType' in object_map
 
@@ -1126,12 +1835,23 @@ def remove_field(object_map, field):
     return False
 
 
+def reorder_list_by_ids(ordered_ids, randomized_list):
+    objects_by_id = {}
+    for object_ in randomized_list:
+        objects_by_id.setdefault(object_['id'], object_)
+    return [objects_by_id[object_id] for object_id in ordered_ids]
+
+
 def reorder_list_by_unrandomized_list(unrandomized_list, randomized_list):
-    reordered_list = []
-    for object_ in unrandomized_list:
-        matching_object = [o for o in randomized_list if o['id'] == object_['id']][0]
-        reordered_list.append(matching_object)
-    return reordered_list
+    return reorder_list_by_ids([o['id'] for o in unrandomized_list],
+                               randomized_list)
+
+
+def round_statistic(value):
+    """A statistic as a JSON number, or None if it is undefined"""
+    if np.isnan(value) or np.isinf(value):
+        return None
+    return round(float(value), 4)
 
 
 def set_answer_form_genus_and_feedback(answer, answer_form):
@@ -1251,6 +1971,59 @@ def set_item_learning_objectives(data, form):
     return form
 
 
+def share_qti_media_files(bank, qti_objects, repository_manager=None):
+    """Share the datastore files of the media that the QTI form records
+    stored for a new item's question and answers with identical files
+    already in the bank's repository (see rutils.share_asset_content_file),
+    so a file used by several answers, language variants or re-imports is
+    kept once. Each reference keeps its own asset. ``repository_manager``
+    defaults to the current request's."""
+    if repository_manager is None:
+        repository_manager = rutils.get_repository_manager()
+    repository = repository_manager.get_repository(bank.ident)
+    for qti_object in qti_objects:
+        try:
+            file_ids = qti_object.get_asset_ids_map()
+        except (AttributeError, KeyError):
+            # no files record / no files
+            continue
+        for file_id in file_ids.values():
+            if file_id.get('assetContentId'):
+                rutils.share_asset_content_file(repository,
+                                                utilities.clean_id(file_id['assetContentId']))
+
+
+def start_qti_import(bank, packages):
+    """Queue (file name, QTI package) pairs for import into ``bank``, and
+    return the job to poll. Packages with the same QTI identifier are
+    imported one after another, in the order given, so that each one
+    provenances the one before it; other packages import in parallel (see
+    QTI_IMPORT_WORKERS).
+    """
+    job = {
+        'id': str(ObjectId()),
+        'bankId': str(bank.ident),
+        'status': 'running' if len(packages) > 0 else 'complete',
+        'total': len(packages),
+        'completed': 0,
+        'results': [{'fileName': file_name, 'status': 'pending'} for file_name, qti_package in packages]
+    }
+
+    groups = OrderedDict()
+    for index, (file_name, qti_package) in enumerate(packages):
+        identifier = get_qti_package_identifier(qti_package) or index
+        groups.setdefault(identifier, []).append((index, qti_package))
+
+    username = utilities.get_proxy_username()
+    language_code = utilities.get_locale_code()
+
+    QTI_IMPORT_JOBS.set(job['id'], job)
+    pool = get_qti_import_pool()
+    for group in groups.values():
+        pool.apply_async(import_qti_packages, (job, bank.ident, username, language_code, group))
+    return job
+
+
 def update_answer_form(answer, form, question=None):
     if 'type' in answer:
         if isinstance(answer['type'], list):
@@ -1677,56 +2450,36 @@ def update_item_json_answers(item, item_map):
     return item_map
 
 
-def update_item_json_random_choices(bank, item, item_map):
+def update_item_json_random_choices(bank, item, item_map, canonical_orders=None):
     # for convenience, return choices in original order
-    item = bank.get_item(item.ident)
+    if canonical_orders is None:
+        # need to re-get the item so that the choice order isn't already shuffled
+        # by .object_map. Callers that list many items should pass in
+        # get_canonical_choice_orders(item), taken before .object_map, instead.
+        canonical_orders = get_canonical_choice_orders(bank.get_item(item.ident))
     serialize = False
     if isinstance(item_map, basestring):
         item_map = json.loads(item_map)
         serialize = True
 
     try:
-        # need to re-get the item so that the choice order isn't already shuffled
-        # by .object_map
         question = item.get_question()
     except TypeError:
         # item has no question
         pass
     else:
-        if hasattr(question, 'get_unrandomized_choices'):
-            unrandomized_choice_order = question.get_unrandomized_choices()
-
-            # now need to get the updated texts, because they might have Assets
-            if isinstance(unrandomized_choice_order, dict):
-                new_choices = {}
-                for region, choices in unrandomized_choice_order.iteritems():
-                    new_choices[region] = reorder_list_by_unrandomized_list(choices,
-                                                                            item_map['question']['choices'][region])
+        for key in RANDOMIZED_QUESTION_KEYS:
+            if (not hasattr(question, 'get_unrandomized_{0}'.format(key)) or
+                    key not in canonical_orders):
+                continue
+            ordered_ids = canonical_orders[key]
+            if isinstance(ordered_ids, dict):
+                item_map['question'][key] = dict((region, reorder_list_by_ids(region_ids,
+                                                                              item_map['question'][key][region]))
+                                                 for region, region_ids in ordered_ids.iteritems())
             else:
-                new_choices = reorder_list_by_unrandomized_list(unrandomized_choice_order,
-                                                                item_map['question']['choices'])
-            item_map['question']['choices'] = new_choices
-        if hasattr(question, 'get_unrandomized_droppables'):
-            unrandomized_droppables_order = question.get_unrandomized_droppables()
-
-            new_droppables = reorder_list_by_unrandomized_list(unrandomized_droppables_order,
-                                                               item_map['question']['droppables'])
-
-            item_map['question']['droppables'] = new_droppables
-        if hasattr(question, 'get_unrandomized_targets'):
-            unrandomized_targets_order = question.get_unrandomized_targets()
-
-            new_targets = reorder_list_by_unrandomized_list(unrandomized_targets_order,
-                                                            item_map['question']['targets'])
-
-            item_map['question']['targets'] = new_targets
-        if hasattr(question, 'get_unrandomized_zones'):
-            unrandomized_zones_order = question.get_unrandomized_zones()
-
-            new_zones = reorder_list_by_unrandomized_list(unrandomized_zones_order,
-                                                          item_map['question']['zones'])
-
-            item_map['question']['zones'] = new_zones
+                item_map['question'][key] = reorder_list_by_ids(ordered_ids,
+                                                                item_map['question'][key])
 
         if serialize:
             item_map = json.dumps(item_map)
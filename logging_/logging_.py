@@ -1,26 +1,27 @@
 ################################################
 #  LOGGING
 ################################################
-import json
+import traceback
 import web
 
-from dlkit.runtime.errors import IllegalState
+from dlkit.runtime.errors import IllegalState, InvalidArgument
 from dlkit.runtime.primordium import Id, Type
 
-from dlkit.records.registry import LOG_ENTRY_RECORD_TYPES
-
 import logging_utilities as logutils
 import utilities
 
 
 DEFAULT_LOG_GENUS_TYPE = 'log-genus-type%3Adefault-clix%40ODL.MIT.EDU'
-TEXT_BLOB_RECORD_TYPE = Type(**LOG_ENTRY_RECORD_TYPES['text-blob'])
+TEXT_BLOB_RECORD_TYPE = logutils.TEXT_BLOB_RECORD_TYPE
 
 urls = (
     "/logs/?", "LogsList",
     "/logs/(.*)/logentries/(.*[^/])/?", "LogEntryDetails",
     "/logs/(.*)/logentries/?", "LogEntriesList",
+    "/logs/(.*)/archive/?", "LogArchive",
+    "/logs/(.*)/export/?", "LogExport",
     "/logs/(.*[^/])/?", "LogDetails",
+    "/genericlog/journal/?", "GenericLogJournal",
     "/genericlog/?", "GenericLogEntries"
 )
 
@@ -59,7 +60,8 @@ class LogDetails(utilities.BaseClass):
         try:
             logm = logutils.get_logging_manager()
             log = logm.get_log(utilities.clean_id(log_id))
-            log = utilities.convert_dl_object(log)
+            log = utilities.convert_dl_object(log,
+                                              fields=utilities.get_requested_fields(self.data()))
 
             return log
         except Exception as ex:
@@ -122,7 +124,8 @@ class LogsList(utilities.BaseClass):
         try:
             logm = logutils.get_logging_manager()
             logs = logm.logs
-            logs = utilities.extract_items(logs)
+            logs = utilities.extract_items(logs,
+                                           fields=utilities.get_requested_fields(self.data()))
             return logs
         except Exception as ex:
             utilities.handle_exceptions(ex)
@@ -165,49 +168,136 @@ class LogEntriesList(utilities.BaseClass):
 
     GET, POST
     GET to view current log entries
-    POST to create a new log entry
+    POST to create a new log entry, or a batch of them with "entries".
+        A batch returns, in order, {"id": ...} or {"error": ...} per entry.
 
     Note that for RESTful calls, you need to set the request header
     'content-type' to 'application/json'
 
     Example (note the use of double quotes!!):
        {"data" : "<JSON string blob, or whatever text blob you want>"}
+       {"entries": [{"data": "foo", "timestamp": {"year": 2016, "month": 8, "day": 1}},
+                    {"data": "bar", "name": "second"}]}
     """
     @utilities.format_response
     def GET(self, log_id):
         try:
             logm = logutils.get_logging_manager()
             log = logm.get_log(utilities.clean_id(log_id))
-            entries = log.get_log_entries()
-
-            data = utilities.extract_items(entries)
 
-            return data
+            return utilities.stream_json_list(get_log_entry_maps(log, self.data()))
         except Exception as ex:
             utilities.handle_exceptions(ex)
 
     @utilities.format_response
     def POST(self, log_id):
         try:
-            utilities.verify_keys_present(self.data(), ['data'])
+            utilities.verify_at_least_one_key_present(self.data(), ['data', 'entries'])
             logm = logutils.get_logging_manager()
 
             log = logm.get_log(utilities.clean_id(log_id))
-            form = log.get_log_entry_form_for_create([TEXT_BLOB_RECORD_TYPE])
+            if 'entries' in self.data():
+                return logutils.create_log_entries(log,
+                                                   logutils.get_log_entry_batch(self.data()))
 
-            if isinstance(self.data()['data'], dict):
-                blob = json.dumps(self.data()['data'])
-            else:
-                blob = str(self.data()['data'])
-
-            form.set_text(blob)
-            entry = log.create_log_entry(form)
+            entry = logutils.create_log_entry(log, self.data())
 
             return utilities.convert_dl_object(entry)
         except Exception as ex:
             utilities.handle_exceptions(ex)
 
 
+class LogArchive(utilities.BaseClass):
+    """
+    Archive the older entries of a log into compressed daily segments
+    api/v1/logging/logs/<log_id>/archive/
+
+    GET, POST
+    GET to view the manifest of archived segments
+    POST to move the entries from before "before" (by default, all but the
+        last 7 days) out of the datastore, into one gzip'ed JSON lines
+        segment per day. Archived entries are still listed with the log's
+        entries. Returns the new segments.
+
+    Example (note the use of double quotes!!):
+       {"before": {"year": 2016, "month": 9, "day": 1}}
+    """
+    @utilities.format_response
+    def GET(self, log_id):
+        try:
+            logm = logutils.get_logging_manager()
+            log = logm.get_log(utilities.clean_id(log_id))
+
+            return logutils.get_log_archive_manifest(log)
+        except Exception as ex:
+            utilities.handle_exceptions(ex)
+
+    @utilities.format_response
+    def POST(self, log_id):
+        try:
+            logm = logutils.get_logging_manager()
+            log = logm.get_log(utilities.clean_id(log_id))
+
+            before = None
+            if 'before' in self.data():
+                before = logutils.get_log_entry_timestamp(self.data()['before'])
+            segments = logutils.archive_log_entries(log, before=before)
+
+            return {'segments': segments}
+        except Exception as ex:
+            utilities.handle_exceptions(ex)
+
+
+class LogExport(utilities.BaseClass):
+    """
+    Export the entries of a log, archived or not, oldest first
+    api/v1/logging/logs/<log_id>/export/
+
+    GET
+    GET streams newline-delimited JSON (format=ndjson, the default) or CSV
+        (format=csv), one flat record per entry with the text blob parsed
+        into "data" when it is JSON. Takes the startTime / endTime / agentId /
+        genusTypeId filters of logentries/, and dataFields=a,b to add CSV
+        columns for keys of "data". Every record has a cursor; pass the last
+        one received as cursor= to resume after it. Gzip'ed if the client
+        accepts it.
+    """
+    @utilities.allow_cors
+    def GET(self, log_id):
+        try:
+            logm = logutils.get_logging_manager()
+            log = logm.get_log(utilities.clean_id(log_id))
+
+            # everything that can reject the request happens before the
+            # first header is set
+            export_format = self.data().get('format', 'ndjson')
+            if export_format not in logutils.LOG_EXPORT_CONTENT_TYPES:
+                raise InvalidArgument('format must be one of {0}'.format(
+                    ', '.join(sorted(logutils.LOG_EXPORT_CONTENT_TYPES.keys()))))
+            after = None
+            if self.data().get('cursor'):
+                after = logutils.decode_log_export_cursor(self.data()['cursor'])
+            data_fields = [field.strip()
+                           for field in self.data().get('dataFields', '').split(',')
+                           if field.strip()]
+
+            entries = logutils.iter_log_entry_maps_by_key(log,
+                                                          filters=logutils.get_log_entry_filters(self.data()),
+                                                          after=after)
+            chunks = logutils.iter_log_export_chunks(entries, export_format, data_fields=data_fields)
+
+            web.header('Content-Type', logutils.LOG_EXPORT_CONTENT_TYPES[export_format])
+            web.header('Content-Disposition', 'attachment; filename="{0}.{1}"'.format(
+                log.ident.identifier, export_format))
+            web.header('Vary', 'Accept-Encoding')
+            if utilities.accepts_gzip():
+                web.header('Content-Encoding', 'gzip')
+                chunks = utilities.gzip_chunks(chunks)
+            return chunks
+        except Exception as ex:
+            utilities.handle_exceptions(ex)
+
+
 class LogEntryDetails(utilities.BaseClass):
     """
     Get log entry details
@@ -230,6 +320,7 @@ class LogEntryDetails(utilities.BaseClass):
             logm = logutils.get_logging_manager()
             log = logm.get_log(utilities.clean_id(log_id))
             log.delete_log_entry(utilities.clean_id(entry_id))
+            logutils.get_log_entry_index(log).remove([utilities.clean_id(entry_id)])
 
             return utilities.success()
         except Exception as ex:
@@ -242,7 +333,8 @@ class LogEntryDetails(utilities.BaseClass):
             lels = logm.get_log_entry_lookup_session(proxy=logm._proxy)
             lels.use_federated_log_view()
             entry = lels.get_log_entry(utilities.clean_id(entry_id))
-            entry_map = entry.object_map
+            entry_map = utilities.project_fields(entry.object_map,
+                                                 utilities.get_requested_fields(self.data()))
 
             return entry_map
         except Exception as ex:
@@ -260,11 +352,7 @@ class LogEntryDetails(utilities.BaseClass):
             form = log.get_log_entry_form_for_update(utilities.clean_id(entry_id))
 
             if 'data' in self.data():
-                if isinstance(self.data()['data'], dict):
-                    blob = json.dumps(self.data()['data'])
-                else:
-                    blob = str(self.data()['data'])
-                form.set_text(blob)
+                form.set_text(logutils.get_log_entry_text(self.data()['data']))
 
             log.update_log_entry(form)
 
@@ -275,51 +363,120 @@ class LogEntryDetails(utilities.BaseClass):
             utilities.handle_exceptions(ex)
 
 
+def get_default_log():
+    """The log for entries from tools that do not know about catalog IDs"""
+    return logutils.get_or_create_log_by_genus(
+        logutils.get_logging_manager(),
+        DEFAULT_LOG_GENUS_TYPE,
+        'Default CLIx QBank log',
+        'For logging info from unplatform and tools, which do not know about catalog IDs')
+
+
+def get_default_log_journal():
+    """The journal of the default log. Once the log id is known, this does
+    not touch the logging service."""
+    log_id = logutils.LOG_IDS_BY_GENUS.get(DEFAULT_LOG_GENUS_TYPE)
+    if log_id is not None and log_id in logutils.LOG_JOURNALS:
+        return logutils.LOG_JOURNALS[log_id]
+    return logutils.get_log_journal(get_default_log())
+
+
+def get_log_entry_maps(log, params):
+    """The page of a log's entry maps that a list request asks for,
+    archived entries first. Requests with startTime / endTime / agentId /
+    genusTypeId go through the log's entry index, and get the entries that
+    are not archived in timestamp order."""
+    filters = logutils.get_log_entry_filters(params)
+    fields = utilities.get_requested_fields(params)
+    if filters is None and not logutils.get_log_archive_manifest(log)['segments']:
+        # nothing archived, so dlkit can skip to the page
+        return utilities.iter_object_maps(utilities.paginate(log.get_log_entries(), params),
+                                          fields=fields)
+    return utilities.paginate(logutils.iter_log_entry_maps(log, filters=filters, fields=fields),
+                              params)
+
+
 class GenericLogEntries(utilities.BaseClass):
-    def _get_log(self):
-        logm = logutils.get_logging_manager()
-
-        logs = logm.get_logs()
-        default_log = None
-        for log in logs:
-            if str(log.genus_type) == DEFAULT_LOG_GENUS_TYPE:
-                default_log = log
-                break
-        if default_log is None:
-            form = logm.get_log_form_for_create([])
-            form.set_genus_type(Type(DEFAULT_LOG_GENUS_TYPE))
-            form.display_name = 'Default CLIx QBank log'
-            form.description = 'For logging info from unplatform and tools, which do not know about catalog IDs'
-
-            default_log = logm.create_log(form)
-        return default_log
+    """
+    Get or add entries in the default log
+    api/v1/logging/genericlog/
 
+    GET, POST
+    GET to view the log entries, including any still in the journal
+    POST to create a new log entry, or a batch of them with "entries".
+        A batch returns, in order, {"id": ...} or {"error": ...} per entry.
+
+    Example (note the use of double quotes!!):
+       {"data" : "<JSON string blob, or whatever text blob you want>"}
+       {"entries": [{"data": "foo", "timestamp": {"year": 2016, "month": 8, "day": 1}},
+                    {"data": "bar", "name": "second"}]}
+    """
     @utilities.format_response
     def GET(self):
-        default_log = self._get_log()
-        log_entries = [le.object_map for le in default_log.get_log_entries()]
-        return log_entries
+        try:
+            default_log = get_default_log()
+            try:
+                logutils.get_log_journal(default_log).flush()
+            except Exception:
+                # the entries stay in the journal for the next flush
+                print traceback.format_exc(10)
+
+            return utilities.stream_json_list(get_log_entry_maps(default_log, self.data()))
+        except Exception as ex:
+            utilities.handle_exceptions(ex)
 
     @utilities.format_response
     def POST(self):
-        # get or find a default log genus type
         try:
             input_data = self.data()
-            utilities.verify_keys_present(input_data, ['data'])
-            log = self._get_log()
+            utilities.verify_at_least_one_key_present(input_data, ['data', 'entries'])
+            if 'entries' in input_data:
+                return logutils.create_log_entries(get_default_log(),
+                                                   logutils.get_log_entry_batch(input_data))
 
-            form = log.get_log_entry_form_for_create([TEXT_BLOB_RECORD_TYPE])
+            entry = logutils.create_log_entry(get_default_log(), input_data)
 
-            if isinstance(input_data['data'], dict):
-                blob = json.dumps(input_data['data'])
-            else:
-                blob = str(input_data['data'])
+            return utilities.convert_dl_object(entry)
+        except Exception as ex:
+            utilities.handle_exceptions(ex)
 
-            form.set_text(blob)
-            form = utilities.set_form_basics(form, input_data)
-            entry = log.create_log_entry(form)
 
-            return utilities.convert_dl_object(entry)
+class GenericLogJournal(utilities.BaseClass):
+    """
+    Journal entries for the default log, for high volume event streams
+    api/v1/logging/genericlog/journal/
+
+    POST
+    POST takes the same payload as genericlog/, but only appends it to a
+    journal, and returns once it is fsync'ed. A batch ("entries") is appended in one
+    write, and returns {} or {"error": ...} per entry. Journaled entries are created in the
+    log in groups, in the background, with the time and user of the original POST.
+    Reading genericlog/ creates any that are still waiting.
+
+    Example (note the use of double quotes!!):
+       {"data" : "<JSON string blob, or whatever text blob you want>"}
+    """
+    @utilities.format_response
+    def POST(self):
+        try:
+            input_data = self.data()
+            utilities.verify_at_least_one_key_present(input_data, ['data', 'entries'])
+            if 'entries' in input_data:
+                entries = logutils.get_log_entry_batch(input_data)
+                results = logutils.validate_log_entries(entries)
+                entries = [entry for index, entry in enumerate(entries)
+                           if 'error' not in results[index]]
+            else:
+                entries = [input_data]
+                results = None
+                error = logutils.validate_log_entries(entries)[0].get('error')
+                if error is not None:
+                    raise InvalidArgument(error)
+            get_default_log_journal().extend(utilities.get_proxy_username(), entries)
+
+            if results is not None:
+                return results
+            return utilities.success()
         except Exception as ex:
             utilities.handle_exceptions(ex)
 
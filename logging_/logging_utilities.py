@@ -1,14 +1,963 @@
+import base64
+import bisect
+import calendar
+import csv
+import datetime
+import gzip
+import heapq
+import itertools
+import json
+import os
+import tempfile
+import threading
+import time
+import traceback
 import web
 
-from dlkit.runtime import PROXY_SESSION, RUNTIME
-from dlkit.runtime.proxy_example import SimpleRequest
+from dlkit.runtime.errors import InvalidArgument, NotFound, PermissionDenied
+from collections import OrderedDict
+from cStringIO import StringIO
 
+from dlkit.runtime.primordium import DateTime, Id, Type
 
-def get_logging_manager():
-    condition = PROXY_SESSION.get_proxy_condition()
-    dummy_request = SimpleRequest(username=web.ctx.env.get('HTTP_X_API_PROXY', 'student@tiss.edu'),
-                                  authenticated=True)
-    condition.set_http_request(dummy_request)
-    proxy = PROXY_SESSION.get_proxy(condition)
-    return RUNTIME.get_service_manager('LOGGING',
-                                       proxy=proxy)
+from dlkit.records.registry import LOG_ENTRY_RECORD_TYPES
+
+import utilities
+
+
+TEXT_BLOB_RECORD_TYPE = Type(**LOG_ENTRY_RECORD_TYPES['text-blob'])
+
+# log genus type -> id of the log that holds entries of that genus. Logs
+# are never re-created under another id, so entries do not expire; a
+# deleted log is dropped when looking it up fails.
+LOG_IDS_BY_GENUS = utilities.LRUCache(64)
+utilities.CACHES['logIdsByGenus'] = LOG_IDS_BY_GENUS
+
+# Journaled log entries are appended to
+# <json datastore>/logJournal/<log identifier>.jsonl, and fsync'ed before
+# the POST that sent them returns; POSTs that come in while an fsync is
+# running share the next one. A background thread creates the journaled
+# entries in the logging service, in groups of LOG_JOURNAL_FLUSH_SIZE, once
+# that many are pending or the oldest is LOG_JOURNAL_FLUSH_INTERVAL seconds
+# old. It checks the journals every LOG_JOURNAL_FLUSHER_POLL_INTERVAL
+# seconds, or as soon as a POST makes one due.
+LOG_JOURNAL_DIRECTORY = 'logJournal'
+LOG_JOURNAL_FLUSH_SIZE = 500
+LOG_JOURNAL_FLUSH_INTERVAL = 30
+LOG_JOURNAL_FLUSHER_POLL_INTERVAL = 1
+LOG_JOURNAL_FLUSHER_WAKEUP = threading.Event()
+
+# Errors that creating a journaled entry runs into again on every retry.
+# Its line is moved to <journal>.dead, with the error, instead of holding up
+# the rest of the journal.
+LOG_JOURNAL_DEAD_LETTER_ERRORS = (InvalidArgument, NotFound, PermissionDenied,
+                                  KeyError, TypeError, ValueError)
+
+# the log entry payload keys that utilities.set_form_basics() reads as text
+LOG_ENTRY_TEXT_KEYS = ['name', 'displayName', 'displayname', 'display_name',
+                       'desc', 'description', 'genus', 'genusTypeId', 'genusType',
+                       'genus_type_id', 'genus_type']
+
+# upper bound for the number of entries in one batch log entry POST
+MAX_LOG_ENTRY_BATCH_SIZE = 5000
+
+# log id -> LogJournal, for the life of the process
+LOG_JOURNALS = {}
+LOG_JOURNALS_LOCK = threading.Lock()
+_log_journal_flusher = None
+
+# The entries of each log are indexed by timestamp, agent and genus in
+# <json datastore>/logEntryIndex/<log identifier>.jsonl, one line per
+# created or deleted entry. The index is built with one scan of the log the
+# first time the log is queried, and then kept up to date as entries are
+# created through this service; delete the file to have it rebuilt.
+LOG_ENTRY_INDEX_DIRECTORY = 'logEntryIndex'
+
+# the URL parameters that query a log's entries through its index
+LOG_ENTRY_FILTERS = ['startTime', 'endTime', 'agentId', 'genusTypeId']
+
+# entries looked up at a time when streaming indexed query results
+LOG_ENTRY_FETCH_SIZE = 100
+
+# Entries older than the last LOG_ARCHIVE_HOT_DAYS (UTC) days can be
+# archived out of the datastore, into one gzip'ed JSON lines segment of
+# entry maps per day, in <json datastore>/logArchive/<log identifier>/.
+# Segments are never changed: entries archived later for a day that already
+# has a segment go into another one. manifest.json lists the segments.
+LOG_ARCHIVE_DIRECTORY = 'logArchive'
+LOG_ARCHIVE_HOT_DAYS = 7
+LOG_ARCHIVE_MANIFEST = 'manifest.json'
+LOG_ARCHIVE_LOCK = threading.Lock()
+
+# log export format -> content type. Exports are sent in chunks of about
+# LOG_EXPORT_CHUNK_SIZE bytes (before any gzip).
+LOG_EXPORT_CONTENT_TYPES = {
+    'csv': 'text/csv; charset=utf-8',
+    'ndjson': 'application/x-ndjson'
+}
+LOG_EXPORT_COLUMNS = ['cursor', 'id', 'timestamp', 'agentId', 'genusTypeId',
+                      'displayName', 'description', 'data']
+LOG_EXPORT_CHUNK_SIZE = 64 * 1024
+
+# log id -> LogEntryIndex, for the life of the process
+LOG_ENTRY_INDEXES = {}
+LOG_ENTRY_INDEXES_LOCK = threading.Lock()
+
+
+class LogEntryIndex(object):
+    """Secondary index of the entries of one log, by timestamp, agent and
+    genus. Entries are kept in memory in (timestamp, id) order, overall and
+    per agent and genus, so a query only walks the entries it returns. Lines
+    that other processes add to the index file are picked up before each
+    query.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._offset = 0
+        self._clear()
+
+    def _clear(self):
+        self._rows = {}
+        self._by_time = []
+        self._by_agent = {}
+        self._by_genus = {}
+
+    def add(self, entries):
+        """Index newly created entries. Until the index is built, this is
+        left to the scan that builds it."""
+        rows = [get_log_entry_index_row(entry) for entry in entries]
+        with self._lock:
+            if os.path.exists(self.path):
+                self._append(rows)
+
+    def remove(self, entry_ids):
+        with self._lock:
+            if os.path.exists(self.path):
+                self._append([{'id': str(entry_id), 'deleted': True}
+                              for entry_id in entry_ids])
+
+    def query(self, log, start_time=None, end_time=None, agent_id=None, genus_type_id=None):
+        """Ids of the entries from ``start_time`` (inclusive) to ``end_time``
+        (exclusive), both seconds since the epoch, that were logged by
+        ``agent_id`` and have ``genus_type_id``, in timestamp order"""
+        return [entry_id for timestamp, entry_id in self.query_keys(log,
+                                                                    start_time=start_time,
+                                                                    end_time=end_time,
+                                                                    agent_id=agent_id,
+                                                                    genus_type_id=genus_type_id)]
+
+    def query_keys(self, log, start_time=None, end_time=None, agent_id=None, genus_type_id=None):
+        """Like query(), but returns (timestamp, id) pairs"""
+        with self._lock:
+            if not os.path.exists(self.path):
+                self._build(log)
+            self._read()
+
+            if agent_id is not None:
+                candidates = self._by_agent.get(agent_id, [])
+            elif genus_type_id is not None:
+                candidates = self._by_genus.get(genus_type_id, [])
+            else:
+                candidates = self._by_time
+
+            first = 0
+            if start_time is not None:
+                first = bisect.bisect_left(candidates, (start_time,))
+            last = len(candidates)
+            if end_time is not None:
+                last = bisect.bisect_left(candidates, (end_time,))
+
+            if agent_id is None or genus_type_id is None:
+                return candidates[first:last]
+            return [key for key in candidates[first:last]
+                    if self._rows[key[1]][2] == genus_type_id]
+
+    def _append(self, rows):
+        with open(self.path, 'ab') as index_file:
+            index_file.write(''.join(json.dumps(row) + '\n' for row in rows))
+        self._read()
+
+    def _build(self, log):
+        directory = os.path.dirname(self.path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        # dlkit lists entries newest first; written in (timestamp, id) order,
+        # the rows load with appends
+        rows = sorted((get_log_entry_index_row(entry) for entry in log.get_log_entries()),
+                      key=lambda row: (row['timestamp'], row['id']))
+        file_descriptor, temp_path = tempfile.mkstemp(prefix='.index-', dir=directory)
+        with os.fdopen(file_descriptor, 'wb') as temp_file:
+            for row in rows:
+                temp_file.write(json.dumps(row) + '\n')
+        os.rename(temp_path, self.path)
+        self._offset = 0
+        self._clear()
+
+    def _read(self):
+        """Apply the lines added to the index file since it was last read"""
+        size = os.path.getsize(self.path)
+        if size < self._offset:
+            # rebuilt
+            self._offset = 0
+            self._clear()
+        if size == self._offset:
+            return
+        with open(self.path, 'rb') as index_file:
+            index_file.seek(self._offset)
+            data = index_file.read(size - self._offset)
+        # a line that is still being written is read next time
+        data = data[:data.rfind('\n') + 1]
+        self._offset += len(data)
+        # the last line for an entry wins
+        latest = {}
+        for line in data.splitlines():
+            try:
+                row = json.loads(line)
+            except ValueError:
+                continue
+            latest[row['id']] = row
+        self._discard([entry_id for entry_id in latest if entry_id in self._rows])
+        self._insert([latest_row for latest_row in latest.values() if not latest_row.get('deleted')])
+
+    def _discard(self, entry_ids):
+        if not entry_ids:
+            return
+        keys = []
+        for entry_id in entry_ids:
+            timestamp, agent_id, genus_type_id = self._rows.pop(entry_id)
+            keys.append((timestamp, entry_id, agent_id, genus_type_id))
+        if len(keys) == 1:
+            timestamp, entry_id, agent_id, genus_type_id = keys[0]
+            for candidates in [self._by_time,
+                               self._by_agent[agent_id],
+                               self._by_genus[genus_type_id]]:
+                del candidates[bisect.bisect_left(candidates, (timestamp, entry_id))]
+            return
+        # rebuild each affected list once, rather than a delete per entry
+        discarded = set(entry_ids)
+        self._by_time = [key for key in self._by_time if key[1] not in discarded]
+        for agent_id in set(key[2] for key in keys):
+            self._by_agent[agent_id] = [key for key in self._by_agent[agent_id]
+                                        if key[1] not in discarded]
+        for genus_type_id in set(key[3] for key in keys):
+            self._by_genus[genus_type_id] = [key for key in self._by_genus[genus_type_id]
+                                             if key[1] not in discarded]
+
+    def _insert(self, rows):
+        if not rows:
+            return
+        by_agent = {}
+        by_genus = {}
+        keys = []
+        for row in rows:
+            self._rows[row['id']] = (row['timestamp'], row['agentId'], row['genusTypeId'])
+            key = (row['timestamp'], row['id'])
+            keys.append(key)
+            by_agent.setdefault(row['agentId'], []).append(key)
+            by_genus.setdefault(row['genusTypeId'], []).append(key)
+        add_sorted(self._by_time, keys)
+        for agent_id, agent_keys in by_agent.items():
+            add_sorted(self._by_agent.setdefault(agent_id, []), agent_keys)
+        for genus_type_id, genus_keys in by_genus.items():
+            add_sorted(self._by_genus.setdefault(genus_type_id, []), genus_keys)
+
+
+class LogJournal(object):
+    """Append-only journal of log entries waiting to be created in one log.
+    ``extend()`` returns once its entries are fsync'ed to the end of the
+    journal file; ``flush()`` moves the file aside and creates its entries,
+    so new appends are not held up by it. Entries are created at least
+    once: if the process dies part way through a flush, the entries of the
+    groups already created are created again by the next one.
+    """
+    def __init__(self, log_id, path):
+        self.log_id = str(log_id)
+        self.path = path
+        self.flushing_path = path + '.flushing'
+        self.dead_letter_path = path + '.dead'
+        self._lock = threading.Lock()
+        self._sync_lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._buffer = []
+        self._appended = 0
+        self._synced = 0
+        self._pending = count_lines(path)
+        self._pending_since = time.time() if self._pending > 0 else None
+        self._retry_at = None
+
+    def extend(self, username, entries):
+        """Journal entries for ``username``, and wake the flusher if enough
+        entries are pending. Concurrent calls share one write and fsync:
+        the first to get the sync lock writes out every buffered entry."""
+        if not entries:
+            return
+        now = time.time()
+        lines = [json.dumps({'agent': username,
+                             'timestamp': now,
+                             'data': data})
+                 for data in entries]
+        with self._lock:
+            self._buffer.extend(lines)
+            self._appended += len(lines)
+            appended = self._appended
+            if self._pending_since is None:
+                self._pending_since = now
+            self._pending += len(lines)
+        with self._sync_lock:
+            if self._synced < appended:
+                self._sync()
+        if self.is_due():
+            LOG_JOURNAL_FLUSHER_WAKEUP.set()
+
+    def is_due(self):
+        """Whether LOG_JOURNAL_FLUSH_SIZE entries are pending, the oldest
+        has waited LOG_JOURNAL_FLUSH_INTERVAL seconds, or a failed flush left
+        entries behind. A failed flush is retried LOG_JOURNAL_FLUSH_INTERVAL
+        seconds later."""
+        now = time.time()
+        with self._lock:
+            if self._retry_at is not None and now < self._retry_at:
+                return False
+            if os.path.exists(self.flushing_path):
+                return True
+            if self._pending == 0:
+                return False
+            return (self._pending >= LOG_JOURNAL_FLUSH_SIZE or
+                    now - self._pending_since >= LOG_JOURNAL_FLUSH_INTERVAL)
+
+    def pending(self):
+        with self._lock:
+            return self._pending
+
+    def _sync(self):
+        """Write the buffered entries to the end of the journal and fsync it.
+        Call with the sync lock held."""
+        with self._lock:
+            lines = self._buffer
+            appended = self._appended
+            self._buffer = []
+        if not lines:
+            return
+        try:
+            append_journal_lines(self.path, lines)
+        except Exception:
+            # the callers waiting on these lines write them again
+            with self._lock:
+                self._buffer[:0] = lines
+            raise
+        self._synced = appended
+
+    def flush(self):
+        """Create every journaled entry in the logging service and return
+        how many were created"""
+        created = 0
+        with self._flush_lock:
+            try:
+                while True:
+                    with self._sync_lock:
+                        self._sync()
+                        if not os.path.exists(self.flushing_path):
+                            # entries left over from a failed flush go first
+                            if not os.path.exists(self.path):
+                                break
+                            os.rename(self.path, self.flushing_path)
+                            with self._lock:
+                                self._pending = 0
+                                self._pending_since = None
+                    created += self._flush_file(self.flushing_path)
+            except Exception:
+                with self._lock:
+                    self._retry_at = time.time() + LOG_JOURNAL_FLUSH_INTERVAL
+                raise
+            with self._lock:
+                self._retry_at = None
+        return created
+
+    def _flush_file(self, path):
+        with open(path, 'rb') as journal:
+            lines = journal.read().splitlines()
+        created = 0
+        for start in range(0, len(lines), LOG_JOURNAL_FLUSH_SIZE):
+            try:
+                created += create_journaled_log_entries(
+                    self.log_id,
+                    lines[start:start + LOG_JOURNAL_FLUSH_SIZE],
+                    self.dead_letter_path)
+            except Exception:
+                # keep this group and the ones after it for the next flush
+                rewrite_journal(path, lines[start:])
+                raise
+        os.remove(path)
+        return created
+
+
+def add_sorted(candidates, keys):
+    """Add keys to a sorted list. Both are sorted runs, which list.sort()
+    merges in linear time."""
+    keys.sort()
+    if candidates and keys[0] < candidates[-1]:
+        candidates.extend(keys)
+        candidates.sort()
+    else:
+        candidates.extend(keys)
+
+
+def append_journal_lines(path, lines):
+    """Append lines to the end of a journal file and fsync it"""
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    with open(path, 'ab') as journal:
+        journal.write(''.join(line + '\n' for line in lines))
+        journal.flush()
+        os.fsync(journal.fileno())
+
+
+def archive_log_entries(log, before=None):
+    """Move the entries of ``log`` from before ``before`` (a UTC datetime;
+    by default the start of the day LOG_ARCHIVE_HOT_DAYS ago) into a new
+    segment per day. Returns the manifest records of the new segments."""
+    if not log.can_delete_log_entries():
+        raise PermissionDenied()
+    if before is None:
+        today = datetime.datetime.utcnow().date()
+        before = datetime.datetime.combine(today - datetime.timedelta(days=LOG_ARCHIVE_HOT_DAYS),
+                                           datetime.time())
+    cutoff = get_epoch_time(before)
+
+    with LOG_ARCHIVE_LOCK:
+        # only the ids are kept between the scan and the writes
+        entry_ids_by_day = {}
+        for entry in log.get_log_entries():
+            row = get_log_entry_index_row(entry)
+            if row['timestamp'] < cutoff:
+                day = datetime.datetime.utcfromtimestamp(row['timestamp']).strftime('%Y-%m-%d')
+                entry_ids_by_day.setdefault(day, []).append((row['timestamp'], row['id']))
+
+        directory = get_log_file_path(log, LOG_ARCHIVE_DIRECTORY, extension='')
+        manifest = get_log_archive_manifest(log)
+        segments = []
+        for day in sorted(entry_ids_by_day.keys()):
+            rows = sorted(entry_ids_by_day[day])
+            entry_ids = [entry_id for timestamp, entry_id in rows]
+            segment = {
+                'file': get_log_archive_segment_name(directory, day),
+                'day': day,
+                'count': len(rows),
+                'startTime': rows[0][0],
+                'endTime': rows[-1][0]
+            }
+            write_log_archive_segment(os.path.join(directory, segment['file']),
+                                      (entry.object_map for entry in iter_log_entries_by_ids(log, entry_ids)))
+            manifest['segments'].append(segment)
+            save_log_archive_manifest(directory, manifest)
+
+            # a crash before this leaves the day's entries both in the
+            # segment and the datastore, and they are read twice
+            delete_log_entries(log, entry_ids)
+            get_log_entry_index(log).remove(entry_ids)
+            segments.append(segment)
+        return segments
+
+
+def count_lines(path):
+    lines = 0
+    for journal_path in [path, path + '.flushing']:
+        if os.path.exists(journal_path):
+            with open(journal_path, 'rb') as journal:
+                lines += sum(1 for _ in journal)
+    return lines
+
+
+def create_journaled_log_entries(log_id, lines, dead_letter_path):
+    """Create the log entries of a group of journal lines, fetching the log
+    once per agent in the group. Lines that fail with one of
+    LOG_JOURNAL_DEAD_LETTER_ERRORS are appended to ``dead_letter_path``
+    once the group is done; any other error stops the group."""
+    logs = {}
+    created = []
+    dead_letters = []
+    for line in lines:
+        try:
+            # a line torn by a crash does not parse
+            record = json.loads(line)
+            username = record['agent']
+            if username not in logs:
+                logm = get_logging_manager(username=username)
+                logs[username] = logm.get_log(Id(log_id))
+            created.append(create_log_entry(logs[username],
+                                            record['data'],
+                                            timestamp=DateTime.utcfromtimestamp(record['timestamp']),
+                                            index=False))
+        except LOG_JOURNAL_DEAD_LETTER_ERRORS as ex:
+            print traceback.format_exc(1)
+            dead_letters.append(json.dumps({'error': repr(ex), 'line': line}))
+    if dead_letters:
+        append_journal_lines(dead_letter_path, dead_letters)
+    if created:
+        get_log_entry_index(logs.values()[0]).add(created)
+    return len(created)
+
+
+def create_log_entries(log, entries):
+    """Create a batch of log entries in ``log``. Returns, in order,
+    ``{"id": ...}`` for each entry that was created and ``{"error": ...}``
+    for each that was not."""
+    results = validate_log_entries(entries)
+    created = []
+    for index, entry in enumerate(entries):
+        if 'error' in results[index]:
+            continue
+        try:
+            created.append(create_log_entry(log, entry, index=False))
+            results[index]['id'] = str(created[-1].ident)
+        except Exception as ex:
+            results[index]['error'] = str(ex)
+    get_log_entry_index(log).add(created)
+    return results
+
+
+def create_log_entry(log, data, timestamp=None, index=True):
+    """Create a text blob log entry in ``log`` from a log entry payload,
+    i.e. ``{"data": ..., "name": ..., "description": ...}``. A ``timestamp``
+    in the payload wins over the given one. Pass ``index=False`` to add a
+    batch of entries to the log's index at once."""
+    form = log.get_log_entry_form_for_create([TEXT_BLOB_RECORD_TYPE])
+    form.set_text(get_log_entry_text(data['data']))
+    form = utilities.set_form_basics(form, data)
+    if 'timestamp' in data:
+        timestamp = get_log_entry_timestamp(data['timestamp'])
+    if timestamp is not None:
+        form.set_timestamp(timestamp)
+    entry = log.create_log_entry(form)
+    if index:
+        get_log_entry_index(log).add([entry])
+    return entry
+
+
+def decode_log_export_cursor(cursor):
+    """The (timestamp, id) of the last entry a log export sent"""
+    try:
+        timestamp, entry_id = json.loads(base64.urlsafe_b64decode(str(cursor)))
+        return float(timestamp), str(entry_id)
+    except (TypeError, ValueError):
+        raise InvalidArgument('invalid cursor')
+
+
+def delete_log_entries(log, entry_ids):
+    """Delete archived entries from the datastore, through the log's
+    session, so that its authorization and the entries' own clean-up
+    apply. Entries that are already gone are skipped."""
+    for entry_id in entry_ids:
+        try:
+            log.delete_log_entry(Id(entry_id))
+        except NotFound:
+            pass
+
+
+def encode_log_export_cursor(key):
+    return base64.urlsafe_b64encode(json.dumps(list(key)))
+
+
+def get_epoch_time(timestamp):
+    """A UTC datetime as seconds since the epoch"""
+    return calendar.timegm(timestamp.utctimetuple()) + timestamp.microsecond / 1e6
+
+
+def get_log_entry_batch(data):
+    """The ``entries`` list of a batch log entry POST"""
+    entries = utilities.clean_json(data['entries'])
+    if not isinstance(entries, list):
+        raise InvalidArgument('entries must be a list')
+    if len(entries) > MAX_LOG_ENTRY_BATCH_SIZE:
+        raise InvalidArgument('at most {0} entries can be sent at once'.format(MAX_LOG_ENTRY_BATCH_SIZE))
+    return entries
+
+
+def get_log_entry_filters(params):
+    """The index query of a log entry list request, or None if it does not
+    filter the entries"""
+    if not any(params.get(key) for key in LOG_ENTRY_FILTERS):
+        return None
+    filters = {}
+    if params.get('startTime'):
+        filters['start_time'] = get_epoch_time(get_log_entry_timestamp(params['startTime']))
+    if params.get('endTime'):
+        filters['end_time'] = get_epoch_time(get_log_entry_timestamp(params['endTime']))
+    if params.get('agentId'):
+        filters['agent_id'] = str(utilities.clean_id(params['agentId']))
+    if params.get('genusTypeId'):
+        filters['genus_type_id'] = str(utilities.clean_id(params['genusTypeId']))
+    return filters
+
+
+def get_log_entry_index(log):
+    """The process-wide index of the entries of ``log``"""
+    log_id = str(log.ident)
+    with LOG_ENTRY_INDEXES_LOCK:
+        if log_id not in LOG_ENTRY_INDEXES:
+            LOG_ENTRY_INDEXES[log_id] = LogEntryIndex(
+                get_log_file_path(log, LOG_ENTRY_INDEX_DIRECTORY))
+        return LOG_ENTRY_INDEXES[log_id]
+
+
+def get_log_entry_index_row(entry):
+    # dlkit does not implement LogEntry.get_timestamp()
+    return {
+        'id': str(entry.ident),
+        'timestamp': get_epoch_time(entry._my_map['timestamp']),
+        'agentId': str(entry.get_agent_id()),
+        'genusTypeId': str(entry.genus_type)
+    }
+
+
+def get_log_entry_map_key(entry_map):
+    """The (timestamp, id) that entries are ordered by"""
+    return get_epoch_time(DateTime(**entry_map['timestamp'])), entry_map['id']
+
+
+def get_log_entry_text(data):
+    if isinstance(data, dict):
+        return json.dumps(data)
+    if isinstance(data, unicode):
+        return data.encode('utf-8')
+    return str(data)
+
+
+def get_log_entry_timestamp(timestamp):
+    """A client timestamp, i.e. ``{"year": 2016, "month": 8, "day": 1,
+    "hour": 10, "minute": 30, "second": 5}`` or seconds since the epoch,
+    as a DateTime in UTC"""
+    timestamp = utilities.clean_json(timestamp)
+    try:
+        if isinstance(timestamp, (int, long, float)):
+            return DateTime.utcfromtimestamp(timestamp)
+        return DateTime(**timestamp)
+    except (TypeError, ValueError):
+        raise InvalidArgument('timestamp must be seconds since the epoch or an object with '
+                              'year, month, day, and optionally hour, minute, second and microsecond')
+
+
+def get_log_archive_manifest(log):
+    """The manifest of the archived segments of ``log``"""
+    manifest_path = os.path.join(get_log_file_path(log, LOG_ARCHIVE_DIRECTORY, extension=''),
+                                 LOG_ARCHIVE_MANIFEST)
+    if not os.path.exists(manifest_path):
+        return {'segments': []}
+    with open(manifest_path, 'rb') as manifest_file:
+        return json.load(manifest_file)
+
+
+def get_log_archive_segment_paths(log, start_time=None, end_time=None):
+    """The archived segments of ``log`` that may hold entries from
+    ``start_time`` to ``end_time``, oldest first"""
+    directory = get_log_file_path(log, LOG_ARCHIVE_DIRECTORY, extension='')
+    segments = sorted(get_log_archive_manifest(log)['segments'],
+                      key=lambda segment: (segment['startTime'], segment['file']))
+    return [os.path.join(directory, segment['file'])
+            for segment in segments
+            if ((start_time is None or segment['endTime'] >= start_time) and
+                (end_time is None or segment['startTime'] < end_time))]
+
+
+def get_log_archive_segment_name(directory, day):
+    segment_name = '{0}.jsonl.gz'.format(day)
+    counter = 1
+    while os.path.exists(os.path.join(directory, segment_name)):
+        segment_name = '{0}.{1}.jsonl.gz'.format(day, counter)
+        counter += 1
+    return segment_name
+
+
+def get_log_export_record(entry_map, key):
+    """A flat version of an entry map, with its text blob parsed when it is
+    a JSON object or list"""
+    data = entry_map.get('text', {}).get('text', '')
+    try:
+        parsed_data = json.loads(data)
+    except (TypeError, ValueError):
+        pass
+    else:
+        if isinstance(parsed_data, (dict, list)):
+            data = parsed_data
+    timestamp = DateTime(**entry_map['timestamp'])
+    return OrderedDict([
+        ('cursor', encode_log_export_cursor(key)),
+        ('id', entry_map['id']),
+        ('timestamp', timestamp.strftime('%Y-%m-%dT%H:%M:%S.%fZ')),
+        ('agentId', entry_map.get('agentId', '')),
+        ('genusTypeId', entry_map.get('genusTypeId', '')),
+        ('displayName', entry_map.get('displayName', {}).get('text', '')),
+        ('description', entry_map.get('description', {}).get('text', '')),
+        ('data', data)
+    ])
+
+
+def get_log_export_csv_value(value):
+    if isinstance(value, (dict, list)):
+        return json.dumps(value)
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
+
+
+def get_log_file_path(log, directory, extension='.jsonl'):
+    """Where a per-log file in ``directory`` of the JSON datastore is kept"""
+    config = log._catalog._runtime.get_configuration()
+    parameter_id = utilities.clean_id('parameter:dataStorePath@json')
+    data_store_path = config.get_value_by_parameter(parameter_id).get_string_value()
+    return os.path.join(data_store_path,
+                        directory,
+                        '{0}{1}'.format(log.ident.identifier, extension))
+
+
+def get_log_journal(log):
+    """The process-wide journal for ``log``. The first call starts the
+    thread that flushes the journals."""
+    global _log_journal_flusher
+    log_id = str(log.ident)
+    with LOG_JOURNALS_LOCK:
+        if log_id not in LOG_JOURNALS:
+            LOG_JOURNALS[log_id] = LogJournal(log_id,
+                                              get_log_file_path(log, LOG_JOURNAL_DIRECTORY))
+        if _log_journal_flusher is None:
+            _log_journal_flusher = threading.Thread(target=run_log_journal_flusher,
+                                                    name='log-journal-flusher')
+            _log_journal_flusher.daemon = True
+            _log_journal_flusher.start()
+        return LOG_JOURNALS[log_id]
+
+
+def get_logging_manager(username=None):
+    return utilities.get_service_manager('LOGGING', with_locale=False, username=username)
+
+
+def get_or_create_log_by_genus(logm, genus_type, name, description):
+    """The log of ``genus_type``, created if there is none yet"""
+    log_id = LOG_IDS_BY_GENUS.get(genus_type)
+    if log_id is not None:
+        try:
+            return logm.get_log(Id(log_id))
+        except NotFound:
+            LOG_IDS_BY_GENUS.invalidate(genus_type)
+
+    log = None
+    for candidate in logm.get_logs():
+        if str(candidate.genus_type) == genus_type:
+            log = candidate
+            break
+    if log is None:
+        form = logm.get_log_form_for_create([])
+        form.set_genus_type(Type(genus_type))
+        form.display_name = name
+        form.description = description
+
+        log = logm.create_log(form)
+    LOG_IDS_BY_GENUS.set(genus_type, str(log.ident))
+    return log
+
+
+def iter_archived_log_entry_maps(log, start_time=None, end_time=None, agent_id=None, genus_type_id=None):
+    """The maps of the archived entries of ``log``, day by day, optionally
+    filtered like LogEntryIndex.query(). Segments outside the time range are
+    not opened."""
+    for segment_path in get_log_archive_segment_paths(log, start_time, end_time):
+        for entry_map in iter_log_archive_segment(segment_path, start_time, end_time,
+                                                  agent_id, genus_type_id):
+            yield entry_map
+
+
+def iter_log_archive_segment(segment_path, start_time=None, end_time=None, agent_id=None,
+                             genus_type_id=None):
+    """The entry maps in one archived segment, in (timestamp, id) order"""
+    segment_file = gzip.open(segment_path, 'rb')
+    try:
+        for line in segment_file:
+            entry_map = json.loads(line)
+            if agent_id is not None and entry_map['agentId'] != agent_id:
+                continue
+            if genus_type_id is not None and entry_map['genusTypeId'] != genus_type_id:
+                continue
+            if start_time is not None or end_time is not None:
+                timestamp = get_log_entry_map_key(entry_map)[0]
+                if start_time is not None and timestamp < start_time:
+                    continue
+                if end_time is not None and timestamp >= end_time:
+                    continue
+            yield entry_map
+    finally:
+        segment_file.close()
+
+
+def iter_log_entry_maps_by_key(log, filters=None, after=None):
+    """(key, map) pairs of the entries of ``log``, archived or not, merged
+    into one (timestamp, id) order (see get_log_entry_map_key()), starting
+    after the ``after`` key. Only one entry per segment is held at a time.
+    The archive manifest and the index are read right away, so that their
+    errors are raised here rather than once a response is under way."""
+    filters = filters or {}
+    start_time = filters.get('start_time')
+    if after is not None and (start_time is None or after[0] > start_time):
+        start_time = after[0]
+
+    streams = []
+    for segment_path in get_log_archive_segment_paths(log, start_time, filters.get('end_time')):
+        streams.append((get_log_entry_map_key(entry_map), entry_map)
+                       for entry_map in iter_log_archive_segment(segment_path, **filters))
+
+    keys = get_log_entry_index(log).query_keys(log, **filters)
+    if after is not None:
+        keys = keys[bisect.bisect_right(keys, after):]
+    entries = iter_log_entries_by_ids(log, [entry_id for timestamp, entry_id in keys])
+    streams.append((get_log_entry_map_key(entry_map), entry_map)
+                   for entry_map in utilities.iter_object_maps(entries))
+    return _iter_merged_log_entry_maps(streams, after)
+
+
+def _iter_merged_log_entry_maps(streams, after):
+    for key, entry_map in heapq.merge(*streams):
+        if after is None or key > after:
+            yield key, entry_map
+
+
+def iter_log_entry_maps(log, filters=None, fields=None):
+    """The maps of all entries of ``log``, archived ones first, then the
+    ones still in the datastore. With ``filters`` (see
+    get_log_entry_filters()), the datastore ones come from the log's index."""
+    if filters is None:
+        filters = {}
+        hot_entries = log.get_log_entries()
+    else:
+        hot_entries = iter_log_entries_by_ids(log, get_log_entry_index(log).query(log, **filters))
+    return itertools.chain(
+        (utilities.project_fields(entry_map, fields)
+         for entry_map in iter_archived_log_entry_maps(log, **filters)),
+        utilities.iter_object_maps(hot_entries, fields=fields))
+
+
+def iter_log_export_chunks(keyed_entry_maps, export_format, data_fields=None):
+    """Serialize (key, map) pairs as NDJSON or CSV, a chunk at a time. CSV
+    has a ``data.<field>`` column for each of ``data_fields``."""
+    data_fields = data_fields or []
+    if export_format == 'csv':
+        csv_buffer = StringIO()
+        csv_writer = csv.writer(csv_buffer)
+        csv_writer.writerow(LOG_EXPORT_COLUMNS + ['data.{0}'.format(field) for field in data_fields])
+
+    lines = []
+    size = 0
+    if export_format == 'csv':
+        lines.append(csv_buffer.getvalue())
+    for key, entry_map in keyed_entry_maps:
+        record = get_log_export_record(entry_map, key)
+        if export_format == 'csv':
+            data = record['data']
+            row = record.values()
+            for field in data_fields:
+                row.append(data.get(field, '') if isinstance(data, dict) else '')
+            csv_buffer.seek(0)
+            csv_buffer.truncate()
+            csv_writer.writerow([get_log_export_csv_value(value) for value in row])
+            line = csv_buffer.getvalue()
+        else:
+            line = json.dumps(record) + '\n'
+        lines.append(line)
+        size += len(line)
+        if size >= LOG_EXPORT_CHUNK_SIZE:
+            yield ''.join(lines)
+            lines = []
+            size = 0
+    if lines:
+        yield ''.join(lines)
+
+
+def iter_log_entries_by_ids(log, entry_ids):
+    """Look up the entries of ``log`` with the given ids, in order, a few at
+    a time as they are iterated over. Ids that are gone are skipped."""
+    for start in range(0, len(entry_ids), LOG_ENTRY_FETCH_SIZE):
+        chunk = [Id(entry_id) for entry_id in entry_ids[start:start + LOG_ENTRY_FETCH_SIZE]]
+        for entry in log.get_log_entries_by_ids(chunk):
+            yield entry
+
+
+def rewrite_journal(path, lines):
+    """Replace a journal's lines, through a temp file that is renamed into
+    place, so a crash leaves either the old or the new lines"""
+    file_descriptor, temp_path = tempfile.mkstemp(prefix='.journal-',
+                                                  dir=os.path.dirname(path))
+    with os.fdopen(file_descriptor, 'wb') as temp_file:
+        temp_file.write(''.join(line + '\n' for line in lines))
+        temp_file.flush()
+        os.fsync(temp_file.fileno())
+    os.rename(temp_path, path)
+
+
+def run_log_journal_flusher():
+    """Flush the journals that are due, for the life of the process"""
+    # dlkit form helpers read request headers from web.ctx, which is
+    # per thread
+    web.ctx.env = {}
+    while True:
+        LOG_JOURNAL_FLUSHER_WAKEUP.wait(LOG_JOURNAL_FLUSHER_POLL_INTERVAL)
+        LOG_JOURNAL_FLUSHER_WAKEUP.clear()
+        with LOG_JOURNALS_LOCK:
+            journals = LOG_JOURNALS.values()
+        for journal in journals:
+            if not journal.is_due():
+                continue
+            try:
+                journal.flush()
+            except Exception:
+                # the entries stay in the journal for the next flush
+                print traceback.format_exc(10)
+
+
+def save_log_archive_manifest(directory, manifest):
+    """Replace the manifest through a temp file that is renamed into place"""
+    file_descriptor, temp_path = tempfile.mkstemp(prefix='.manifest-', dir=directory)
+    with os.fdopen(file_descriptor, 'wb') as temp_file:
+        json.dump(manifest, temp_file, indent=2, sort_keys=True)
+        temp_file.flush()
+        os.fsync(temp_file.fileno())
+    os.rename(temp_path, os.path.join(directory, LOG_ARCHIVE_MANIFEST))
+
+
+def validate_log_entries(entries):
+    """Check a batch of log entry payloads in one pass, before any is
+    created. Returns, in order, ``{}`` for each valid entry and
+    ``{"error": ...}`` for each invalid one."""
+    results = []
+    for entry in entries:
+        result = {}
+        try:
+            if not isinstance(entry, dict):
+                raise InvalidArgument('each entry must be an object')
+            utilities.verify_keys_present(entry, ['data'])
+            get_log_entry_text(entry['data'])
+            for key in LOG_ENTRY_TEXT_KEYS:
+                if key in entry and not isinstance(entry[key], (basestring, dict)):
+                    raise InvalidArgument('{0} must be a string'.format(key))
+            if 'timestamp' in entry:
+                get_log_entry_timestamp(entry['timestamp'])
+        except (InvalidArgument, KeyError) as ex:
+            result['error'] = ex.args[0]
+        results.append(result)
+    return results
+
+
+def write_log_archive_segment(path, entry_maps):
+    """Write a gzip'ed JSON lines segment, through a temp file that is
+    renamed into place once it is fsync'ed"""
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    file_descriptor, temp_path = tempfile.mkstemp(prefix='.segment-', dir=directory)
+    with os.fdopen(file_descriptor, 'wb') as temp_file:
+        segment_file = gzip.GzipFile(filename='', mode='wb', fileobj=temp_file)
+        for entry_map in entry_maps:
+            segment_file.write(json.dumps(entry_map) + '\n')
+        segment_file.close()
+        temp_file.flush()
+        os.fsync(temp_file.fileno())
+    os.rename(temp_path, path)
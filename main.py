@@ -36,6 +36,7 @@ urls = (
     '/test', 'video_test',
     '/datastore_path', 'bootloader_storage_path',
     '/version', 'version',
+    '/cache_stats', 'cache_stats',
     '/(.*)', 'index'
 )
 app = web.application(urls, locals())
@@ -46,6 +47,12 @@ class bootloader_storage_path:
         return ABS_PATH
 
 
+class cache_stats:
+    @utilities.format_response
+    def GET(self):
+        return {name: cache.stats() for name, cache in utilities.CACHES.iteritems()}
+
+
 class index:
     def GET(self, path=None):
         return 'Trying to GET: {0}'.format(path)
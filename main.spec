@@ -18,6 +18,7 @@ a = Analysis(['main.py'],
              hiddenimports=['_cffi_backend',
                             'six',
                             'sympy',
+                            'numpy',
                             'bs4',
                             'lxml',
                             'dlkit',
@@ -1,10 +1,12 @@
+import functools
 import mimetypes
 import os
+import uuid
 import web
 import json
 
 from dlkit.runtime.errors import *
-from dlkit.runtime.primitives import DataInputStream, DateTime
+from dlkit.runtime.primitives import DateTime
 
 from urllib import quote
 
@@ -53,7 +55,8 @@ class RepositoriesList(utilities.BaseClass):
                 repositories = rm.get_repositories_by_query(querier)
             else:
                 repositories = rm.repositories
-            repositories = utilities.extract_items(repositories)
+            repositories = utilities.extract_items(repositories,
+                                                   fields=utilities.get_requested_fields(inputs))
             return repositories
         except Exception as ex:
             utilities.handle_exceptions(ex)
@@ -104,7 +107,8 @@ class RepositoryDetails(utilities.BaseClass):
         try:
             rm = rutils.get_repository_manager()
             repository = rm.get_repository(utilities.clean_id(repository_id))
-            repository = utilities.convert_dl_object(repository)
+            repository = utilities.convert_dl_object(repository,
+                                                     fields=utilities.get_requested_fields(self.data()))
             return repository
         except Exception as ex:
             utilities.handle_exceptions(ex)
@@ -161,23 +165,23 @@ class AssetsList(utilities.BaseClass):
             else:
                 repository = rm.get_repository(utilities.clean_id(repository_id))
                 assets = repository.get_assets()
-            data = utilities.extract_items(assets)
 
-            # Update the source field with the displayName.text of the actual resource
-            data = json.loads(data)
-            for asset_map in data:
-                resource_utils.update_asset_map_with_resource(asset_map)
-            data = json.dumps(data)
+            assets = utilities.paginate(assets, params)
+            fields = utilities.get_requested_fields(params)
 
-            if 'fullUrls' in params:
-                data = json.loads(data)
-                updated_data = []
-                for asset in data:
-                    updated_data.append(rutils.update_asset_map_with_content_url(rm, asset))
+            object_maps = utilities.iter_object_maps(assets)
+            if (utilities.field_requested(fields, 'source') or
+                    utilities.field_requested(fields, 'provider')):
+                # Update the source field with the displayName.text of the actual resource
+                object_maps = resource_utils.update_asset_maps_with_resources(object_maps)
 
-                data = json.dumps(updated_data)
+            def get_asset_map(asset_map):
+                if 'fullUrls' in params and utilities.field_requested(fields, 'assetContents'):
+                    asset_map = rutils.update_asset_map_with_content_url(rm, asset_map)
 
-            return data
+                return utilities.project_fields(asset_map, fields)
+
+            return utilities.stream_json_list(object_maps, convert=get_asset_map)
         except Exception as ex:
             utilities.handle_exceptions(ex)
 
@@ -347,70 +351,84 @@ class AssetContentStream(utilities.BaseClass):
                 web.header('Content-Type', 'text/plain')
                 yield asset_content.get_vtt_text()
             else:
-                asset_content_data = asset_content.get_data()
+                # serve filesystem-backed contents straight from their file;
+                # anything else goes through the dlkit data stream
+                asset_content_data = None
+                etag = None
+                last_modified = None
+                asset_content_path = rutils.get_asset_content_file_path(asset_content)
+                if asset_content_path is not None:
+                    file_stat = os.stat(asset_content_path)
+                    content_length = file_stat.st_size
+                    # validators are only sent for files, where they cost a stat()
+                    etag = rutils.get_file_etag(file_stat)
+                    last_modified = file_stat.st_mtime
+                else:
+                    asset_content_data = asset_content.get_data()
+                    asset_content_path = asset_content_data.name
+                    content_length = rutils.get_data_length(asset_content_data)
 
-                filespace_path = ''
-                try:
-                    config = asset._runtime.get_configuration()
-                    parameter_id = utilities.clean_id('parameter:dataStoreFullPath@mongo')
-                    filespace_path = config.get_value_by_parameter(parameter_id).get_string_value()
-                except (AttributeError, KeyError):
-                    pass
-
-                # the asset_url is relative, so add in the path
-                asset_content_path = '{0}/{1}'.format(filespace_path,
-                                                      asset_content_data.name)
-                web.header('Content-Type', mimetypes.guess_type(asset_content_path)[0])
                 web.header('Accept-Ranges', 'bytes')
+                if etag is not None:
+                    utilities.set_cache_validators(etag, last_modified, rutils.STREAM_CACHE_CONTROL)
+                    if utilities.is_not_modified(etag, last_modified):
+                        web.ctx.status = '304 Not Modified'
+                        yield ''
+                        return
+                content_type = mimetypes.guess_type(asset_content_path)[0]
+                if asset_content_data is None:
+                    read_range = functools.partial(rutils.stream_file, asset_content_path)
+                else:
+                    read_range = functools.partial(rutils.stream_data, asset_content_data)
+
                 # The algorithm below for streaming partial content was based off of this
                 # post:
                 # https://benramsey.com/blog/2008/05/206-partial-content-and-range-requests/
-                continue_with_stream = True
-                byte_range = rutils.get_byte_ranges()
-                total_bytes_to_read = os.path.getsize(asset_content_data.name)
-                content_length = os.path.getsize(asset_content_data.name)
-                bytes_to_throw_away = 0
-                if byte_range is not None:
-                    bytes_to_throw_away = int(byte_range[0])
-                    if bytes_to_throw_away > total_bytes_to_read or bytes_to_throw_away < 0:
-                        web.ctx.status = '416 Requested Range Not Satisfiable'
-                        continue_with_stream = False
-                        asset_content_data.close()
-                        yield ''
-                    else:
-                        asset_content_data.read(bytes_to_throw_away)
-                        total_bytes_to_read = os.path.getsize(asset_content_data.name) - bytes_to_throw_away
-                        if byte_range[1] != '':
-                            total_bytes_to_read = int(byte_range[1]) - bytes_to_throw_away
-
-                if continue_with_stream:
-                    bytes_read = 0
-                    num_bytes_to_read = 1024 * 8
-                    starting_bytes = bytes_to_throw_away
+                # Ranges are seeked to, so their offset does not matter.
+                byte_ranges = None
+                if utilities.if_range_matches(etag, last_modified):
+                    byte_ranges = rutils.get_byte_ranges(content_length)
+
+                if byte_ranges is None:
+                    web.header('Content-Type', content_type)
+                    web.header('Content-Length', str(content_length))
+                    chunks = read_range(0, content_length)
+                elif not byte_ranges:
+                    web.ctx.status = '416 Requested Range Not Satisfiable'
+                    web.header('Content-Type', content_type)
+                    web.header('Content-Range', 'bytes */{0}'.format(content_length))
+                    chunks = ['']
+                elif len(byte_ranges) == 1:
+                    start, end = byte_ranges[0]
+                    web.ctx.status = '206 Partial Content'
+                    web.header('Content-Type', content_type)
+                    # The ending value {1} has to be the last byte sent, not one past
+                    # it. That broke video streaming in Chrome, not in FF.
+                    web.header('Content-Range', 'bytes {0}-{1}/{2}'.format(start,
+                                                                           end - 1,
+                                                                           content_length))
+                    web.header('Content-Length', str(end - start))
+                    chunks = read_range(start, end)
+                else:
+                    boundary = uuid.uuid4().hex
                     web.ctx.status = '206 Partial Content'
+                    web.header('Content-Type', 'multipart/byteranges; boundary={0}'.format(boundary))
+                    web.header('Content-Length', str(rutils.get_byte_ranges_length(byte_ranges,
+                                                                                   content_length,
+                                                                                   content_type,
+                                                                                   boundary)))
+                    chunks = rutils.stream_byte_ranges(read_range,
+                                                       byte_ranges,
+                                                       content_length,
+                                                       content_type,
+                                                       boundary)
 
-                    while continue_with_stream:
-                        remaining_bytes = total_bytes_to_read - bytes_read
-                        bytes_to_read = min(num_bytes_to_read, remaining_bytes)
-                        buf = asset_content_data.read(bytes_to_read)
-                        if not buf:
-                            asset_content_data.close()
-                            break
-
-                        bytes_actually_read = len(buf)
-
-                        # web.header('Content-Length', total_bytes_to_read)
-                        # Introduce a -1 here because otherwise the bytes_read indicator is off
-                        #   by one to the browser. The ending value {1} has to be the last byte
-                        #   actually read. That broke video streaming in Chrome, not in FF.
-                        range_header_str = 'bytes {0}-{1}/{2}'.format(str(starting_bytes),
-                                                                      str(starting_bytes + bytes_actually_read - 1),
-                                                                      str(content_length))
-                        web.header('Content-Range', range_header_str)
-
-                        bytes_read += bytes_actually_read
-                        starting_bytes += bytes_actually_read
-                        yield buf
+                try:
+                    for chunk in chunks:
+                        yield chunk
+                finally:
+                    if asset_content_data is not None:
+                        asset_content_data.close()
         except Exception as ex:
             utilities.handle_exceptions(ex)
 
@@ -425,7 +443,8 @@ class AssetContentsList(utilities.BaseClass):
             data = utilities.extract_items(asset.get_asset_contents())
 
             if 'fullUrls' in self.data():
-                data = json.dumps(rutils.update_asset_map_with_content_url(rm, asset.object_map)['assetContents'])
+                asset_map = {'assetContents': json.loads(data)}
+                data = json.dumps(rutils.update_asset_map_with_content_url(rm, asset_map)['assetContents'])
 
             return data
         except Exception as ex:
@@ -496,12 +515,8 @@ class AssetContentDetails(utilities.BaseClass):
                     data = asset_content.object_map
                     break
 
-            if 'fullUrl' in self.data():
-                contents = rutils.update_asset_map_with_content_url(rm, asset.object_map)['assetContents']
-                for content in contents:
-                    if content['id'] == str(utilities.clean_id(content_id)):
-                        data = content
-                        break
+            if 'fullUrl' in self.data() and data:
+                data = rutils.update_asset_map_with_content_url(rm, data)
 
             return json.dumps(data)
         except Exception as ex:
@@ -536,9 +551,6 @@ class AssetContentDetails(utilities.BaseClass):
             else:
                 file_name = x['inputFile'].filename
 
-                data = DataInputStream(input_file)
-                data.name = file_name
-
                 # default, but can be over-ridden by user params
                 form.set_genus_type(rutils.get_asset_content_genus_type(file_name))
 
@@ -547,7 +559,7 @@ class AssetContentDetails(utilities.BaseClass):
                 except AttributeError:
                     form.display_name = file_name
 
-                form.set_data(data)
+                form = rutils.set_asset_content_form_data(form, file_name, input_file)
 
             params = self.data()
             form = utilities.set_form_basics(form, params)
@@ -1,6 +1,13 @@
+import hashlib
+import json
 import os
+import shutil
+import tempfile
+import threading
 import web
 
+from bson import ObjectId
+
 from dlkit.abstract_osid.repository.objects import Repository
 from dlkit.primordium.calendaring.primitives import DateTime
 from dlkit.primordium.id.primitives import Id
@@ -8,10 +15,7 @@ from dlkit.primordium.transport.objects import DataInputStream
 from dlkit.primordium.type.primitives import Type
 from dlkit.json_ import types
 
-from dlkit.runtime import PROXY_SESSION, RUNTIME
 from dlkit.runtime.errors import NotFound
-from dlkit.runtime.primitives import InitializableLocale
-from dlkit.runtime.proxy_example import SimpleRequest
 
 from dlkit.records import registry
 
@@ -21,6 +25,7 @@ DEFAULT_LANGUAGE_TYPE = Type(**types.Language().get_type_data('DEFAULT'))
 DEFAULT_SCRIPT_TYPE = Type(**types.Script().get_type_data('DEFAULT'))
 DEFAULT_FORMAT_TYPE = Type(**types.Format().get_type_data('DEFAULT'))
 
+AUDIO_ASSET_GENUS_TYPE = Type(**registry.ASSET_GENUS_TYPES['audio'])
 IMAGE_ASSET_GENUS_TYPE = Type(**registry.ASSET_GENUS_TYPES['image'])
 JPG_ASSET_CONTENT_GENUS_TYPE = Type(**registry.ASSET_CONTENT_GENUS_TYPES['jpg'])
 GENERIC_ASSET_CONTENT_GENUS_TYPE = Type(**registry.ASSET_CONTENT_GENUS_TYPES['generic'])
@@ -38,6 +43,41 @@ TRANSCRIPT_ASSET_CONTENT_GENUS_TYPE = Type(**registry.ASSET_CONTENT_GENUS_TYPES[
 TRANSCRIPT_ASSET_CONTENT_RECORD_TYPE = Type(**registry.ASSET_CONTENT_RECORD_TYPES['multi-language-transcript-files'])
 MULTI_LANGUAGE_ASSET_CONTENT = Type(**registry.ASSET_CONTENT_RECORD_TYPES['multi-language'])
 
+CONTENT_HASH_CHUNK_SIZE = 64 * 1024
+
+# bytes per chunk when streaming asset content. Large chunks keep the
+# per-chunk overhead down when many clients stream video at once.
+STREAM_CHUNK_SIZE = 1024 * 1024
+
+# bytes per chunk when copying an upload into the datastore
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+# more ranges than this in one request are ignored, and the whole file sent
+MAX_BYTE_RANGES = 16
+
+# streamed files may be kept by browsers and shared (offline) proxies, but
+# are revalidated on every use, since contents can be replaced in place
+STREAM_CACHE_CONTROL = 'public, no-cache'
+
+# repository id -> SHA-256 of the bytes -> [path, size, modification time]
+# of the datastore file that holds them, for the asset contents passed to
+# share_asset_content_file. Each repository's index is kept in a JSON file
+# in the datastore, and loaded from it the first time the repository is
+# used. A stored file is only re-hashed before it is shared if its size or
+# modification time changed, and stale entries are dropped. Lookups,
+# updates and saves of the index all hold CONTENT_HASH_INDEX_LOCK.
+CONTENT_HASH_INDEX = utilities.LRUCache(1024)
+utilities.CACHES['assetContentHashes'] = CONTENT_HASH_INDEX
+CONTENT_HASH_INDEX_DIRECTORY = 'assetContentHashIndex'
+CONTENT_HASH_INDEX_LOCK = threading.Lock()
+
+# repository id -> template for the URLs of its asset contents, filled in
+# with the repository, asset and asset content ids; '' for stores whose
+# URLs do not follow the stream endpoint, which are looked up one by one
+CONTENT_URL_PATH = '/repository/repositories/{0}/assets/{1}/contents/{2}/stream'
+CONTENT_URL_TEMPLATES = utilities.LRUCache(1024)
+utilities.CACHES['assetContentUrlTemplates'] = CONTENT_URL_TEMPLATES
+
 
 def append_file_as_asset_content(repo, asset_id, file_name, file_data, basics=None):
     asset_content_type_list = get_asset_content_records(repo)
@@ -51,10 +91,7 @@ def append_file_as_asset_content(repo, asset_id, file_name, file_data, basics=No
     except AttributeError:
         acfc.display_name = file_name
 
-    data = DataInputStream(file_data)
-    data.name = file_name
-
-    acfc.set_data(data)
+    acfc = set_asset_content_form_data(acfc, file_name, file_data)
 
     if basics is not None:
         acfc = utilities.set_form_basics(acfc, basics)
@@ -65,10 +102,11 @@ def append_file_as_asset_content(repo, asset_id, file_name, file_data, basics=No
     # the ID above will be off by one-ish -- we need it to match the
     # AssetContent ID, so re-set it.
     # have to set it above so that the filesystem adapter kicks in on update
-    data.seek(0)
-    acfu = repo.get_asset_content_form_for_update(ac.ident)
-    acfu.set_data(data)
-    repo.update_asset_content(acfu)
+    # Newer filesystem adapters rename the file themselves.
+    if ac.ident.identifier not in ac._my_map.get('url', ''):
+        acfu = repo.get_asset_content_form_for_update(ac.ident)
+        acfu = set_asset_content_form_data(acfu, file_name, file_data)
+        repo.update_asset_content(acfu)
     return repo.get_asset(asset_id), ac
 
 
@@ -316,46 +354,198 @@ def get_asset_content_genus_type(file_name):
     return ac_genus_type
 
 
-def get_byte_ranges():
-    if 'HTTP_RANGE' in web.ctx.env:
-        return web.ctx.env['HTTP_RANGE'].split('=')[-1].split('-')
+def get_asset_content_file_path(asset_content):
+    """The path of the file that holds a filesystem-backed asset
+    content's data, or None for other stores. Lets the file be streamed
+    directly, because get_data() first reads it all to sniff the encoding"""
+    try:
+        file_path = asset_content._my_map['url']
+    except (AttributeError, KeyError, TypeError):
+        return None
+    if file_path and os.path.isfile(file_path):
+        return file_path
     return None
 
 
+def get_byte_ranges(content_length):
+    """Parse the request's ``Range`` header (RFC 7233) into sorted, merged
+    ``(start, end)`` pairs, ``end`` exclusive. Handles ``bytes=500-999``,
+    open ended ``bytes=500-``, suffix ``bytes=-500`` and comma-separated sets.
+    ``None`` means there is no usable header, so send the whole file; an
+    empty list means none of the ranges can be satisfied, i.e. a 416"""
+    range_header = web.ctx.env.get('HTTP_RANGE')
+    if range_header is None:
+        return None
+    units, _, range_set = range_header.partition('=')
+    specs = range_set.split(',')
+    if units.strip().lower() != 'bytes' or len(specs) > MAX_BYTE_RANGES:
+        return None
+
+    ranges = []
+    for spec in specs:
+        first, dash, last = spec.strip().partition('-')
+        try:
+            if not dash:
+                return None
+            elif first == '':
+                # the last <last> bytes
+                suffix_length = int(last)
+                if suffix_length < 0:
+                    return None
+                start = max(content_length - suffix_length, 0)
+                end = content_length if suffix_length > 0 else start
+            else:
+                start = int(first)
+                end = content_length
+                if last.strip() != '':
+                    if int(last) < start:
+                        return None
+                    end = min(int(last) + 1, content_length)
+        except ValueError:
+            # syntactically invalid headers are ignored
+            return None
+        if start < end:
+            ranges.append((start, end))
+
+    merged_ranges = []
+    for start, end in sorted(ranges):
+        if merged_ranges and start <= merged_ranges[-1][1]:
+            merged_ranges[-1] = (merged_ranges[-1][0], max(end, merged_ranges[-1][1]))
+        else:
+            merged_ranges.append((start, end))
+    return merged_ranges
+
+
+def get_byte_range_part_header(start, end, content_length, content_type, boundary):
+    """The boundary and headers before one part of a multipart/byteranges body"""
+    return '--{0}\r\nContent-Type: {1}\r\nContent-Range: bytes {2}-{3}/{4}\r\n\r\n'.format(
+        boundary,
+        content_type or 'application/octet-stream',
+        start,
+        end - 1,
+        content_length)
+
+
+def get_byte_ranges_length(ranges, content_length, content_type, boundary):
+    """The exact length of the multipart/byteranges body that
+    ``stream_byte_ranges`` yields, for its ``Content-Length``"""
+    length = len('--{0}--\r\n'.format(boundary))
+    for start, end in ranges:
+        length += len(get_byte_range_part_header(start, end, content_length, content_type, boundary))
+        length += end - start + len('\r\n')
+    return length
+
+
+def get_data_length(data):
+    try:
+        return os.fstat(data.fileno()).st_size
+    except (AttributeError, IOError, OSError, ValueError):
+        data.seek(0, os.SEEK_END)
+        length = data.tell()
+        data.seek(0)
+        return length
+
+
+def get_file_etag(file_stat):
+    """A strong ETag for a file, from its inode, modification time and size"""
+    return '"{0:x}-{1:x}-{2:x}"'.format(file_stat.st_ino,
+                                        int(file_stat.st_mtime * 1000000),
+                                        file_stat.st_size)
+
+
+def get_filesystem_data_paths(form, file_name):
+    """The paths that the filesystem adapter's set_data() would write the
+    data of an asset content form to: the file in the datastore, then its
+    backup copy if the adapter keeps one. None if the form is not
+    filesystem-backed"""
+    config_map = vars(form).get('_config_map', {})
+    if 'data_store_path' not in config_map:
+        return None
+    # the adapter names files after the asset content, or a new ObjectId
+    # for forms that create one, and renames them to the id once created
+    file_id = form._my_map.get('_id') or ObjectId()
+    data_file_name = '{0}.{1}'.format(str(file_id), file_name.split('.')[-1])
+    data_paths = ['{0}/repository/AssetContent/{1}'.format(config_map['data_store_path'],
+                                                            data_file_name)]
+    if 'secondary_data_store_path' in config_map:
+        data_paths.append('{0}/{1}'.format(config_map['secondary_data_store_path'],
+                                           data_file_name))
+    return data_paths
+
+
 def get_file_extension(file_name):
     return os.path.splitext(os.path.basename(file_name))[-1].replace('.', '')
 
 
-def get_repository_manager():
-    condition = PROXY_SESSION.get_proxy_condition()
-    dummy_request = SimpleRequest(username=web.ctx.env.get('HTTP_X_API_PROXY', 'student@tiss.edu'),
-                                  authenticated=True)
-    condition.set_http_request(dummy_request)
-
-    if 'HTTP_X_API_LOCALE' in web.ctx.env:
-        language_code = web.ctx.env['HTTP_X_API_LOCALE'].lower()
-        if language_code in ['en', 'hi', 'te']:
-            if language_code == 'en':
-                language_code = 'ENG'
-                script_code = 'LATN'
-            elif language_code == 'hi':
-                language_code = 'HIN'
-                script_code = 'DEVA'
-            else:
-                language_code = 'TEL'
-                script_code = 'TELU'
-        else:
-            language_code = DEFAULT_LANGUAGE_TYPE.identifier
-            script_code = DEFAULT_SCRIPT_TYPE.identifier
+def get_content_hash(file_data):
+    """SHA-256 hex digest of a file-like object, read in chunks so large
+    media files are never held in memory. Leaves file_data at the start"""
+    content_hash = hashlib.sha256()
+    file_data.seek(0)
+    for chunk in iter(lambda: file_data.read(CONTENT_HASH_CHUNK_SIZE), ''):
+        content_hash.update(chunk)
+    file_data.seek(0)
+    return content_hash.hexdigest()
 
-        locale = InitializableLocale(language_type_identifier=language_code,
-                                     script_type_identifier=script_code)
 
-        condition.set_locale(locale)
+def get_content_hash_index(repo):
+    """The content hash index of a repository, loaded from the datastore
+    the first time the repository is used"""
+    hash_index = CONTENT_HASH_INDEX.get(str(repo.ident))
+    if hash_index is None:
+        hash_index = load_content_hash_index(repo)
+        CONTENT_HASH_INDEX.set(str(repo.ident), hash_index)
+    return hash_index
 
-    proxy = PROXY_SESSION.get_proxy(condition)
-    return RUNTIME.get_service_manager('REPOSITORY',
-                                       proxy=proxy)
+
+def get_content_hash_index_path(repo):
+    """Where the content hash index of a repository is kept, in the JSON
+    datastore, or None if the datastore path is not configured"""
+    try:
+        config = repo._catalog._runtime.get_configuration()
+        parameter_id = Id('parameter:dataStorePath@json')
+        data_store_path = config.get_value_by_parameter(parameter_id).get_string_value()
+    except (AttributeError, KeyError, NotFound):
+        return None
+    return os.path.join(data_store_path,
+                        CONTENT_HASH_INDEX_DIRECTORY,
+                        '{0}.json'.format(repo.ident.identifier))
+
+
+def get_content_url(asset_content_map):
+    """The full URL of an asset content, from its repository's URL
+    template, or None if there is no template for it"""
+    try:
+        repository_id = asset_content_map['assignedRepositoryIds'][0]
+        template = CONTENT_URL_TEMPLATES.get(repository_id)
+        if template:
+            return template.format(repository_id,
+                                   asset_content_map['assetId'],
+                                   asset_content_map['id'])
+    except (KeyError, IndexError):
+        pass
+    return None
+
+
+def get_indexed_file_path(entry, content_hash):
+    """The stored file of a content hash index entry, or None if it is gone
+    or no longer holds the indexed bytes. The file is only re-hashed, in
+    chunks, when its size or modification time is not the indexed one."""
+    file_path = entry[0]
+    try:
+        file_stat = os.stat(file_path)
+    except (OSError, TypeError):
+        return None
+    if entry[1:] == [file_stat.st_size, file_stat.st_mtime]:
+        return file_path
+    with open(file_path, 'rb') as stored_file:
+        if get_content_hash(stored_file) != content_hash:
+            return None
+    return file_path
+
+
+def get_repository_manager():
+    return utilities.get_service_manager('REPOSITORY')
 
 
 def get_singular_filename(file_name):
@@ -367,6 +557,35 @@ def get_singular_filename(file_name):
         return file_name.split('.')[0]
 
 
+def load_content_hash_index(repo):
+    """The content hash index of a repository, as saved in the datastore"""
+    hash_index = {
+        'path': get_content_hash_index_path(repo),
+        'contents': {}
+    }
+    if hash_index['path'] is not None and os.path.isfile(hash_index['path']):
+        try:
+            with open(hash_index['path'], 'rb') as index_file:
+                hash_index['contents'] = json.load(index_file)
+        except (IOError, ValueError):
+            # rebuilt as files are stored
+            pass
+    return hash_index
+
+
+def link_file(source_path, file_path):
+    """Replace file_path with a hard link to source_path, through a link in
+    the same directory that is renamed over it"""
+    temp_path = os.path.join(os.path.dirname(file_path),
+                             '.link-{0}'.format(os.path.basename(file_path)))
+    os.link(source_path, temp_path)
+    try:
+        os.rename(temp_path, file_path)
+    except OSError:
+        os.remove(temp_path)
+        raise
+
+
 def match_asset_content_by_name(asset_content_list, name):
     for asset_content in asset_content_list:
         if asset_content.display_name.text == name:
@@ -438,13 +657,68 @@ def replace_asset_main_content(repo, asset_id, file_name, file_data):
                 continue
 
             form = repo.get_asset_content_form_for_update(asset_content.ident)
-            data = DataInputStream(file_data)
-            data.name = file_name
-            form.set_data(data)
+            form = set_asset_content_form_data(form, file_name, file_data)
             repo.update_asset_content(form)
             break
 
 
+def save_content_hash_index(hash_index):
+    """Write a content hash index to the datastore, through a temp file that
+    is renamed into place, so readers never see a partial index"""
+    if hash_index['path'] is None:
+        return
+    index_directory = os.path.dirname(hash_index['path'])
+    if not os.path.isdir(index_directory):
+        os.makedirs(index_directory)
+    file_descriptor, temp_path = tempfile.mkstemp(prefix='.index-', dir=index_directory)
+    with os.fdopen(file_descriptor, 'wb') as temp_file:
+        json.dump(dict(hash_index['contents']), temp_file)
+    os.rename(temp_path, hash_index['path'])
+
+
+def save_file(file_path, file_data, chunk_size=UPLOAD_CHUNK_SIZE):
+    """Copy a file-like object to file_path in chunks, through a temp file
+    in the same directory that is renamed over file_path once complete.
+    Readers see the old file or the new one, never a partial one"""
+    file_descriptor, temp_path = tempfile.mkstemp(prefix='.upload-',
+                                                  dir=os.path.dirname(file_path))
+    try:
+        with os.fdopen(file_descriptor, 'wb') as temp_file:
+            file_data.seek(0)
+            for chunk in iter(lambda: file_data.read(chunk_size), ''):
+                temp_file.write(chunk)
+            temp_file.flush()
+            os.fsync(temp_file.fileno())
+        if os.path.exists(file_path):
+            # mkstemp files are private to the owner
+            shutil.copymode(file_path, temp_path)
+        os.rename(temp_path, file_path)
+    except Exception:
+        os.remove(temp_path)
+        raise
+
+
+def set_asset_content_form_data(form, file_name, file_data):
+    """Set the file of an asset content form. The filesystem adapter
+    read()s the whole file into memory and writes it over the content's
+    current file in place, so for it the upload is copied in chunks to the
+    paths the adapter would use, each through save_file(), and the form
+    pointed at the new file. Other stores get the file as-is"""
+    data_paths = get_filesystem_data_paths(form, file_name)
+    if data_paths is None:
+        data = DataInputStream(file_data)
+        data.name = file_name
+        form.set_data(data)
+        return form
+
+    for data_path in data_paths:
+        if not os.path.isdir(os.path.dirname(data_path)):
+            os.makedirs(os.path.dirname(data_path))
+        save_file(data_path, file_data)
+    form.set_url(data_paths[0])
+    return form
+
+
 def set_asset_created_date(repository, asset_id, created_date):
     if not isinstance(created_date, DateTime):
         raise TypeError('created_date must be instance of DateTime')
@@ -457,15 +731,111 @@ def set_asset_created_date(repository, asset_id, created_date):
     repository.update_asset(form)
 
 
+def set_content_url_template(asset_content_map, url):
+    """Remember the URL template of an asset content's repository, from
+    the URL of that asset content"""
+    try:
+        repository_id = asset_content_map['assignedRepositoryIds'][0]
+        path = CONTENT_URL_PATH.format(repository_id,
+                                       asset_content_map['assetId'],
+                                       asset_content_map['id'])
+    except (KeyError, IndexError):
+        return
+    template = ''
+    if url.endswith(path):
+        # keeps the url_hostname, if the store has one
+        template = url[:-len(path)] + CONTENT_URL_PATH
+    CONTENT_URL_TEMPLATES.set(repository_id, template)
+
+
+def share_asset_content_file(repo, asset_content_id):
+    """Hard link the datastore file of an asset content to a file with the
+    same bytes already stored in repo, so the bytes are kept once, or index
+    it if there is none. Each asset content keeps its own path, so deleting
+    one only drops its link, and replacing one (set_asset_content_form_data)
+    writes a new file rather than changing the shared one. Contents in other
+    stores, and the filesystem adapter's backup copies, are left as-is."""
+    file_path = get_asset_content_file_path(repo.get_asset_content(asset_content_id))
+    if file_path is None:
+        return
+    with open(file_path, 'rb') as content_file:
+        content_hash = get_content_hash(content_file)
+
+    with CONTENT_HASH_INDEX_LOCK:
+        hash_index = get_content_hash_index(repo)
+        entry = hash_index['contents'].get(content_hash)
+        stored_path = None
+        if entry is not None:
+            stored_path = get_indexed_file_path(entry, content_hash)
+        if stored_path is not None and stored_path != file_path:
+            try:
+                link_file(stored_path, file_path)
+            except OSError:
+                # i.e. the datastore does not support hard links
+                stored_path = None
+        if stored_path is None:
+            stored_path = file_path
+
+        file_stat = os.stat(stored_path)
+        stored_entry = [stored_path, file_stat.st_size, file_stat.st_mtime]
+        if stored_entry != entry:
+            hash_index['contents'][content_hash] = stored_entry
+            save_content_hash_index(hash_index)
+
+
+def stream_byte_ranges(read_range, ranges, content_length, content_type, boundary):
+    """Yield a multipart/byteranges body, with the bytes of each range
+    coming from ``read_range(start, end)``"""
+    for start, end in ranges:
+        yield get_byte_range_part_header(start, end, content_length, content_type, boundary)
+        for chunk in read_range(start, end):
+            yield chunk
+        yield '\r\n'
+    yield '--{0}--\r\n'.format(boundary)
+
+
+def stream_data(data, start, end, chunk_size=STREAM_CHUNK_SIZE):
+    """Yield bytes start to end (exclusive) of a file-like object, seeking
+    to start. For stores that do not keep asset contents in files"""
+    data.seek(start)
+    remaining = end - start
+    while remaining > 0:
+        chunk = data.read(min(chunk_size, remaining))
+        if not chunk:
+            break
+        remaining -= len(chunk)
+        yield chunk
+
+
+def stream_file(file_path, start, end, chunk_size=STREAM_CHUNK_SIZE):
+    """Yield bytes start to end (exclusive) of a file, read in chunks of
+    chunk_size. Stops early if the file is cut short while it streams
+    (e.g. its content is replaced)"""
+    if end <= start:
+        return
+    with open(file_path, 'rb') as file_:
+        for chunk in stream_data(file_, start, end, chunk_size=chunk_size):
+            yield chunk
+
+
 def update_asset_map_with_content_url(rm, asset_map):
-    acls = rm.get_asset_content_lookup_session(proxy=rm._proxy)
-    acls.use_federated_repository_view()
+    """Set the full URL of each asset content in an asset map, or of a
+    single asset content map. Only the first content of each repository is
+    looked up; the rest are filled into its URL template"""
     if 'assetContents' in asset_map:
-        for index, asset_content in enumerate(asset_map['assetContents']):
-            ac = acls.get_asset_content(utilities.clean_id(asset_content['id']))
-            asset_map['assetContents'][index]['url'] = ac.get_url()
+        asset_content_maps = asset_map['assetContents']
     else:
         # for an assetContent
-        ac = acls.get_asset_content(utilities.clean_id(asset_map['id']))
-        asset_map['url'] = ac.get_url()
+        asset_content_maps = [asset_map]
+
+    acls = None
+    for asset_content_map in asset_content_maps:
+        url = get_content_url(asset_content_map)
+        if url is None:
+            if acls is None:
+                acls = rm.get_asset_content_lookup_session(proxy=rm._proxy)
+                acls.use_federated_repository_view()
+            url = acls.get_asset_content(utilities.clean_id(asset_content_map['id'])).get_url()
+            set_content_url_template(asset_content_map, url)
+        asset_content_map['url'] = url
     return asset_map
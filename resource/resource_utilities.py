@@ -1,21 +1,46 @@
 import json
-import web
+import os
+import tempfile
 
 from bson.errors import InvalidId
 
 from dlkit.primordium.type.primitives import Type
 from dlkit.json_ import types
-from dlkit.runtime import PROXY_SESSION, RUNTIME
 from dlkit.runtime.errors import NotFound
-from dlkit.runtime.proxy_example import SimpleRequest
-from dlkit.runtime.primitives import InitializableLocale
 
-from utilities import clean_id
+from utilities import clean_id, get_locale_code, get_service_manager, CACHES, LRUCache
 
 DEFAULT_LANGUAGE_TYPE = Type(**types.Language().get_type_data('DEFAULT'))
 DEFAULT_SCRIPT_TYPE = Type(**types.Script().get_type_data('DEFAULT'))
 DEFAULT_FORMAT_TYPE = Type(**types.Format().get_type_data('DEFAULT'))
 
+# asset maps are enriched this many at a time, with one resource lookup
+# for the sources / providers that are not cached yet
+RESOURCE_PREFETCH_BATCH_SIZE = 100
+
+# (resource id, locale) -> displayName map, for asset source / provider
+# enrichment; the names are read in the request's language. There are few
+# distinct sources and providers, so this rarely fills up. Resources made or
+# found deleted here drop their entries (invalidate_resource_display_names);
+# the TTL bounds how stale a resource renamed elsewhere can be
+RESOURCE_DISPLAY_NAMES = LRUCache(4096, ttl=300)
+CACHES['resourceDisplayNames'] = RESOURCE_DISPLAY_NAMES
+
+# bin id -> resource name -> id of the resource that
+# get_or_create_resource_id made for it, so repeated attributions look the
+# resource up by its id instead of resolving its alias. Each bin's index is
+# kept in a JSON file in the datastore, and loaded from it the first time
+# the bin is used; entries whose resource is gone are dropped
+RESOURCE_ALIAS_INDEX = LRUCache(1024)
+CACHES['resourceAliasIndex'] = RESOURCE_ALIAS_INDEX
+RESOURCE_ALIAS_INDEX_DIRECTORY = 'resourceAliasIndex'
+
+
+def get_asset_map_resource_ids(asset_map):
+    """The source and provider ids of an asset map"""
+    return [asset_map[key] for key in ['sourceId', 'providerId']
+            if asset_map.get(key, '') != '']
+
 
 def get_alias_resource_id(resource_name, authority='ODL.MIT.EDU'):
     # Note that this authority must match the config...
@@ -24,9 +49,25 @@ def get_alias_resource_id(resource_name, authority='ODL.MIT.EDU'):
 
 
 def get_or_create_resource_id(catalog, resource_name):
+    # the bin is always got, so that the caller's authorization for it is
+    # checked, even when the name is in the index
     mgr = get_resource_manager()
     bin_ = mgr.get_bin(catalog.ident)
 
+    alias_index = RESOURCE_ALIAS_INDEX.get(str(catalog.ident))
+    if alias_index is None:
+        alias_index = load_resource_alias_index(bin_)
+        RESOURCE_ALIAS_INDEX.set(str(catalog.ident), alias_index)
+    resource_id = alias_index['resourceIds'].get(resource_name)
+    if resource_id is not None:
+        try:
+            return bin_.get_resource(clean_id(resource_id)).ident
+        except (NotFound, InvalidId):
+            # the resource was deleted since it was indexed
+            alias_index['resourceIds'].pop(resource_name, None)
+            save_resource_alias_index(alias_index)
+            invalidate_resource_display_names(resource_id)
+
     authority = 'ODL.MIT.EDU'
     try:
         config = bin_._catalog._runtime.get_configuration()
@@ -45,72 +86,146 @@ def get_or_create_resource_id(catalog, resource_name):
         form.display_name = resource_name
         resource = bin_.create_resource(form)
         bin_.alias_resource(resource.ident, resource_alias_id)
+        invalidate_resource_display_names(resource.ident)
+        invalidate_resource_display_names(resource_alias_id)
 
+    alias_index['resourceIds'][resource_name] = str(resource.ident)
+    save_resource_alias_index(alias_index)
     return resource.ident
 
 
-def get_resource_manager():
-    condition = PROXY_SESSION.get_proxy_condition()
-    dummy_request = SimpleRequest(username=web.ctx.env.get('HTTP_X_API_PROXY', 'student@tiss.edu'),
-                                  authenticated=True)
-    condition.set_http_request(dummy_request)
-
-    if 'HTTP_X_API_LOCALE' in web.ctx.env:
-        language_code = web.ctx.env['HTTP_X_API_LOCALE'].lower()
-        if language_code in ['en', 'hi', 'te']:
-            if language_code == 'en':
-                language_code = 'ENG'
-                script_code = 'LATN'
-            elif language_code == 'hi':
-                language_code = 'HIN'
-                script_code = 'DEVA'
-            else:
-                language_code = 'TEL'
-                script_code = 'TELU'
+def get_resource_display_names(resource_ids):
+    """
+    Get the displayName maps of the given resources, from the cache or
+    else with one lookup for all of the missing ones
+    :param resource_ids: resource id strings
+    :return: dict of resource id string -> displayName map
+    """
+    display_names = {}
+    missing_ids = []
+    locale = get_locale_code()
+    for resource_id in set(resource_ids):
+        display_name = RESOURCE_DISPLAY_NAMES.get((resource_id, locale))
+        if display_name is None:
+            missing_ids.append(resource_id)
         else:
-            language_code = DEFAULT_LANGUAGE_TYPE.identifier
-            script_code = DEFAULT_SCRIPT_TYPE.identifier
-
-        locale = InitializableLocale(language_type_identifier=language_code,
-                                     script_type_identifier=script_code)
+            display_names[resource_id] = display_name
 
-        condition.set_locale(locale)
-
-    proxy = PROXY_SESSION.get_proxy(condition)
-    return RUNTIME.get_service_manager('RESOURCE',
-                                       proxy=proxy)
+    if len(missing_ids) > 0:
+        mgr = get_resource_manager()
+        rls = mgr.get_resource_lookup_session(proxy=mgr._proxy)
+        rls.use_federated_bin_view()
+        resources = dict((str(resource.ident), resource)
+                         for resource in rls.get_resources_by_ids([clean_id(i) for i in missing_ids]))
+        for resource_id in missing_ids:
+            if resource_id in resources:
+                resource = resources[resource_id]
+            else:
+                # i.e. an alias id; raises NotFound for unknown resources
+                resource = rls.get_resource(clean_id(resource_id))
+            display_names[resource_id] = {
+                'text': resource.display_name.text,
+                'languageTypeId': str(resource.display_name.language_type),
+                'formatTypeId': str(resource.display_name.format_type),
+                'scriptTypeId': str(resource.display_name.script_type)
+            }
+            RESOURCE_DISPLAY_NAMES.set((resource_id, locale), display_names[resource_id])
+    return display_names
+
+
+def get_resource_alias_index_path(bin_):
+    """Where the alias index of a bin is kept, in the JSON datastore, or
+    None if the datastore path is not configured"""
+    try:
+        config = bin_._catalog._runtime.get_configuration()
+        parameter_id = clean_id('parameter:dataStorePath@json')
+        data_store_path = config.get_value_by_parameter(parameter_id).get_string_value()
+    except (AttributeError, KeyError, NotFound):
+        return None
+    return os.path.join(data_store_path,
+                        RESOURCE_ALIAS_INDEX_DIRECTORY,
+                        '{0}.json'.format(bin_.ident.identifier))
 
 
-def update_asset_map_with_resource(asset_map):
+def get_resource_manager():
+    return get_service_manager('RESOURCE')
+
+
+def invalidate_resource_display_names(resource_id):
+    """Drop the cached names of a resource that was made, changed or
+    deleted, in every language"""
+    resource_id = str(resource_id)
+    RESOURCE_DISPLAY_NAMES.invalidate_where(lambda key: key[0] == resource_id)
+
+
+def load_resource_alias_index(bin_):
+    """The alias index of a bin, as saved in the datastore"""
+    alias_index = {
+        'path': get_resource_alias_index_path(bin_),
+        'resourceIds': {}
+    }
+    if alias_index['path'] is not None and os.path.isfile(alias_index['path']):
+        try:
+            with open(alias_index['path'], 'rb') as index_file:
+                alias_index['resourceIds'] = json.load(index_file)
+        except (IOError, ValueError):
+            # rebuilt from the resource service as names are used
+            pass
+    return alias_index
+
+
+def save_resource_alias_index(alias_index):
+    """Write an alias index to the datastore, through a temp file that is
+    renamed into place, so readers never see a partial index"""
+    if alias_index['path'] is None:
+        return
+    index_directory = os.path.dirname(alias_index['path'])
+    if not os.path.isdir(index_directory):
+        os.makedirs(index_directory)
+    file_descriptor, temp_path = tempfile.mkstemp(prefix='.index-', dir=index_directory)
+    with os.fdopen(file_descriptor, 'wb') as temp_file:
+        json.dump(dict(alias_index['resourceIds']), temp_file)
+    os.rename(temp_path, alias_index['path'])
+
+
+def update_asset_map_with_resource(asset_map, display_names=None):
     original_was_string = False
     if isinstance(asset_map, str):
         asset_map = json.loads(asset_map)
         original_was_string = True
 
+    if display_names is None:
+        display_names = get_resource_display_names(get_asset_map_resource_ids(asset_map))
+
     if 'sourceId' in asset_map and asset_map['sourceId'] != '':
-        mgr = get_resource_manager()
-        rls = mgr.get_resource_lookup_session(proxy=mgr._proxy)
-        rls.use_federated_bin_view()
-        resource = rls.get_resource(clean_id(asset_map['sourceId']))
-        asset_map['source'] = {
-            'text': resource.display_name.text,
-            'languageTypeId': str(resource.display_name.language_type),
-            'formatTypeId': str(resource.display_name.format_type),
-            'scriptTypeId': str(resource.display_name.script_type)
-        }
+        asset_map['source'] = dict(display_names[asset_map['sourceId']])
 
     if 'providerId' in asset_map and asset_map['providerId'] != '':
-        mgr = get_resource_manager()
-        rls = mgr.get_resource_lookup_session(proxy=mgr._proxy)
-        rls.use_federated_bin_view()
-        resource = rls.get_resource(clean_id(asset_map['providerId']))
-        asset_map['provider'] = {
-            'text': resource.display_name.text,
-            'languageTypeId': str(resource.display_name.language_type),
-            'formatTypeId': str(resource.display_name.format_type),
-            'scriptTypeId': str(resource.display_name.script_type)
-        }
+        asset_map['provider'] = dict(display_names[asset_map['providerId']])
 
     if original_was_string:
         return json.dumps(asset_map)
     return asset_map
+
+
+def update_asset_maps_with_resources(asset_maps, batch_size=RESOURCE_PREFETCH_BATCH_SIZE):
+    """Lazily update a stream of asset maps with their source and provider
+    names, prefetching them for batch_size asset maps at a time"""
+    batch = []
+    for asset_map in asset_maps:
+        batch.append(asset_map)
+        if len(batch) == batch_size:
+            for updated_asset_map in _update_asset_map_batch_with_resources(batch):
+                yield updated_asset_map
+            batch = []
+    for updated_asset_map in _update_asset_map_batch_with_resources(batch):
+        yield updated_asset_map
+
+
+def _update_asset_map_batch_with_resources(asset_maps):
+    resource_ids = []
+    for asset_map in asset_maps:
+        resource_ids += get_asset_map_resource_ids(asset_map)
+    display_names = get_resource_display_names(resource_ids)
+    return [update_asset_map_with_resource(asset_map, display_names)
+            for asset_map in asset_maps]
@@ -22,6 +22,7 @@ from dlkit.records.registry import LOG_ENTRY_RECORD_TYPES
 from urllib import unquote
 
 from main import app
+from utilities import clear_caches
 
 
 # PROJECT_PATH = os.path.dirname(os.path.abspath(__file__))
@@ -513,6 +514,9 @@ class BaseTestCase(TestCase):
         shutil.copytree('{0}/cataloging'.format(TEST_FIXTURES_PATH),
                         '{0}/cataloging'.format(TEST_DATA_STORE_PATH))
 
+        # cached managers / lookups may point at the previous test's data
+        clear_caches()
+
         self._bank = get_fixture_bank()
 
     def setup_entry(self, log_id, data):
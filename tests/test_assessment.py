@@ -1,7 +1,9 @@
 # -*- coding: utf-8 -*-
 import csv
 import json
+import numpy as np
 import os
+import web
 
 from bs4 import BeautifulSoup
 
@@ -22,8 +24,10 @@ from sympy import sympify
 
 from testing_utilities import BaseTestCase, get_managers, get_fixture_bank,\
     create_new_bank, get_valid_contents, get_fixture_repository, update_soup_with_url
+from unittest import TestCase
 from urllib import unquote, quote
 
+from assessment import assessment_utilities as autils
 import utilities
 
 EDX_ITEM_RECORD_TYPE = Type(**ITEM_RECORD_TYPES['edx_item'])
@@ -2404,6 +2408,65 @@ class AssessmentCrUDTests(BaseAssessmentTestCase):
         data = self.json(req)
         self.assertEqual(len(data), 0)
 
+    def test_can_get_sparse_item_fields(self):
+        item = self.create_item(self._bank.ident)
+
+        req = self.app.get(self.url + '/items?fields=displayName,genusTypeId&wronganswers&unshuffled')
+        self.ok(req)
+        data = self.json(req)
+        self.assertEqual(len(data), 1)
+        self.assertEqual(sorted(data[0].keys()),
+                         ['displayName', 'genusTypeId', 'id'])
+        self.assertEqual(data[0]['id'], str(item.ident))
+
+        req = self.app.get('{0}/items/{1}?fields=question'.format(self.url,
+                                                                  unquote(str(item.ident))))
+        self.ok(req)
+        data = self.json(req)
+        self.assertEqual(sorted(data.keys()), ['id', 'question'])
+        self.assertEqual(data['question']['text']['text'], 'foo?')
+
+        req = self.app.get(self.url + '/items')
+        self.ok(req)
+        self.assertIn('answers', self.json(req)[0])
+
+    def test_can_page_through_items(self):
+        item_ids = [str(self.create_item(self._bank.ident).ident) for i in range(0, 3)]
+
+        url = self.url + '/items?limit=2'
+        paged_ids = []
+        while url is not None:
+            req = self.app.get(url)
+            self.ok(req)
+            data = self.json(req)
+            self.assertTrue(len(data) <= 2)
+            paged_ids += [i['id'] for i in data]
+            links = [value for name, value in req.headers if name == 'Link']
+            url = None
+            if len(links) > 0:
+                url = links[0].split('<')[1].split('>')[0].replace('http://localhost', '')
+        self.assertEqual(sorted(paged_ids), sorted(item_ids))
+
+    def test_qti_media_path_is_looked_up_once(self):
+        self.create_mw_sentence_item()
+        self.create_item(self._bank.ident)
+        repository_ids = utilities.CACHES['bankRepositoryIds']
+        repository_ids.clear()
+
+        req = self.app.get(self.url + '/items?qti')
+        self.ok(req)
+        data = self.json(req)
+        self.assertEqual(len(data), 2)
+        qti_xml = [i['qti'] for i in data if 'qti' in i][0]
+        self.assertIn('/api/v1/repository/repositories/', qti_xml)
+        self.assertEqual(repository_ids.stats()['misses'], 1)
+        self.assertEqual(repository_ids.stats()['hits'], 0)
+
+        req = self.app.get(self.url + '/items?qti')
+        self.ok(req)
+        self.assertEqual(repository_ids.stats()['misses'], 1)
+        self.assertEqual(repository_ids.stats()['hits'], 1)
+
 
 class AssessmentOfferedTests(BaseAssessmentTestCase):
     def create_assessment(self):
@@ -3342,6 +3405,52 @@ class AssessmentOfferedTests(BaseAssessmentTestCase):
                           params=json.dumps(payload),
                           headers={'content-type': 'application/json'})
 
+    def test_can_page_through_assessments_offered(self):
+        item = self.create_item()
+        assessment = self.create_assessment()
+        self.link_item_to_assessment(item, assessment)
+        assessment_offering_endpoint = '{0}/assessments/{1}/assessmentsoffered'.format(self.url,
+                                                                                      unquote(assessment['id']))
+        payload = {
+            "startTime" : {
+                "day"   : 1,
+                "month" : 1,
+                "year"  : 2015
+            }
+        }
+        offered_ids = []
+        for i in range(0, 3):
+            req = self.app.post(assessment_offering_endpoint,
+                                params=json.dumps(payload),
+                                headers={'content-type': 'application/json'})
+            self.ok(req)
+            offered_ids.append(self.json(req)['id'])
+
+        for url in [assessment_offering_endpoint, self.url + '/assessmentsoffered']:
+            req = self.app.get(url + '?limit=2')
+            self.ok(req)
+            data = self.json(req)
+            self.assertEqual(len(data), 2)
+            next_link = req.header('Link')
+            self.assertIn('rel="next"', next_link)
+            next_url = next_link.split('<')[1].split('>')[0]
+            self.assertIn('limit=2', next_url)
+            self.assertIn('cursor=', next_url)
+
+            req = self.app.get(next_url.replace('http://localhost', ''))
+            self.ok(req)
+            next_data = self.json(req)
+            self.assertEqual(len(next_data), 1)
+            self.assertNotIn('Link', [h[0] for h in req.headers])
+
+            paged_ids = [o['id'] for o in data + next_data]
+            self.assertEqual(sorted(paged_ids), sorted(offered_ids))
+
+    def test_bad_offered_pagination_cursor_throws_exception(self):
+        self.assertRaises(AppError,
+                          self.app.get,
+                          self.url + '/assessmentsoffered?limit=2&cursor=foo')
+
 
 class AssessmentTakingTests(BaseAssessmentTestCase):
     def create_assessment(self):
@@ -3875,6 +3984,150 @@ class AssessmentTakingTests(BaseAssessmentTestCase):
             self.assertTrue(question['response']['isCorrect'])
             self.assertFalse(question['additionalAttempts'][0]['isCorrect'])
 
+    def test_results_for_offered_are_refreshed_after_submit_and_finish(self):
+        assessment_offering_detail_endpoint = self.url + '/assessmentsoffered/' + unquote(str(self.offered['id']))
+        test_student = 'student@tiss.edu'  # this is what we have authz set up for
+        assessment_offering_takens_endpoint = assessment_offering_detail_endpoint + '/assessmentstaken'
+        req = self.app.post(assessment_offering_takens_endpoint,
+                            headers={
+                                'x-api-proxy': test_student
+                            })
+        self.ok(req)
+        taken = json.loads(req.body)
+        taken_id = unquote(taken['id'])
+        taken_questions_url = '{0}/assessmentstaken/{1}/questions'.format(self.url,
+                                                                          taken_id)
+        req = self.app.get(taken_questions_url)
+        self.ok(req)
+        question_1 = self.json(req)['data'][0]
+        url = '{0}/{1}/submit'.format(taken_questions_url,
+                                      question_1['id'])
+        choices = question_1['choices']
+        wrong_answer = [c for c in choices if c['name'] == 'Choice 2'][0]
+        right_answer = [c for c in choices if c['name'] == 'Choice 1'][0]
+
+        results_url = '{0}/assessmentsoffered/{1}/results'.format(self.url,
+                                                                  unquote(self.offered['id']))
+        req = self.app.get(results_url)
+        self.ok(req)
+        data = self.json(req)
+        self.assertEqual(len(data), 1)
+        self.assertIsNone(data[0]['sections'][0]['questions'][0]['response'])
+        self.assertIsNone(data[0]['completionTime'])
+
+        for answer in [wrong_answer, right_answer]:
+            req = self.app.post(url,
+                                params=json.dumps({'choiceIds': [answer['id']]}),
+                                headers={'content-type': 'application/json'})
+            self.ok(req)
+            req = self.app.get(results_url)
+            self.ok(req)
+            data = self.json(req)
+            question = data[0]['sections'][0]['questions'][0]
+            self.assertEqual(question['response']['choiceIds'], [answer['id']])
+            self.assertEqual(question['response']['isCorrect'], answer == right_answer)
+
+        # the second GET above was served from the refreshed results
+        self.assertTrue(utilities.CACHES['takenResults'].hits > 0)
+
+        req = self.app.post('{0}/assessmentstaken/{1}/finish'.format(self.url, taken_id))
+        self.ok(req)
+        req = self.app.get(results_url)
+        self.ok(req)
+        data = self.json(req)
+        self.assertIsNotNone(data[0]['completionTime'])
+
+    def test_results_for_offered_are_cached_per_locale_and_handed_out_as_copies(self):
+        takens_url = '{0}/assessmentsoffered/{1}/assessmentstaken'.format(self.url,
+                                                                          unquote(self.offered['id']))
+        req = self.app.post(takens_url,
+                            headers={
+                                'x-api-proxy': 'student@tiss.edu'
+                            })
+        self.ok(req)
+        taken_id = unquote(json.loads(req.body)['id'])
+        req = self.app.get('{0}/assessmentstaken/{1}/questions'.format(self.url, taken_id))
+        self.ok(req)
+
+        results_url = '{0}/assessmentsoffered/{1}/results'.format(self.url,
+                                                                  unquote(self.offered['id']))
+        req = self.app.get(results_url)
+        self.ok(req)
+        req = self.app.get(results_url,
+                           headers={
+                               'x-api-locale': 'hi'
+                           })
+        self.ok(req)
+        self.assertIn((taken_id, None, False), autils.TAKEN_RESULTS_CACHE)
+        self.assertIn((taken_id, 'hi', False), autils.TAKEN_RESULTS_CACHE)
+
+        web.ctx.clear()
+        web.ctx.env = {}
+        bank = get_managers()['am'].get_bank(self._bank.ident)
+        taken = bank.get_assessment_taken(utilities.clean_id(taken_id))
+        results_map = autils.get_taken_results_map(taken, bank)
+        del results_map['sections'][0]['questions'][:]
+        results_map = autils.get_taken_results_map(taken, bank)
+        self.assertEqual(len(results_map['sections'][0]['questions']), 1)
+
+    def test_can_get_item_statistics_for_offered(self):
+        statistics_url = '{0}/assessmentsoffered/{1}/statistics'.format(self.url,
+                                                                        unquote(self.offered['id']))
+        req = self.app.get(statistics_url)
+        self.ok(req)
+        data = self.json(req)
+        self.assertEqual(data['takens'], 0)
+        self.assertEqual(data['questions'], [])
+        self.assertIsNone(data['cronbachAlpha'])
+
+        takens_url = '{0}/assessmentsoffered/{1}/assessmentstaken'.format(self.url,
+                                                                          unquote(self.offered['id']))
+        # finishing the first taken makes the student get a second one
+        for choice_name in ['Choice 1', 'Choice 2']:
+            req = self.app.post(takens_url,
+                                headers={
+                                    'x-api-proxy': 'student@tiss.edu'
+                                })
+            self.ok(req)
+            taken_id = unquote(json.loads(req.body)['id'])
+            taken_questions_url = '{0}/assessmentstaken/{1}/questions'.format(self.url,
+                                                                              taken_id)
+            req = self.app.get(taken_questions_url)
+            self.ok(req)
+            question_1 = self.json(req)['data'][0]
+            choice = [c for c in question_1['choices'] if c['name'] == choice_name][0]
+            req = self.app.post('{0}/{1}/submit'.format(taken_questions_url,
+                                                        question_1['id']),
+                                params=json.dumps({'choiceIds': [choice['id']]}),
+                                headers={'content-type': 'application/json'})
+            self.ok(req)
+            req = self.app.post('{0}/assessmentstaken/{1}/finish'.format(self.url, taken_id))
+            self.ok(req)
+
+        req = self.app.get(statistics_url)
+        self.ok(req)
+        data = self.json(req)
+        self.assertEqual(data['takens'], 2)
+        self.assertEqual(data['completeTakens'], 2)
+        self.assertEqual(data['meanScore'], 0.5)
+        # a one question test has no alpha
+        self.assertIsNone(data['cronbachAlpha'])
+        self.assertEqual(len(data['questions']), 1)
+        question = data['questions'][0]
+        self.assertEqual(question['presented'], 2)
+        self.assertEqual(question['pValue'], 0.5)
+        self.assertEqual(
+            dict((c['name'], c['count']) for c in question['choices']),
+            {'Choice 1': 1, 'Choice 2': 1, 'Choice 3': 0}
+        )
+
+        # the matrices are re-used until a taken's results change
+        matrices = utilities.CACHES['offeredResponseMatrices']
+        hits = matrices.hits
+        req = self.app.get(statistics_url)
+        self.ok(req)
+        self.assertEqual(matrices.hits, hits + 1)
+
     def test_can_set_display_name(self):
         item = self.create_item(with_feedback=True)
         self.assessment = self.create_assessment()
@@ -4116,6 +4369,35 @@ class AssessmentTakingTests(BaseAssessmentTestCase):
         assert provenance_id_1 != provenance_id_2
         assert data['id'] == taken['id']
 
+    def test_can_page_through_assessments_taken(self):
+        bank = get_managers()['am'].get_bank(self._bank.ident)
+        taken_ids = []
+        for i in range(0, 3):
+            form = bank.get_assessment_taken_form_for_create(utilities.clean_id(self.offered['id']),
+                                                             [REVIEWABLE_TAKEN])
+            taken_ids.append(str(bank.create_assessment_taken(form).ident))
+
+        url = '{0}/assessmentsoffered/{1}/assessmentstaken'.format(self.url,
+                                                                   unquote(self.offered['id']))
+        req = self.app.get(url + '?limit=2')
+        self.ok(req)
+        data = self.json(req)
+        self.assertEqual(len(data), 2)
+        next_link = req.header('Link')
+        self.assertIn('rel="next"', next_link)
+        next_url = next_link.split('<')[1].split('>')[0]
+        self.assertIn('limit=2', next_url)
+        self.assertIn('cursor=', next_url)
+
+        req = self.app.get(next_url.replace('http://localhost', ''))
+        self.ok(req)
+        next_data = self.json(req)
+        self.assertEqual(len(next_data), 1)
+        self.assertNotIn('Link', [h[0] for h in req.headers])
+
+        paged_ids = [t['id'] for t in data + next_data]
+        self.assertEqual(sorted(paged_ids), sorted(taken_ids))
+
 
 class BankTests(BaseAssessmentTestCase):
     def setUp(self):
@@ -10963,3 +11245,77 @@ class MultiLanguageTests(BaseAssessmentTestCase):
         matching_choice = soup.find(identifier=original_identifier)
         self.assertIn(self._hindi_text, unicode(matching_choice))
         self.assertNotIn(wrong_identifier, unicode(soup))
+
+
+class ItemStatisticsTests(TestCase):
+    def get_matrices(self, scores, choices=None, choice_count=0):
+        scores = np.array(scores, dtype=np.int8)
+        if choices is None:
+            choices = np.full(scores.shape, autils.NO_CHOICE, dtype=np.int16)
+        item_ids = ['item{0}'.format(column) for column in range(scores.shape[1])]
+        choice_ids = [['choice{0}'.format(index) for index in range(choice_count)]
+                      for _ in item_ids]
+        return {
+            'item_ids': item_ids,
+            'choice_ids': choice_ids,
+            'choice_names': choice_ids,
+            'scores': scores,
+            'choices': np.array(choices, dtype=np.int16)
+        }
+
+    def test_p_values_and_alpha(self):
+        scores = [[1, 1, 1],
+                  [1, 1, 0],
+                  [1, 0, 0],
+                  [0, 0, 0]]
+        statistics = autils.get_item_statistics(self.get_matrices(scores))
+        self.assertEqual(statistics['takens'], 4)
+        self.assertEqual(statistics['meanScore'], 1.5)
+        self.assertEqual([q['pValue'] for q in statistics['questions']],
+                         [0.75, 0.5, 0.25])
+
+        # k / (k - 1) * (1 - sum of item variances / variance of totals)
+        item_variance = sum(np.var(column, ddof=1) for column in zip(*scores))
+        total_variance = np.var([sum(row) for row in scores], ddof=1)
+        self.assertAlmostEqual(statistics['cronbachAlpha'],
+                               1.5 * (1 - item_variance / total_variance),
+                               places=4)
+
+    def test_point_biserial_is_against_the_rest_score(self):
+        scores = [[1, 1, 0],
+                  [1, 0, 1],
+                  [0, 1, 1],
+                  [0, 0, 0],
+                  [1, 1, 1]]
+        statistics = autils.get_item_statistics(self.get_matrices(scores))
+        for column, question in enumerate(statistics['questions']):
+            item = [row[column] for row in scores]
+            rest = [sum(row) - row[column] for row in scores]
+            self.assertAlmostEqual(question['pointBiserial'],
+                                   np.corrcoef(item, rest)[0, 1],
+                                   places=4)
+
+    def test_questions_not_presented_are_left_out(self):
+        scores = [[1, autils.NOT_PRESENTED],
+                  [0, autils.NOT_PRESENTED],
+                  [1, 1]]
+        statistics = autils.get_item_statistics(self.get_matrices(scores))
+        self.assertEqual(statistics['completeTakens'], 1)
+        self.assertEqual([q['presented'] for q in statistics['questions']], [3, 1])
+        self.assertEqual(statistics['questions'][1]['pValue'], 1.0)
+        # no variance among the one taken that got it
+        self.assertIsNone(statistics['questions'][1]['pointBiserial'])
+        self.assertIsNone(statistics['cronbachAlpha'])
+
+    def test_choice_frequencies(self):
+        scores = [[1, 0],
+                  [0, 0],
+                  [1, 1],
+                  [0, 0]]
+        choices = [[0, 2],
+                   [1, autils.NO_CHOICE],
+                   [0, 1],
+                   [2, 2]]
+        statistics = autils.get_item_statistics(self.get_matrices(scores, choices, 3))
+        self.assertEqual([[c['count'] for c in q['choices']] for q in statistics['questions']],
+                         [[2, 1, 1], [0, 1, 2]])
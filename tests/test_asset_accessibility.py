@@ -1643,7 +1643,7 @@ class AssetAccessibilityCRUDTests(BaseAccessibilityTestCase):
         soup = BeautifulSoup(choice_with_media, 'xml')
         src = soup.source['src']
         req = self.app.get(src)
-        self.code(req, 206)
+        self.ok(req)
 
         req = self.app.get(url,
                            headers={'x-api-locale': 'hi'})
@@ -1657,7 +1657,7 @@ class AssetAccessibilityCRUDTests(BaseAccessibilityTestCase):
         soup = BeautifulSoup(choice_with_media, 'xml')
         src = soup.source['src']
         req = self.app.get(src)
-        self.code(req, 206)
+        self.ok(req)
 
         req = self.app.get(url,
                            headers={'x-api-locale': 'te'})
@@ -1672,7 +1672,7 @@ class AssetAccessibilityCRUDTests(BaseAccessibilityTestCase):
         soup = BeautifulSoup(choice_with_media, 'xml')
         src = soup.source['src']
         req = self.app.get(src)
-        self.code(req, 206)
+        self.ok(req)
 
     def test_audio_transcript_shows_up_in_requested_language(self):
         data = self.upload_audio_with_transcripts()
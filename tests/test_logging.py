@@ -1,15 +1,24 @@
+import csv
+import gzip
 import json
+import os
+import time
 
 from copy import deepcopy
+from cStringIO import StringIO
 
 from dlkit.runtime.primordium import Id
 
 from paste.fixture import AppError
 
-from urllib import quote
+from urllib import quote, urlencode
 
 from testing_utilities import BaseTestCase, get_managers, get_fixture_bank
 
+import utilities
+
+from logging_ import logging_utilities as logutils
+
 
 def osid_agent(name):
     return 'osid.agent.Agent%3A{0}%40MIT-ODL'.format(quote(quote(name)))
@@ -346,6 +355,34 @@ class LogEntryCrUDTests(BaseLoggingTestCase):
             'foo'
         )
 
+    def test_can_page_through_log_entries(self):
+        for text in ['foo', 'bar', 'baz']:
+            self.setup_entry(self.log.ident, text)
+
+        req = self.app.get(self.url + '?limit=2')
+        self.ok(req)
+        self.assertEqual(len(self.json(req)), 2)
+        next_link = req.header('Link')
+        self.assertIn('rel="next"', next_link)
+        next_url = next_link.split('<')[1].split('>')[0]
+        self.assertIn('limit=2', next_url)
+        self.assertIn('cursor=', next_url)
+
+        req = self.app.get(next_url.replace('http://localhost', ''))
+        self.ok(req)
+        entries = self.json(req)
+        self.assertEqual(len(entries), 1)
+        self.assertNotIn('Link', [h[0] for h in req.headers])
+
+        texts = [e['text']['text'] for e in self.json(self.app.get(self.url))]
+        self.assertEqual(texts[2], entries[0]['text']['text'])
+
+    def test_bad_pagination_cursor_throws_exception(self):
+        self.setup_entry(self.log.ident, 'foo')
+        self.assertRaises(AppError,
+                          self.app.get,
+                          self.url + '?limit=2&cursor=foo')
+
     def test_can_create_log_entry(self):
         self.num_entries(0)
         payload = {
@@ -377,6 +414,274 @@ class LogEntryCrUDTests(BaseLoggingTestCase):
                           params=json.dumps(payload),
                           headers={'content-type': 'application/json'})
 
+    def test_can_create_a_batch_of_log_entries(self):
+        self.num_entries(0)
+        payload = {
+            'entries': [
+                {'data': {'action': 'click'},
+                 'name': 'first',
+                 'timestamp': {'year': 2016, 'month': 8, 'day': 1,
+                               'hour': 10, 'minute': 30, 'second': 5}},
+                {'name': 'no data'},
+                {'data': 'second',
+                 'timestamp': {'month': 'august'}},
+                'not an entry',
+                {'data': 'third'}
+            ]
+        }
+
+        req = self.app.post(self.url,
+                            params=json.dumps(payload),
+                            headers={'content-type': 'application/json'})
+        self.ok(req)
+        results = self.json(req)
+        self.assertEqual(len(results), 5)
+        self.assertIn('id', results[0])
+        self.assertIn('"data" required', results[1]['error'])
+        self.assertIn('timestamp', results[2]['error'])
+        self.assertIn('object', results[3]['error'])
+        self.assertIn('id', results[4])
+        for result in [results[1], results[2], results[3]]:
+            self.assertNotIn('id', result)
+        self.num_entries(2)
+
+        req = self.app.get('{0}/{1}'.format(self.url, results[0]['id']))
+        self.ok(req)
+        entry = self.json(req)
+        self.assertEqual(entry['displayName']['text'], 'first')
+        self.assertEqual(json.loads(entry['text']['text']), {'action': 'click'})
+        self.assertEqual(entry['timestamp']['year'], 2016)
+        self.assertEqual(entry['timestamp']['minute'], 30)
+
+    def test_log_entry_batch_must_be_a_list(self):
+        self.assertRaises(AppError,
+                          self.app.post,
+                          self.url,
+                          params=json.dumps({'entries': {'data': 'foo'}}),
+                          headers={'content-type': 'application/json'})
+        self.num_entries(0)
+
+    def post_entries(self, entries):
+        req = self.app.post(self.url,
+                            params=json.dumps({'entries': entries}),
+                            headers={'content-type': 'application/json'})
+        self.ok(req)
+        return [result['id'] for result in self.json(req)]
+
+    def query(self, **params):
+        req = self.app.get(self.url + '?' + urlencode(params))
+        self.ok(req)
+        return [entry['id'] for entry in self.json(req)]
+
+    def test_can_filter_log_entries_by_time_agent_and_genus(self):
+        # made before the index exists, so found by the scan that builds it
+        old_entry = self.setup_entry(self.log.ident, 'old')
+        ids = self.post_entries([
+            {'data': 'first',
+             'genusTypeId': 'log-entry-genus-type%3Aclick%40ODL.MIT.EDU',
+             'timestamp': {'year': 2016, 'month': 8, 'day': 1}},
+            {'data': 'second',
+             'timestamp': {'year': 2016, 'month': 8, 'day': 3}},
+            {'data': 'third',
+             'genusTypeId': 'log-entry-genus-type%3Aclick%40ODL.MIT.EDU',
+             'timestamp': {'year': 2016, 'month': 8, 'day': 5}}
+        ])
+
+        august = {'startTime': json.dumps({'year': 2016, 'month': 8, 'day': 1}),
+                  'endTime': json.dumps({'year': 2016, 'month': 9, 'day': 1})}
+        self.assertEqual(self.query(**august), ids)
+        self.assertEqual(self.query(startTime=json.dumps({'year': 2016, 'month': 8, 'day': 2}),
+                                    endTime=json.dumps({'year': 2016, 'month': 8, 'day': 5})),
+                         [ids[1]])
+        self.assertEqual(self.query(genusTypeId='log-entry-genus-type%3Aclick%40ODL.MIT.EDU'),
+                         [ids[0], ids[2]])
+        self.assertEqual(self.query(agentId=osid_agent('student@tiss.edu'),
+                                    genusTypeId='log-entry-genus-type%3Aclick%40ODL.MIT.EDU',
+                                    endTime=json.dumps({'year': 2016, 'month': 8, 'day': 4})),
+                         [ids[0]])
+        self.assertEqual(self.query(agentId=osid_agent('teacher@tiss.edu')), [])
+        self.assertEqual(self.query(startTime=json.dumps({'year': 2016, 'month': 9, 'day': 1})),
+                         [str(old_entry.ident)])
+
+        # the index is kept up to date after it is built
+        new_ids = self.post_entries([
+            {'data': 'fourth',
+             'timestamp': {'year': 2016, 'month': 8, 'day': 2}}
+        ])
+        self.assertEqual(self.query(**august), [ids[0], new_ids[0], ids[1], ids[2]])
+
+        self.ok(self.app.delete('{0}/{1}'.format(self.url, ids[1])))
+        self.assertEqual(self.query(**august), [ids[0], new_ids[0], ids[2]])
+
+        august['limit'] = 2
+        req = self.app.get(self.url + '?' + urlencode(august))
+        self.ok(req)
+        self.assertEqual([entry['id'] for entry in self.json(req)], [ids[0], new_ids[0]])
+        self.assertIn('rel="next"', req.header('Link'))
+
+    def test_can_archive_old_log_entries_into_daily_segments(self):
+        ids = self.post_entries([
+            {'data': 'first',
+             'timestamp': {'year': 2016, 'month': 8, 'day': 1, 'hour': 9}},
+            {'data': 'second',
+             'timestamp': {'year': 2016, 'month': 8, 'day': 1, 'hour': 10}},
+            {'data': 'third',
+             'timestamp': {'year': 2016, 'month': 8, 'day': 3}},
+            {'data': 'recent'}
+        ])
+
+        # by default only entries older than a week are archived
+        req = self.app.post(self.url.replace('logentries', 'archive'))
+        self.ok(req)
+        self.assertEqual(len(self.json(req)['segments']), 2)
+        self.num_entries(1)
+
+        req = self.app.get(self.url.replace('logentries', 'archive'))
+        self.ok(req)
+        segments = self.json(req)['segments']
+        self.assertEqual([(segment['file'], segment['count']) for segment in segments],
+                         [('2016-08-01.jsonl.gz', 2), ('2016-08-03.jsonl.gz', 1)])
+        archive_path = logutils.get_log_file_path(self.log,
+                                                  logutils.LOG_ARCHIVE_DIRECTORY,
+                                                  extension='')
+        segment_file = gzip.open(os.path.join(archive_path, '2016-08-01.jsonl.gz'), 'rb')
+        self.assertEqual([json.loads(line)['id'] for line in segment_file], ids[:2])
+        segment_file.close()
+
+        # reads merge the segments and the entries still in the datastore
+        req = self.app.get(self.url)
+        self.ok(req)
+        entries = self.json(req)
+        self.assertEqual([entry['id'] for entry in entries], ids)
+        self.assertEqual(entries[0]['text']['text'], 'first')
+        self.assertEqual(self.query(startTime=json.dumps({'year': 2016, 'month': 8, 'day': 1,
+                                                          'hour': 10})),
+                         ids[1:])
+        self.assertEqual(self.query(endTime=json.dumps({'year': 2016, 'month': 8, 'day': 2}),
+                                    fields='id'),
+                         ids[:2])
+        self.assertEqual(self.query(limit=2, cursor=utilities.encode_cursor(2)), ids[2:])
+
+        req = self.app.get('{0}/{1}'.format(self.url, ids[3]))
+        self.ok(req)
+
+        # segments are never changed, so late entries for a day get a new one
+        late_ids = self.post_entries([
+            {'data': 'late',
+             'timestamp': {'year': 2016, 'month': 8, 'day': 1, 'hour': 11}}
+        ])
+        req = self.app.post(self.url.replace('logentries', 'archive'),
+                            params=json.dumps({'before': {'year': 2016, 'month': 9, 'day': 1}}),
+                            headers={'content-type': 'application/json'})
+        self.ok(req)
+        self.assertEqual([segment['file'] for segment in self.json(req)['segments']],
+                         ['2016-08-01.1.jsonl.gz'])
+        self.num_entries(1)
+        self.assertEqual(self.query(genusTypeId=str(self.json(self.app.get(self.url))[0]['genusTypeId'])),
+                         ids[:2] + late_ids + ids[2:])
+
+    def export(self, **params):
+        req = self.app.get(self.url.replace('logentries', 'export') + '?' + urlencode(params))
+        self.ok(req)
+        return req
+
+    def test_can_export_log_entries_as_ndjson(self):
+        ids = self.post_entries([
+            {'data': {'action': 'click', 'target': 'next'},
+             'name': 'first',
+             'timestamp': {'year': 2016, 'month': 8, 'day': 3}},
+            {'data': 'plain text',
+             'timestamp': {'year': 2016, 'month': 8, 'day': 1}},
+            {'data': {'action': 'scroll'}}
+        ])
+        self.ok(self.app.post(self.url.replace('logentries', 'archive'),
+                              params=json.dumps({'before': {'year': 2016, 'month': 8, 'day': 2}}),
+                              headers={'content-type': 'application/json'}))
+
+        req = self.export()
+        self.assertEqual(req.header('Content-Type'), 'application/x-ndjson')
+        self.assertEqual(req.header('Access-Control-Allow-Origin'), '*')
+        records = [json.loads(line) for line in req.body.splitlines()]
+        # archived and live entries merged in time order
+        self.assertEqual([record['id'] for record in records], [ids[1], ids[0], ids[2]])
+        self.assertEqual(records[0]['data'], 'plain text')
+        self.assertEqual(records[0]['timestamp'], '2016-08-01T00:00:00.000000Z')
+        self.assertEqual(records[1]['data'], {'action': 'click', 'target': 'next'})
+        self.assertEqual(records[1]['displayName'], 'first')
+        self.assertEqual(records[1]['agentId'], osid_agent('student@tiss.edu'))
+
+        # resume after the last record received
+        req = self.export(cursor=records[0]['cursor'])
+        self.assertEqual([json.loads(line)['id'] for line in req.body.splitlines()],
+                         [ids[0], ids[2]])
+        req = self.export(cursor=records[2]['cursor'])
+        self.assertEqual(req.body, '')
+
+        req = self.export(startTime=json.dumps({'year': 2016, 'month': 8, 'day': 2}),
+                          endTime=json.dumps({'year': 2016, 'month': 8, 'day': 4}))
+        self.assertEqual([json.loads(line)['id'] for line in req.body.splitlines()],
+                         [ids[0]])
+
+    def test_can_export_log_entries_as_gzipped_csv(self):
+        ids = self.post_entries([
+            {'data': {'action': 'click', 'target': 'next'},
+             'timestamp': {'year': 2016, 'month': 8, 'day': 1}},
+            {'data': 'plain text',
+             'timestamp': {'year': 2016, 'month': 8, 'day': 2}}
+        ])
+        url = self.url.replace('logentries', 'export') + '?format=csv&dataFields=action,missing'
+        req = self.app.get(url,
+                           headers={'Accept-Encoding': 'gzip, deflate'})
+        self.ok(req)
+        self.assertEqual(req.header('Content-Encoding'), 'gzip')
+        self.assertEqual(req.header('Content-Type'), 'text/csv; charset=utf-8')
+        body = gzip.GzipFile(fileobj=StringIO(req.body)).read()
+        rows = list(csv.DictReader(StringIO(body)))
+        self.assertEqual([row['id'] for row in rows], ids)
+        self.assertEqual(json.loads(rows[0]['data']), {'action': 'click', 'target': 'next'})
+        self.assertEqual(rows[0]['data.action'], 'click')
+        self.assertEqual(rows[0]['data.missing'], '')
+        self.assertEqual(rows[1]['data'], 'plain text')
+        self.assertEqual(rows[1]['data.action'], '')
+
+        req = self.app.get(url)
+        self.ok(req)
+        self.assertNotIn('Content-Encoding', [h[0] for h in req.headers])
+        self.assertEqual(list(csv.DictReader(StringIO(req.body))), rows)
+
+    def test_bad_export_format_throws_exception(self):
+        self.assertRaises(AppError,
+                          self.app.get,
+                          self.url.replace('logentries', 'export') + '?format=xml')
+
+    def test_bad_export_request_fails_before_the_export_starts(self):
+        self.post_entries([{'data': 'first'}])
+        export_url = self.url.replace('logentries', 'export')
+        for params in [{'cursor': 'not-a-cursor'},
+                       {'startTime': 'yesterday'}]:
+            self.assertRaises(AppError,
+                              self.app.get,
+                              export_url + '?' + urlencode(params))
+
+        archive_path = logutils.get_log_file_path(self.log,
+                                                  logutils.LOG_ARCHIVE_DIRECTORY,
+                                                  extension='')
+        if not os.path.isdir(archive_path):
+            os.makedirs(archive_path)
+        with open(os.path.join(archive_path, logutils.LOG_ARCHIVE_MANIFEST), 'wb') as manifest_file:
+            manifest_file.write('{"segments": ')
+        try:
+            self.app.get(export_url)
+        except AppError as ex:
+            self.assertIn('500', str(ex))
+        else:
+            self.fail('a broken archive manifest must fail the export')
+
+    def test_bad_time_filter_throws_exception(self):
+        self.assertRaises(AppError,
+                          self.app.get,
+                          self.url + '?startTime=yesterday')
+
     def test_can_update_log_entry(self):
         self.num_entries(0)
         entry = self.setup_entry(self.log.ident, "foo")
@@ -519,3 +824,185 @@ class LoggingTests(BaseLoggingTestCase):
             entry['agentId'],
             osid_agent('student@tiss.edu')
         )
+
+    def test_default_log_is_looked_up_once(self):
+        payload = {
+            'data': {
+                'action': 'pause audio'
+            }
+        }
+        for _ in range(3):
+            req = self.app.post(self.url,
+                                params=json.dumps(payload),
+                                headers={'content-type': 'application/json'})
+            self.ok(req)
+
+        req = self.app.get('/api/v1/logging/logs')
+        self.ok(req)
+        self.assertEqual(len(self.json(req)), 1)
+        stats = logutils.LOG_IDS_BY_GENUS.stats()
+        self.assertEqual(stats['misses'], 1)
+        self.assertEqual(stats['hits'], 2)
+
+    def test_journaled_entries_are_created_when_the_log_is_read(self):
+        for index in range(3):
+            payload = {
+                'name': 'entry {0}'.format(index),
+                'data': {
+                    'action': 'click',
+                    'index': index
+                }
+            }
+            req = self.app.post(self.url + '/journal',
+                                params=json.dumps(payload),
+                                headers={'content-type': 'application/json'})
+            self.ok(req)
+            self.assertTrue(self.json(req)['success'])
+
+        logm = get_managers()['logm']
+        log = logm.get_logs().next()
+        self.assertEqual(log.get_log_entries().available(), 0)
+
+        req = self.app.get(self.url)
+        self.ok(req)
+        data = self.json(req)
+        self.assertEqual(len(data), 3)
+        self.assertEqual(sorted(entry['displayName']['text'] for entry in data),
+                         ['entry 0', 'entry 1', 'entry 2'])
+        for entry in data:
+            self.assertEqual(entry['agentId'], osid_agent('student@tiss.edu'))
+        self.assertEqual(logutils.LOG_JOURNALS[str(log.ident)].pending(), 0)
+
+        req = self.app.get(self.url)
+        self.assertEqual(len(self.json(req)), 3)
+
+    def test_journal_is_fsynced_and_flushed_in_batches(self):
+        flush_size = logutils.LOG_JOURNAL_FLUSH_SIZE
+        logutils.LOG_JOURNAL_FLUSH_SIZE = 4
+        try:
+            payload = {
+                'data': 'tick'
+            }
+            self.ok(self.app.post(self.url + '/journal',
+                                  params=json.dumps(payload),
+                                  headers={'content-type': 'application/json'}))
+
+            logm = get_managers()['logm']
+            log = logm.get_logs().next()
+            journal = logutils.LOG_JOURNALS[str(log.ident)]
+            self.assertTrue(os.path.isfile(journal.path))
+            with open(journal.path, 'rb') as journal_file:
+                records = [json.loads(line) for line in journal_file]
+            self.assertEqual(len(records), 1)
+            self.assertEqual(records[0]['data'], payload)
+            self.assertEqual(log.get_log_entries().available(), 0)
+
+            for _ in range(3):
+                self.ok(self.app.post(self.url + '/journal',
+                                      params=json.dumps(payload),
+                                      headers={'content-type': 'application/json'}))
+
+            deadline = time.time() + 10
+            while log.get_log_entries().available() < 4 and time.time() < deadline:
+                time.sleep(0.1)
+            self.assertEqual(log.get_log_entries().available(), 4)
+            self.assertFalse(os.path.exists(journal.path))
+            self.assertEqual(journal.pending(), 0)
+        finally:
+            logutils.LOG_JOURNAL_FLUSH_SIZE = flush_size
+
+    def test_can_create_a_batch_of_generic_log_entries(self):
+        payload = {
+            'entries': [
+                {'data': {'action': 'click'}},
+                {'name': 'no data'},
+                {'data': {'action': 'scroll'}}
+            ]
+        }
+        req = self.app.post(self.url,
+                            params=json.dumps(payload),
+                            headers={'content-type': 'application/json'})
+        self.ok(req)
+        results = self.json(req)
+        self.assertIn('id', results[0])
+        self.assertIn('error', results[1])
+        self.assertIn('id', results[2])
+
+        req = self.app.get(self.url)
+        self.assertEqual(len(self.json(req)), 2)
+
+    def test_can_journal_a_batch_of_entries(self):
+        payload = {
+            'entries': [
+                {'data': 'first',
+                 'timestamp': {'year': 2016, 'month': 8, 'day': 1}},
+                {'data': 'second',
+                 'timestamp': 'yesterday'},
+                {'data': 'third'}
+            ]
+        }
+        req = self.app.post(self.url + '/journal',
+                            params=json.dumps(payload),
+                            headers={'content-type': 'application/json'})
+        self.ok(req)
+        results = self.json(req)
+        self.assertEqual(results[0], {})
+        self.assertIn('timestamp', results[1]['error'])
+        self.assertEqual(results[2], {})
+
+        req = self.app.get(self.url)
+        entries = dict((entry['text']['text'], entry) for entry in self.json(req))
+        self.assertEqual(sorted(entries.keys()), ['first', 'third'])
+        self.assertEqual(entries['first']['timestamp']['year'], 2016)
+
+    def test_journal_requires_data(self):
+        self.assertRaises(AppError,
+                          self.app.post,
+                          self.url + '/journal',
+                          params=json.dumps({'name': 'no data'}),
+                          headers={'content-type': 'application/json'})
+
+    def test_journal_keeps_non_ascii_data(self):
+        payload = {
+            'data': u'\u0928\u092e\u0938\u094d\u0924\u0947'
+        }
+        req = self.app.post(self.url + '/journal',
+                            params=json.dumps(payload),
+                            headers={'content-type': 'application/json'})
+        self.ok(req)
+
+        req = self.app.get(self.url)
+        self.ok(req)
+        data = self.json(req)
+        self.assertEqual(len(data), 1)
+        self.assertEqual(data[0]['text']['text'], payload['data'])
+
+    def test_journal_lines_that_always_fail_are_moved_aside(self):
+        self.ok(self.app.post(self.url + '/journal',
+                              params=json.dumps({'data': 'first'}),
+                              headers={'content-type': 'application/json'}))
+        logm = get_managers()['logm']
+        log = logm.get_logs().next()
+        journal = logutils.LOG_JOURNALS[str(log.ident)]
+        with open(journal.path, 'ab') as journal_file:
+            journal_file.write('{"agent": "student@tiss.edu", "tim\n')
+            journal_file.write(json.dumps({'agent': 'student@tiss.edu',
+                                           'timestamp': 0,
+                                           'data': {'data': 'bad',
+                                                    'timestamp': 'yesterday'}}) + '\n')
+        self.ok(self.app.post(self.url + '/journal',
+                              params=json.dumps({'data': 'second'}),
+                              headers={'content-type': 'application/json'}))
+
+        req = self.app.get(self.url)
+        self.ok(req)
+        self.assertEqual(sorted(entry['text']['text'] for entry in self.json(req)),
+                         ['first', 'second'])
+        with open(journal.dead_letter_path, 'rb') as dead_letter_file:
+            dead_letters = [json.loads(line) for line in dead_letter_file]
+        self.assertEqual(len(dead_letters), 2)
+        self.assertIn('yesterday', dead_letters[1]['line'])
+
+        req = self.app.get(self.url)
+        self.ok(req)
+        self.assertEqual(len(self.json(req)), 2)
@@ -1,7 +1,12 @@
 # -*- coding: utf-8 -*-
 import json
+import os
+import time
+import zipfile
+
 from bs4 import BeautifulSoup, Tag
 
+from cStringIO import StringIO
 from urllib import unquote, quote
 
 from .test_assessment import BaseAssessmentTestCase, _stringify, ABS_PATH,\
@@ -40,7 +45,14 @@ from .test_assessment import BaseAssessmentTestCase, _stringify, ABS_PATH,\
     QTI_QUESTION_ORDER_INTERACTION_MW_SENTENCE_GENUS,\
     QTI_QUESTION_ORDER_INTERACTION_OBJECT_MANIPULATION_GENUS
 
+from repository import repository_utilities as rutils
+
+from testing_utilities import TEST_DATA_STORE_PATH
+
 from testing_utilities import get_managers, get_valid_contents
+from unittest import TestCase
+
+from assessment.assessment_utilities import ZipMemberFile
 
 import utilities
 
@@ -787,6 +799,89 @@ class QTIEndpointTests(BaseAssessmentTestCase):
                 expected_string
             )
 
+    def import_image_in_feedback_item(self):
+        url = '{0}/items'.format(self.url)
+        self._image_in_feedback_test_file.seek(0)
+        req = self.app.post(url,
+                            upload_files=[('qtiFile',
+                                           self._filename(self._image_in_feedback_test_file),
+                                           self._image_in_feedback_test_file.read())])
+        self.ok(req)
+        return self.json(req)
+
+    def media_file_path(self, file_id):
+        asset_content = self._repo.get_asset_content(utilities.clean_id(file_id['assetContentId']))
+        return rutils.get_asset_content_file_path(asset_content)
+
+    def test_identical_media_files_are_stored_once(self):
+        item = self.import_image_in_feedback_item()
+
+        # each reference still gets its own asset, as the QTI records make them
+        red_dot_label = 'medium534315617922181373draggable_red_dot_png'
+        red_dot_1 = item['answers'][1]['fileIds'][red_dot_label]
+        red_dot_2 = item['answers'][2]['fileIds'][red_dot_label]
+        self.assertNotEqual(red_dot_1['assetId'], red_dot_2['assetId'])
+        self.assertEqual(red_dot_1['assetContentTypeId'],
+                         str(rutils.PNG_ASSET_CONTENT_GENUS_TYPE))
+        red_dot_content = self._repo.get_asset_content(utilities.clean_id(red_dot_1['assetContentId']))
+        self.assertIn(str(rutils.MULTI_LANGUAGE_ASSET_CONTENT),
+                      red_dot_content.object_map['recordTypeIds'])
+
+        # but their files are one file
+        self.assertNotEqual(self.media_file_path(red_dot_1),
+                            self.media_file_path(red_dot_2))
+        self.assertTrue(os.path.samefile(self.media_file_path(red_dot_1),
+                                         self.media_file_path(red_dot_2)))
+
+        # re-importing the item shares its media files too
+        new_item = self.import_image_in_feedback_item()
+        self.assertNotEqual(new_item['id'], item['id'])
+        image_label = 'medium849946232588888784replacement_image_png'
+        new_image = new_item['answers'][0]['fileIds'][image_label]
+        self.assertNotEqual(new_image['assetId'],
+                            item['answers'][0]['fileIds'][image_label]['assetId'])
+        self.assertTrue(os.path.samefile(self.media_file_path(new_image),
+                                         self.media_file_path(item['answers'][0]['fileIds'][image_label])))
+
+        req = self.app.get('/api/v1/repository/repositories/{0}/assets/{1}/contents/{2}/stream'.format(
+            str(self._repo.ident),
+            new_image['assetId'],
+            new_image['assetContentId']))
+        self.assertTrue(len(req.body) > 0)
+
+    def test_replacing_a_shared_media_file_only_changes_its_own_asset(self):
+        item = self.import_image_in_feedback_item()
+        red_dot_label = 'medium534315617922181373draggable_red_dot_png'
+        red_dot_1 = item['answers'][1]['fileIds'][red_dot_label]
+        red_dot_2 = item['answers'][2]['fileIds'][red_dot_label]
+        with open(self.media_file_path(red_dot_2), 'rb') as red_dot_file:
+            red_dot = red_dot_file.read()
+
+        rutils.replace_asset_main_content(self._repo,
+                                          utilities.clean_id(red_dot_1['assetId']),
+                                          'red_dot.png',
+                                          StringIO('not a red dot'))
+        with open(self.media_file_path(red_dot_1), 'rb') as red_dot_file:
+            self.assertEqual(red_dot_file.read(), 'not a red dot')
+        with open(self.media_file_path(red_dot_2), 'rb') as red_dot_file:
+            self.assertEqual(red_dot_file.read(), red_dot)
+
+    def test_media_file_index_survives_a_restart(self):
+        item = self.import_image_in_feedback_item()
+
+        index_path = os.path.join(TEST_DATA_STORE_PATH,
+                                  rutils.CONTENT_HASH_INDEX_DIRECTORY,
+                                  '{0}.json'.format(self._repo.ident.identifier))
+        with open(index_path, 'rb') as index_file:
+            self.assertTrue(len(json.load(index_file)) > 0)
+
+        # a restarted process picks the index up from the datastore
+        rutils.CONTENT_HASH_INDEX.clear()
+        new_item = self.import_image_in_feedback_item()
+        image_label = 'medium849946232588888784replacement_image_png'
+        self.assertTrue(os.path.samefile(self.media_file_path(new_item['answers'][0]['fileIds'][image_label]),
+                                         self.media_file_path(item['answers'][0]['fileIds'][image_label])))
+
     def test_audio_file_in_question_gets_saved(self):
         url = '{0}/items'.format(self.url)
         self._audio_recording_test_file.seek(0)
@@ -915,6 +1010,76 @@ class QTIEndpointTests(BaseAssessmentTestCase):
         self.assertFalse(qti.responseDeclaration)
         self.assertFalse(qti.responseProcessing)
 
+    def test_taken_question_qti_is_cached_in_that_takens_choice_order(self):
+        second_taken, offered, assessment = self.create_taken_for_item(self._bank.ident, self._item.ident)
+        for taken in [self._taken, second_taken, self._taken, second_taken]:
+            questions_url = '{0}/assessmentstaken/{1}/questions'.format(self.url,
+                                                                        unquote(str(taken.ident)))
+            req = self.app.get(questions_url)
+            self.ok(req)
+            question = self.json(req)['data'][0]
+
+            url = '{0}/{1}/qti'.format(questions_url, question['id'])
+            req = self.app.get(url)
+            self.ok(req)
+            qti = BeautifulSoup(req.body, 'lxml-xml')
+            self.assertEqual([c['identifier'] for c in qti.find_all('simpleChoice')],
+                             [c['id'] for c in question['choices']])
+
+        stats = self.json(self.app.get('/cache_stats'))['renderedQti']
+        self.assertEqual(stats['size'], 2)
+        self.assertEqual(stats['hits'], 2)
+
+    def test_item_qti_cache_is_invalidated_when_item_is_edited(self):
+        url = '{0}/items'.format(self.url)
+        self._mc_multi_select_test_file.seek(0)
+        req = self.app.post(url,
+                            upload_files=[('qtiFile', 'testFile', self._mc_multi_select_test_file.read())])
+        self.ok(req)
+        item = self.json(req)
+        self.assertFalse(item['question']['shuffle'])
+
+        item_url = '{0}/{1}'.format(url, unquote(item['id']))
+        qti_url = '{0}/qti'.format(item_url)
+        first_qti = self.app.get(qti_url).body
+        self.assertEqual(self.app.get(qti_url).body, first_qti)
+        self.assertEqual(self.json(self.app.get('/cache_stats'))['renderedQti']['hits'], 1)
+
+        req = self.app.put(item_url,
+                           params=json.dumps({'name': 'a new name'}),
+                           headers={'content-type': 'application/json'})
+        self.ok(req)
+        self.assertEqual(self.json(self.app.get('/cache_stats'))['renderedQti']['size'], 0)
+
+        self.assertEqual(self.app.get(qti_url).body, first_qti)
+        stats = self.json(self.app.get('/cache_stats'))['renderedQti']
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['misses'], 2)
+
+    def test_item_qti_is_not_resent_when_unchanged(self):
+        url = '{0}/items'.format(self.url)
+        self._mc_multi_select_test_file.seek(0)
+        req = self.app.post(url,
+                            upload_files=[('qtiFile', 'testFile', self._mc_multi_select_test_file.read())])
+        self.ok(req)
+        item = self.json(req)
+
+        qti_url = '{0}/{1}/qti'.format(url, unquote(item['id']))
+        req = self.app.get(qti_url)
+        self.ok(req)
+        etag = req.header('ETag')
+
+        req = self.app.get(qti_url,
+                           headers={'If-None-Match': etag})
+        self.code(req, 304)
+        self.assertEqual(req.body, '')
+
+        req = self.app.get(qti_url,
+                           headers={'If-None-Match': '"stale"'})
+        self.ok(req)
+        self.assertEqual(req.header('ETag'), etag)
+        self.assertTrue(len(req.body) > 0)
+
     def test_with_all_items_can_include_qti_flag(self):
         url = '{0}/items?qti'.format(self.url)
         req = self.app.get(url)
@@ -995,6 +1160,109 @@ class QTIEndpointTests(BaseAssessmentTestCase):
         self.assertTrue(item.responseDeclaration)
         self.assertTrue(item.responseProcessing)
 
+    def _wait_for_qti_import(self, job):
+        url = '{0}/items/import/{1}'.format(self.url, job['id'])
+        for i in range(0, 240):
+            req = self.app.get(url)
+            self.ok(req)
+            job = self.json(req)
+            if job['status'] == 'complete':
+                return job
+            time.sleep(0.25)
+        self.fail('QTI import job did not finish')
+
+    def test_can_bulk_import_qti_packages(self):
+        self._mc_multi_select_test_file.seek(0)
+        self._mw_sentence_test_file.seek(0)
+        req = self.app.post('{0}/items/import'.format(self.url),
+                            upload_files=[('qtiFiles', 'mc.zip', self._mc_multi_select_test_file.read()),
+                                          ('qtiFiles', 'mw.zip', self._mw_sentence_test_file.read())])
+        self.ok(req)
+        job = self.json(req)
+        self.assertEqual(job['total'], 2)
+
+        job = self._wait_for_qti_import(job)
+        self.assertEqual(job['completed'], 2)
+        self.assertEqual([r['fileName'] for r in job['results']], ['mc.zip', 'mw.zip'])
+        self.assertEqual([r['status'] for r in job['results']], ['created', 'created'])
+
+        req = self.app.get('{0}/items/{1}'.format(self.url, job['results'][1]['itemId']))
+        self.ok(req)
+        self.assertEqual(self.json(req)['genusTypeId'],
+                         str(QTI_ITEM_ORDER_INTERACTION_MW_SENTENCE_GENUS))
+
+    def test_can_bulk_import_a_zip_of_qti_packages(self):
+        broken_package = StringIO()
+        with zipfile.ZipFile(broken_package, 'w') as broken_zip:
+            broken_zip.writestr('readme.txt', 'no QTI in here')
+
+        curriculum = StringIO()
+        with zipfile.ZipFile(curriculum, 'w') as curriculum_zip:
+            self._test_file2.seek(0)
+            curriculum_zip.writestr('first.zip', self._test_file2.read())
+            curriculum_zip.writestr('broken.zip', broken_package.getvalue())
+            self._test_file2.seek(0)
+            curriculum_zip.writestr('second.zip', self._test_file2.read())
+
+        req = self.app.post('{0}/items/import'.format(self.url),
+                            upload_files=[('qtiFiles', 'curriculum.zip', curriculum.getvalue())])
+        self.ok(req)
+        job = self._wait_for_qti_import(self.json(req))
+
+        self.assertEqual(job['total'], 3)
+        first, broken, second = job['results']
+        self.assertEqual(first['status'], 'created')
+        self.assertEqual(broken['status'], 'failed')
+        self.assertEqual(second['status'], 'created')
+
+        # same QTI identifier, so imported in order and provenanced
+        req = self.app.get('{0}/items/{1}'.format(self.url, second['itemId']))
+        self.ok(req)
+        self.assertEqual(self.json(req)['provenanceId'], first['itemId'])
+
+    def test_bulk_import_requires_qti_files(self):
+        req = self.app.post('{0}/items/import'.format(self.url),
+                            expect_errors=True)
+        self.code(req, 500)
+
+    def test_bulk_import_job_is_scoped_to_its_bank(self):
+        self._test_file2.seek(0)
+        req = self.app.post('{0}/items/import'.format(self.url),
+                            upload_files=[('qtiFiles', 'mc.zip', self._test_file2.read())])
+        self.ok(req)
+        job = self._wait_for_qti_import(self.json(req))
+
+        other_bank_id = 'assessment.Bank%3A000000000000000000000000%40ODL.MIT.EDU'
+        req = self.app.get('/api/v1/assessment/banks/{0}/items/import/{1}'.format(other_bank_id,
+                                                                                  job['id']),
+                           expect_errors=True)
+        self.code(req, 404)
+
+    def test_unknown_bulk_import_job_or_bank_is_not_found(self):
+        req = self.app.get('{0}/items/import/000000000000000000000000'.format(self.url),
+                           expect_errors=True)
+        self.code(req, 404)
+
+        self._test_file2.seek(0)
+        unknown_bank_id = 'assessment.Bank%3A000000000000000000000000%40ODL.MIT.EDU'
+        req = self.app.post('/api/v1/assessment/banks/{0}/items/import'.format(unknown_bank_id),
+                            upload_files=[('qtiFiles', 'mc.zip', self._test_file2.read())],
+                            expect_errors=True)
+        self.code(req, 404)
+
+    def test_bulk_import_runs_as_the_requesting_user_and_locale(self):
+        utilities.SERVICE_MANAGER_CACHE.clear()
+        self._test_file2.seek(0)
+        req = self.app.post('{0}/items/import'.format(self.url),
+                            upload_files=[('qtiFiles', 'mc.zip', self._test_file2.read())],
+                            headers={'x-api-locale': 'hi'})
+        self.ok(req)
+        job = self._wait_for_qti_import(self.json(req))
+        self.assertEqual(job['results'][0]['status'], 'created')
+        # only the import worker gets a repository manager
+        self.assertIn(('REPOSITORY', utilities.DEFAULT_PROXY_USERNAME, 'hi'),
+                      utilities.SERVICE_MANAGER_CACHE)
+
     def test_uploading_same_qti_item_id_sets_provenance(self):
         url = '{0}/items'.format(self.url)
         self._test_file2.seek(0)
@@ -5682,3 +5950,36 @@ class QTIEndpointTests(BaseAssessmentTestCase):
         )
         self.assertIn('var1', item['question']['id'].split('%3A')[-1].split('%40')[0])
         self.assertIn('var2', item['question']['id'].split('%3A')[-1].split('%40')[0])
+
+
+class ZipMemberFileTests(TestCase):
+    """Test reading QTI zip members without copying them into memory first
+
+    """
+    def setUp(self):
+        self._zip_file = open('{0}/tests/files/qti_file_with_images.zip'.format(ABS_PATH), 'r')
+        self._qti_zip = zipfile.ZipFile(self._zip_file)
+        self._media_info = [i for i in self._qti_zip.infolist()
+                            if i.filename.startswith('media/') and i.file_size > 20][0]
+        self._expected = self._qti_zip.read(self._media_info)
+
+    def tearDown(self):
+        self._qti_zip.close()
+        self._zip_file.close()
+
+    def test_can_read_member_more_than_once(self):
+        member = ZipMemberFile(self._qti_zip, self._media_info)
+        self.assertEqual(member.name, self._media_info.filename)
+        self.assertEqual(member.read(), self._expected)
+        self.assertEqual(member.tell(), len(self._expected))
+        member.seek(0)
+        self.assertEqual(member.read(), self._expected)
+
+    def test_can_seek_within_member(self):
+        member = ZipMemberFile(self._qti_zip, self._media_info)
+        member.seek(10)
+        self.assertEqual(member.read(5), self._expected[10:15])
+        member.seek(-5, 1)
+        self.assertEqual(member.read(5), self._expected[10:15])
+        member.seek(-4, 2)
+        self.assertEqual(member.read(), self._expected[-4:])
@@ -1,9 +1,16 @@
 # -*- coding: utf-8 -*-
 import json
 import os
+import shutil
+import tempfile
+import web
 
 from bs4 import BeautifulSoup
 
+from bson import ObjectId
+
+from cStringIO import StringIO
+
 from dlkit.runtime.errors import NotFound
 from dlkit.runtime.primordium import DataInputStream, Type, Id, DisplayText
 from dlkit.records.registry import ASSESSMENT_RECORD_TYPES,\
@@ -11,12 +18,17 @@ from dlkit.records.registry import ASSESSMENT_RECORD_TYPES,\
 
 from paste.fixture import AppError
 
+from unittest import TestCase
+
 from testing_utilities import BaseTestCase, get_fixture_repository,\
-    get_managers
+    get_managers, TEST_DATA_STORE_PATH, TEST_STUDENT_RESPONSE_DATA_STORE_PATH
 from urllib import unquote, quote
 
 import utilities
 
+from repository import repository_utilities as rutils
+from resource import resource_utilities as resource_utils
+
 PROJECT_PATH = os.path.dirname(os.path.abspath(__file__))
 ABS_PATH = os.path.abspath(os.path.join(PROJECT_PATH, os.pardir))
 
@@ -348,14 +360,175 @@ class AssetContentTests(BaseRepositoryTestCase):
 
     def test_can_get_asset_content_file(self):
         req = self.app.get(self.url + '/stream')
-        # self.ok(req)
-        self.code(req, 206)
+        self.ok(req)
         self.test_file.seek(0)
         self.assertEqual(
             req.body,
             self.test_file.read()
         )
 
+    def test_can_get_rest_of_asset_content_file_from_an_offset(self):
+        self.test_file.seek(0)
+        data = self.test_file.read()
+        req = self.app.get(self.url + '/stream',
+                           headers={'Range': 'bytes=1000-'})
+        self.code(req, 206)
+        self.assertEqual(req.header('Content-Range'),
+                         'bytes 1000-{0}/{1}'.format(len(data) - 1, len(data)))
+        self.assertEqual(req.body, data[1000:])
+
+    def test_can_get_a_closed_byte_range_of_asset_content_file(self):
+        self.test_file.seek(0)
+        data = self.test_file.read()
+        req = self.app.get(self.url + '/stream',
+                           headers={'Range': 'bytes=100-199'})
+        self.code(req, 206)
+        self.assertEqual(req.header('Content-Range'),
+                         'bytes 100-199/{0}'.format(len(data)))
+        self.assertEqual(req.header('Content-Length'), '100')
+        self.assertEqual(req.body, data[100:200])
+
+    def test_can_get_last_bytes_of_asset_content_file(self):
+        self.test_file.seek(0)
+        data = self.test_file.read()
+        req = self.app.get(self.url + '/stream',
+                           headers={'Range': 'bytes=-500'})
+        self.code(req, 206)
+        self.assertEqual(req.header('Content-Range'),
+                         'bytes {0}-{1}/{2}'.format(len(data) - 500, len(data) - 1, len(data)))
+        self.assertEqual(req.body, data[-500:])
+
+    def test_can_get_multiple_byte_ranges_of_asset_content_file(self):
+        self.test_file.seek(0)
+        data = self.test_file.read()
+        req = self.app.get(self.url + '/stream',
+                           headers={'Range': 'bytes=1000-1099,0-9,-5'})
+        self.code(req, 206)
+        content_type = req.header('Content-Type')
+        self.assertTrue(content_type.startswith('multipart/byteranges; boundary='))
+        boundary = content_type.split('boundary=')[-1]
+        self.assertEqual(req.header('Content-Length'), str(len(req.body)))
+
+        parts = req.body.split('--{0}'.format(boundary))
+        self.assertEqual(parts[0], '')
+        self.assertEqual(parts[-1], '--\r\n')
+        expected_parts = [(0, 9), (1000, 1099), (len(data) - 5, len(data) - 1)]
+        self.assertEqual(len(parts[1:-1]), len(expected_parts))
+        for part, (start, last) in zip(parts[1:-1], expected_parts):
+            headers, body = part.split('\r\n\r\n', 1)
+            self.assertIn('Content-Range: bytes {0}-{1}/{2}'.format(start, last, len(data)),
+                          headers)
+            self.assertEqual(body, data[start:last + 1] + '\r\n')
+
+    def test_unsatisfiable_byte_range_is_rejected(self):
+        self.test_file.seek(0)
+        data = self.test_file.read()
+        req = self.app.get(self.url + '/stream',
+                           headers={'Range': 'bytes={0}-'.format(len(data))},
+                           expect_errors=True)
+        self.code(req, 416)
+        self.assertEqual(req.header('Content-Range'),
+                         'bytes */{0}'.format(len(data)))
+
+    def test_malformed_byte_range_gets_whole_asset_content_file(self):
+        self.test_file.seek(0)
+        data = self.test_file.read()
+        req = self.app.get(self.url + '/stream',
+                           headers={'Range': 'bytes=200-100'})
+        self.ok(req)
+        self.assertEqual(req.body, data)
+
+    def test_unchanged_asset_content_file_is_not_resent(self):
+        req = self.app.get(self.url + '/stream')
+        self.ok(req)
+        etag = req.header('ETag')
+        last_modified = req.header('Last-Modified')
+        self.assertEqual(req.header('Cache-Control'), 'public, no-cache')
+
+        req = self.app.get(self.url + '/stream',
+                           headers={'If-None-Match': etag})
+        self.code(req, 304)
+        self.assertEqual(req.body, '')
+
+        req = self.app.get(self.url + '/stream',
+                           headers={'If-Modified-Since': last_modified})
+        self.code(req, 304)
+
+        # If-None-Match wins over If-Modified-Since
+        req = self.app.get(self.url + '/stream',
+                           headers={'If-None-Match': '"stale"',
+                                    'If-Modified-Since': last_modified})
+        self.ok(req)
+        self.test_file.seek(0)
+        self.assertEqual(req.body, self.test_file.read())
+
+    def test_range_with_stale_if_range_gets_whole_asset_content_file(self):
+        self.test_file.seek(0)
+        data = self.test_file.read()
+        etag = self.app.get(self.url + '/stream').header('ETag')
+
+        req = self.app.get(self.url + '/stream',
+                           headers={'Range': 'bytes=1000-',
+                                    'If-Range': etag})
+        self.code(req, 206)
+        self.assertEqual(req.body, data[1000:])
+
+        req = self.app.get(self.url + '/stream',
+                           headers={'Range': 'bytes=1000-',
+                                    'If-Range': '"stale"'})
+        self.ok(req)
+        self.assertNotIn('content-range', req.header_dict)
+        self.assertEqual(req.body, data)
+
+    def test_asset_content_file_is_streamed_from_its_path(self):
+        asset_content = self.asset.get_asset_contents().next()
+        file_path = rutils.get_asset_content_file_path(asset_content)
+        self.assertIsNotNone(file_path)
+
+        self.test_file.seek(0)
+        data = self.test_file.read()
+        chunks = list(rutils.stream_file(file_path, 10, len(data), chunk_size=4096))
+        self.assertEqual(len(chunks[0]), 4096)
+        self.assertEqual(''.join(chunks), data[10:])
+        chunks = list(rutils.stream_data(open(file_path, 'rb'), 10, 5000, chunk_size=4096))
+        self.assertEqual(''.join(chunks), data[10:5000])
+
+    def test_replacing_content_leaves_open_readers_the_old_file(self):
+        asset_content = self.asset.get_asset_contents().next()
+        file_path = rutils.get_asset_content_file_path(asset_content)
+        form = self._repo.get_asset_content_form_for_update(asset_content.ident)
+        self.assertEqual(rutils.get_filesystem_data_paths(form, 'sample_movie.MOV'),
+                         [file_path])
+
+        self.test_file.seek(0)
+        data = self.test_file.read()
+        self._replacement_image_file.seek(0)
+        replacement = self._replacement_image_file.read()
+        with open(file_path, 'rb') as reader:
+            rutils.replace_asset_main_content(self._repo,
+                                              self.asset.ident,
+                                              'sample_movie.MOV',
+                                              StringIO(replacement))
+            self.assertEqual(reader.read(), data)
+        with open(file_path, 'rb') as file_:
+            self.assertEqual(file_.read(), replacement)
+
+    def test_file_stream_stops_when_the_file_is_cut_short(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            file_path = os.path.join(temp_dir, 'foo.txt')
+            with open(file_path, 'wb') as file_:
+                file_.write('a' * 10000)
+
+            chunks = rutils.stream_file(file_path, 0, 10000, chunk_size=4096)
+            self.assertEqual(len(chunks.next()), 4096)
+            # replacing the content truncates the file in place
+            with open(file_path, 'wb') as file_:
+                file_.write('b' * 10)
+            self.assertEqual(list(chunks), [])
+        finally:
+            shutil.rmtree(temp_dir)
+
     def test_unknown_asset_content_extensions_preserved(self):
         upload_item = self.create_upload_item()
         taken, offered = self.create_taken_for_item(self._repo.ident, Id(upload_item['id']))
@@ -426,6 +599,18 @@ class AssetContentTests(BaseRepositoryTestCase):
             asset_content['displayName']['text']
         )
 
+    def test_replaced_asset_content_file_is_streamed(self):
+        self._replacement_image_file.seek(0)
+        replacement = self._replacement_image_file.read()
+        req = self.app.put(self.url,
+                           upload_files=[('inputFile',
+                                          self._filename(self._replacement_image_file),
+                                          replacement)])
+        self.ok(req)
+        req = self.app.get(self.url + '/stream')
+        self.ok(req)
+        self.assertEqual(req.body, replacement)
+
     def test_can_update_asset_content_with_new_file_and_set_genus_type(self):
         req = self.app.get(self.url)
         self.ok(req)
@@ -528,16 +713,14 @@ class AssetContentTests(BaseRepositoryTestCase):
         image = soup.find('img')
 
         req = self.app.get(image['src'])
-        # self.ok(req)
-        self.code(req, 206)
+        self.ok(req)
         headers = req.header_dict
         self.assertIn('image/png', headers['content-type'])
         self.assertEqual(headers['accept-ranges'], 'bytes')
         # self.assertIn('.png', headers['content-disposition'])
         # original_content_length = headers['content-length']
-        self.assertIn('content-range', headers)
-        self.assertEqual('bytes 0-8191/152318', headers['content-range'][0])
-        self.assertEqual('bytes 147456-152317/152318', headers['content-range'][-1])
+        self.assertNotIn('content-range', headers)
+        self.assertEqual('152318', headers['content-length'])
 
         # need to get rid of the /stream part of the path to just get the content details URL
         content_url = image['src'].replace('/stream', '')
@@ -555,18 +738,16 @@ class AssetContentTests(BaseRepositoryTestCase):
         image = soup.find('img')
 
         req = self.app.get(image['src'])
-        # self.ok(req)
-        self.code(req, 206)
+        self.ok(req)
         headers = req.header_dict
         self.assertNotIn('image/png', headers['content-type'])
         self.assertEqual(headers['accept-ranges'], 'bytes')
         self.assertEqual('None', headers['content-type'])  # what would sltng be??
         # self.assertIn('.sltng', headers['content-disposition'])
         # self.assertNotEqual(original_content_length, headers['content-length'])
-        self.assertIn('content-range', headers)
-        expected_range = 'bytes 0-8191/{0}'.format(str(os.path.getsize(self._logo_upload_test_file.name)))
-        self.assertIn(expected_range,
-                      headers['content-range'])
+        self.assertNotIn('content-range', headers)
+        self.assertEqual(str(os.path.getsize(self._logo_upload_test_file.name)),
+                         headers['content-length'])
 
     def test_updated_asset_content_in_choices_shows_up_properly_in_item_qti(self):
         item = self.create_item_with_image_in_choices()
@@ -581,15 +762,14 @@ class AssetContentTests(BaseRepositoryTestCase):
         image = soup.find('img')
 
         req = self.app.get(image['src'])
-        # self.ok(req)
-        self.code(req, 206)
+        self.ok(req)
         headers = req.header_dict
         self.assertIn('image/png', headers['content-type'])
         self.assertEqual(headers['accept-ranges'], 'bytes')
         # self.assertIn('.png', headers['content-disposition'].lower())
         # original_content_length = headers['content-length']
-        self.assertIn('content-range', headers)
-        self.assertIn('bytes 0-', headers['content-range'])
+        self.assertNotIn('content-range', headers)
+        self.assertIn('content-length', headers)
         # small file that depends on the choice image, either 512 or 641 bytes...
 
         # need to get rid of the /stream part of the path to just get the content details URL
@@ -608,18 +788,16 @@ class AssetContentTests(BaseRepositoryTestCase):
         image = soup.find('img')
 
         req = self.app.get(image['src'])
-        # self.ok(req)
-        self.code(req, 206)
+        self.ok(req)
         headers = req.header_dict
         self.assertNotIn('image/png', headers['content-type'])
         self.assertEqual('None', headers['content-type'])  # what would sltng be??
         self.assertEqual(headers['accept-ranges'], 'bytes')
         # self.assertIn('.sltng', headers['content-disposition'])
         # self.assertNotEqual(original_content_length, headers['content-length'])
-        self.assertIn('content-range', headers)
-        expected_range = 'bytes 0-8191/{0}'.format(str(os.path.getsize(self._logo_upload_test_file.name)))
-        self.assertIn(expected_range,
-                      headers['content-range'])
+        self.assertNotIn('content-range', headers)
+        self.assertEqual(str(os.path.getsize(self._logo_upload_test_file.name)),
+                         headers['content-length'])
 
     def test_can_set_asset_content_display_name_and_description_to_foreign_language(self):
         req = self.app.get(self.url)
@@ -788,6 +966,37 @@ class AssetContentTests(BaseRepositoryTestCase):
         self.assertEqual(asset_content.get_url(), data[0]['url'])
         self.assertNotEqual('', data[0]['url'])
 
+    def test_can_get_asset_content_with_full_url(self):
+        asset_content = self.asset.get_asset_contents().next()
+        req = self.app.get(self.url + '?fullUrl')
+        self.ok(req)
+        data = self.json(req)
+        self.assertEqual(data['id'], str(asset_content.ident))
+        self.assertEqual(asset_content.get_url(), data['url'])
+
+    def test_full_urls_are_filled_into_a_repository_template(self):
+        rutils.CONTENT_URL_TEMPLATES.clear()
+        self._replacement_image_file.seek(0)
+        req = self.app.post(self.contents_url,
+                            upload_files=[('inputFile',
+                                           self._filename(self._replacement_image_file),
+                                           self._replacement_image_file.read())])
+        self.ok(req)
+
+        for _ in range(2):
+            req = self.app.get(self.contents_url + '?fullUrls')
+            self.ok(req)
+            data = self.json(req)
+            self.assertEqual(len(data), 2)
+            for asset_content in self.asset.get_asset_contents():
+                content_map = [c for c in data if c['id'] == str(asset_content.ident)][0]
+                self.assertEqual(asset_content.get_url(), content_map['url'])
+
+        template = rutils.CONTENT_URL_TEMPLATES.get(data[0]['assignedRepositoryIds'][0])
+        self.assertTrue(template.endswith(rutils.CONTENT_URL_PATH))
+        # only the first content was looked up
+        self.assertEqual(rutils.CONTENT_URL_TEMPLATES.stats()['misses'], 1)
+
     def test_can_add_new_asset_content_with_file(self):
         self._replacement_image_file.seek(0)
         payload = {
@@ -819,6 +1028,28 @@ class AssetContentTests(BaseRepositoryTestCase):
         self.assertNotEqual('', data['url'])
         self.assertEqual(content.get_url(), data['url'])
 
+    def test_uploaded_file_is_saved_to_the_datastore_and_its_backup(self):
+        self._replacement_image_file.seek(0)
+        upload = self._replacement_image_file.read()
+        req = self.app.post(self.contents_url,
+                            upload_files=[('inputFile',
+                                           self._filename(self._replacement_image_file),
+                                           upload)])
+        self.ok(req)
+        data = self.json(req)
+        content = rutils.get_asset_content_by_id(self._repo.get_asset(self.asset.ident),
+                                                 utilities.clean_id(data['id']))
+        file_path = rutils.get_asset_content_file_path(content)
+        self.assertIn(content.ident.identifier, file_path)
+        with open(file_path, 'rb') as saved_file:
+            self.assertEqual(saved_file.read(), upload)
+        backup_path = os.path.join(TEST_STUDENT_RESPONSE_DATA_STORE_PATH,
+                                   os.path.basename(file_path))
+        with open(backup_path, 'rb') as backup_file:
+            self.assertEqual(backup_file.read(), upload)
+        self.assertEqual([name for name in os.listdir(os.path.dirname(file_path))
+                          if name.startswith('.upload-')], [])
+
     def test_can_add_new_asset_content_in_non_english_language(self):
         payload = {
             "displayName": self._hindi_text
@@ -1053,6 +1284,39 @@ class AssetQueryTests(BaseRepositoryTestCase):
         data = self.json(req)
         self.assertEqual(len(data), 0)
 
+    def test_can_page_through_assets(self):
+        asset_ids = []
+        for name in ['foo', 'bar', 'baz']:
+            req = self.app.post(self.url,
+                                params=json.dumps({'name': name}),
+                                headers={'content-type': 'application/json'})
+            self.ok(req)
+            asset_ids.append(self.json(req)['id'])
+
+        req = self.app.get(self.url + '?limit=2')
+        self.ok(req)
+        data = self.json(req)
+        self.assertEqual(len(data), 2)
+        next_link = req.header('Link')
+        self.assertIn('rel="next"', next_link)
+        next_url = next_link.split('<')[1].split('>')[0]
+        self.assertIn('limit=2', next_url)
+        self.assertIn('cursor=', next_url)
+
+        req = self.app.get(next_url.replace('http://localhost', ''))
+        self.ok(req)
+        next_data = self.json(req)
+        self.assertEqual(len(next_data), 1)
+        self.assertNotIn('Link', [h[0] for h in req.headers])
+
+        paged_ids = [a['id'] for a in data + next_data]
+        self.assertEqual(sorted(paged_ids), sorted(asset_ids))
+
+    def test_bad_asset_pagination_cursor_throws_exception(self):
+        self.assertRaises(AppError,
+                          self.app.get,
+                          self.url + '?limit=2&cursor=foo')
+
 
 class AssetCRUDTests(BaseRepositoryTestCase):
     def setUp(self):
@@ -1419,7 +1683,7 @@ class AssetCRUDTests(BaseRepositoryTestCase):
         self.assertEqual(len(data['assetContents']), 1)
         image_url = data['assetContents'][0]['url']
         req = self.app.get(image_url)
-        self.code(req, 206)
+        self.ok(req)
         self._image_2_test_file.seek(0)
         self.assertEqual(req.body,
                          self._image_2_test_file.read())
@@ -1509,6 +1773,85 @@ class AssetCRUDTests(BaseRepositoryTestCase):
         self.assertEqual(data[0]['sourceId'], original_source_id)
         self.assertEqual(data[0]['source']['text'], self._source)
 
+    def test_asset_list_looks_up_each_source_once(self):
+        for _ in range(3):
+            self._video_upload_test_file.seek(0)
+            req = self.app.post(self.url,
+                                params={'source': 'John Doe, (c) 2016',
+                                        'createNew': True},
+                                upload_files=[('inputFile', 'video-js-test.mp4', self._video_upload_test_file.read())])
+            self.ok(req)
+
+        resource_utils.RESOURCE_DISPLAY_NAMES.clear()
+        for _ in range(2):
+            req = self.app.get(self.url)
+            self.ok(req)
+            data = self.json(req)
+            self.assertEqual(len(data), 3)
+            for asset in data:
+                self.assertEqual(asset['source']['text'], 'John Doe, (c) 2016')
+        self.assertEqual(resource_utils.RESOURCE_DISPLAY_NAMES.stats()['misses'], 1)
+
+    def test_source_names_are_cached_per_locale(self):
+        data = self.upload_asset_with_source()
+        source_id = data['sourceId']
+
+        resource_utils.RESOURCE_DISPLAY_NAMES.clear()
+        for locale in [None, 'hi', 'hi']:
+            headers = {}
+            if locale is not None:
+                headers['x-api-locale'] = locale
+            req = self.app.get(self.url, headers=headers)
+            self.ok(req)
+            self.assertEqual(self.json(req)[0]['source']['text'], self._source)
+        self.assertEqual(resource_utils.RESOURCE_DISPLAY_NAMES.stats()['misses'], 2)
+        self.assertIn((source_id, None), resource_utils.RESOURCE_DISPLAY_NAMES)
+        self.assertIn((source_id, 'hi'), resource_utils.RESOURCE_DISPLAY_NAMES)
+
+        resource_utils.invalidate_resource_display_names(source_id)
+        self.assertNotIn((source_id, None), resource_utils.RESOURCE_DISPLAY_NAMES)
+        self.assertNotIn((source_id, 'hi'), resource_utils.RESOURCE_DISPLAY_NAMES)
+
+    def test_resource_names_are_indexed_per_repository(self):
+        data = self.upload_asset_with_source()
+        source_id = data['sourceId']
+        index_path = os.path.join(TEST_DATA_STORE_PATH,
+                                  resource_utils.RESOURCE_ALIAS_INDEX_DIRECTORY,
+                                  '{0}.json'.format(self._repo.ident.identifier))
+        with open(index_path, 'rb') as index_file:
+            self.assertEqual(json.load(index_file), {self._source: source_id})
+
+        data = self.upload_asset_with_source()
+        self.assertEqual(data['sourceId'], source_id)
+
+        # a restarted process picks the index up from the datastore
+        resource_utils.RESOURCE_ALIAS_INDEX.clear()
+        with open(index_path, 'wb') as index_file:
+            json.dump({self._source: source_id,
+                       'Jane Doe': source_id}, index_file)
+        self._video_upload_test_file.seek(0)
+        req = self.app.post(self.url,
+                            params={"source": 'Jane Doe'},
+                            upload_files=[('inputFile', 'video-js-test.mp4', self._video_upload_test_file.read())])
+        self.ok(req)
+        self.assertEqual(self.json(req)['sourceId'], source_id)
+
+    def test_resource_names_indexed_for_deleted_resources_are_made_again(self):
+        deleted_id = 'resource.Resource%3A{0}%40ODL.MIT.EDU'.format(ObjectId())
+        index_path = os.path.join(TEST_DATA_STORE_PATH,
+                                  resource_utils.RESOURCE_ALIAS_INDEX_DIRECTORY,
+                                  '{0}.json'.format(self._repo.ident.identifier))
+        if not os.path.isdir(os.path.dirname(index_path)):
+            os.makedirs(os.path.dirname(index_path))
+        with open(index_path, 'wb') as index_file:
+            json.dump({self._source: deleted_id}, index_file)
+
+        data = self.upload_asset_with_source()
+        self.assertNotEqual(data['sourceId'], deleted_id)
+        self.assertEqual(data['source']['text'], self._source)
+        with open(index_path, 'rb') as index_file:
+            self.assertEqual(json.load(index_file), {self._source: data['sourceId']})
+
     def test_can_set_asset_provider(self):
         data = self.upload_asset_with_provider()
         self.assertIn('provider', data)
@@ -1653,3 +1996,107 @@ class AssetCRUDTests(BaseRepositoryTestCase):
             'microsecond': 0
         }
         assert data['id'] == original_id
+
+
+class ByteRangeParserTests(TestCase):
+    """Test the Range header parser
+
+    """
+    def setUp(self):
+        web.ctx.clear()
+        web.ctx.env = {}
+
+    def tearDown(self):
+        web.ctx.clear()
+
+    def get_byte_ranges(self, range_header, content_length=1000):
+        web.ctx.env['HTTP_RANGE'] = range_header
+        return rutils.get_byte_ranges(content_length)
+
+    def test_no_header_means_whole_file(self):
+        self.assertIsNone(rutils.get_byte_ranges(1000))
+
+    def test_end_is_inclusive(self):
+        self.assertEqual(self.get_byte_ranges('bytes=0-0'), [(0, 1)])
+        self.assertEqual(self.get_byte_ranges('bytes=0-499'), [(0, 500)])
+
+    def test_open_and_suffix_ranges(self):
+        self.assertEqual(self.get_byte_ranges('bytes=900-'), [(900, 1000)])
+        self.assertEqual(self.get_byte_ranges('bytes=-100'), [(900, 1000)])
+        self.assertEqual(self.get_byte_ranges('bytes=-5000'), [(0, 1000)])
+        self.assertEqual(self.get_byte_ranges('bytes=900-5000'), [(900, 1000)])
+
+    def test_ranges_are_sorted_and_merged(self):
+        self.assertEqual(self.get_byte_ranges('bytes=500-599, 0-99, 50-149, 150-199'),
+                         [(0, 200), (500, 600)])
+
+    def test_unsatisfiable_ranges_are_dropped(self):
+        self.assertEqual(self.get_byte_ranges('bytes=1000-'), [])
+        self.assertEqual(self.get_byte_ranges('bytes=-0'), [])
+        self.assertEqual(self.get_byte_ranges('bytes=0-', content_length=0), [])
+        self.assertEqual(self.get_byte_ranges('bytes=2000-2100, 0-9'), [(0, 10)])
+
+    def test_invalid_headers_are_ignored(self):
+        for range_header in ['items=0-9', 'bytes=', 'bytes=9-0', 'bytes=a-b',
+                             'bytes=5', 'bytes=--5',
+                             'bytes=' + ','.join(['0-1'] * (rutils.MAX_BYTE_RANGES + 1))]:
+            self.assertIsNone(self.get_byte_ranges(range_header), range_header)
+
+
+class FilesystemDataPathTests(TestCase):
+    """Test that asset content files are named as the filesystem adapter does
+
+    """
+    def test_paths_follow_the_adapter(self):
+        class Form(object):
+            def __init__(self):
+                self._config_map = {'data_store_path': '/store',
+                                    'secondary_data_store_path': '/backup'}
+                self._my_map = {'_id': 'foo'}
+
+        self.assertEqual(rutils.get_filesystem_data_paths(Form(), 'bar.baz.png'),
+                         ['/store/repository/AssetContent/foo.png', '/backup/foo.png'])
+
+    def test_other_stores_have_no_paths(self):
+        class Form(object):
+            def __init__(self):
+                self._my_map = {'_id': 'foo'}
+
+        self.assertIsNone(rutils.get_filesystem_data_paths(Form(), 'bar.png'))
+
+
+class SaveFileTests(TestCase):
+    """Test that uploads are copied into place atomically
+
+    """
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.file_path = os.path.join(self.directory, 'foo.png')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_file_is_replaced_and_keeps_its_mode(self):
+        with open(self.file_path, 'wb') as file_:
+            file_.write('old')
+        os.chmod(self.file_path, 0o644)
+        rutils.save_file(self.file_path, StringIO('new' * 1000), chunk_size=7)
+        with open(self.file_path, 'rb') as file_:
+            self.assertEqual(file_.read(), 'new' * 1000)
+        self.assertEqual(os.stat(self.file_path).st_mode & 0o777, 0o644)
+        self.assertEqual(os.listdir(self.directory), ['foo.png'])
+
+    def test_failed_copy_leaves_old_file(self):
+        class BrokenUpload(object):
+            def seek(self, offset):
+                pass
+
+            def read(self, size):
+                raise IOError('connection reset')
+
+        with open(self.file_path, 'wb') as file_:
+            file_.write('old')
+        self.assertRaises(IOError, rutils.save_file, self.file_path, BrokenUpload())
+        with open(self.file_path, 'rb') as file_:
+            self.assertEqual(file_.read(), 'old')
+        self.assertEqual(os.listdir(self.directory), ['foo.png'])
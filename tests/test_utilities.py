@@ -0,0 +1,226 @@
+import json
+import time
+import web
+
+from unittest import TestCase
+
+from testing_utilities import BaseTestCase
+
+import utilities
+
+
+class BaseClassDataTests(TestCase):
+    """Test that the request body is parsed once per request
+
+    """
+    def setUp(self):
+        web.ctx.clear()
+        web.ctx.env = {
+            'REQUEST_METHOD': 'GET',
+            'QUERY_STRING': 'page=all'
+        }
+        web.ctx.data = json.dumps({'name': 'foo'})
+
+    def tearDown(self):
+        web.ctx.clear()
+
+    def test_data_merges_body_and_params(self):
+        data = utilities.BaseClass.data()
+        self.assertEqual(data['name'], 'foo')
+        self.assertEqual(data['page'], 'all')
+
+    def test_data_is_parsed_once_per_request(self):
+        data = utilities.BaseClass.data()
+        web.ctx.data = json.dumps({'name': 'bar'})
+        self.assertIs(utilities.BaseClass.data(), data)
+        self.assertEqual(utilities.BaseClass.data()['name'], 'foo')
+
+        # a new request starts with a fresh web.ctx
+        web.ctx.clear()
+        web.ctx.env = {
+            'REQUEST_METHOD': 'GET',
+            'QUERY_STRING': ''
+        }
+        web.ctx.data = json.dumps({'name': 'bar'})
+        self.assertEqual(utilities.BaseClass.data()['name'], 'bar')
+
+
+class FieldProjectionTests(TestCase):
+    """Test the ?fields= helpers
+
+    """
+    def test_no_fields_means_everything(self):
+        self.assertIsNone(utilities.get_requested_fields({}))
+        self.assertIsNone(utilities.get_requested_fields({'fields': ''}))
+        self.assertTrue(utilities.field_requested(None, 'question'))
+        obj_map = {'id': 'foo', 'question': {}}
+        self.assertIs(utilities.project_fields(obj_map, None), obj_map)
+
+    def test_id_is_always_included(self):
+        fields = utilities.get_requested_fields({'fields': 'displayName, genusTypeId'})
+        self.assertEqual(fields, set(['id', 'displayName', 'genusTypeId']))
+        self.assertFalse(utilities.field_requested(fields, 'question'))
+        self.assertEqual(utilities.project_fields({'id': 'foo',
+                                                   'displayName': 'bar',
+                                                   'question': {}}, fields),
+                         {'id': 'foo', 'displayName': 'bar'})
+
+    def test_extract_items_projects_fields(self):
+        data = json.loads(utilities.extract_items([{'id': 'foo', 'question': {}}],
+                                                  fields=set(['id'])))
+        self.assertEqual(data, [{'id': 'foo'}])
+
+
+class StreamJsonListTests(TestCase):
+    """Test the streaming JSON list serializer
+
+    """
+    def test_streamed_list_is_valid_json(self):
+        chunks = list(utilities.stream_json_list(iter([{'a': 1}, {'b': 2}])))
+        self.assertEqual(chunks[0], '[')
+        self.assertEqual(chunks[-1], ']')
+        self.assertEqual(json.loads(''.join(chunks)), [{'a': 1}, {'b': 2}])
+
+    def test_empty_list_is_valid_json(self):
+        self.assertEqual(json.loads(''.join(utilities.stream_json_list([]))), [])
+
+    def test_first_element_is_converted_before_streaming(self):
+        def convert(obj):
+            raise ValueError()
+
+        self.assertRaises(ValueError,
+                          utilities.stream_json_list,
+                          iter([{'a': 1}]),
+                          convert=convert)
+
+    def test_later_element_that_fails_to_convert_aborts_the_stream(self):
+        def convert(obj):
+            if obj == 2:
+                raise ValueError()
+            return {'n': obj}
+
+        chunks = utilities.stream_json_list(iter([1, 2, 3]), convert=convert)
+        self.assertEqual(chunks.next(), '[')
+        self.assertEqual(chunks.next(), '{"n": 1}')
+        self.assertRaises(ValueError, chunks.next)
+
+    def test_stream_is_aborted_when_the_objects_fail(self):
+        def objects():
+            yield {'a': 1}
+            yield {'b': 2}
+            raise ValueError()
+
+        streamed = []
+        chunks = utilities.stream_json_list(objects())
+        with self.assertRaises(ValueError):
+            for chunk in chunks:
+                streamed.append(chunk)
+        self.assertEqual(''.join(streamed), '[{"a": 1},{"b": 2}')
+
+    def test_stream_items_skips_bad_items(self):
+        class Good(object):
+            object_map = {'id': 'good'}
+
+        class Bad(object):
+            @property
+            def object_map(self):
+                raise ValueError()
+
+        streamed = ''.join(utilities.stream_items([Good(), Bad(), Good()]))
+        self.assertEqual(json.loads(streamed), [{'id': 'good'}, {'id': 'good'}])
+
+
+class LRUCacheTests(TestCase):
+    """Test the shared LRU / TTL cache
+
+    """
+    def test_least_recently_used_entry_is_evicted(self):
+        cache = utilities.LRUCache(2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+        cache.set('c', 3)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('c'), 3)
+        self.assertEqual(len(cache), 2)
+
+    def test_expired_entry_is_a_miss(self):
+        cache = utilities.LRUCache(2, ttl=0.01)
+        cache.set('a', 1)
+        time.sleep(0.05)
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(len(cache), 0)
+
+    def test_hits_and_misses_are_counted(self):
+        cache = utilities.LRUCache(2)
+        cache.get('a')
+        cache.set('a', 1)
+        cache.get('a')
+        cache.get('a')
+        stats = cache.stats()
+        self.assertEqual(stats['hits'], 2)
+        self.assertEqual(stats['misses'], 1)
+        self.assertEqual(stats['size'], 1)
+
+    def test_total_bytes_can_be_bounded(self):
+        cache = utilities.LRUCache(10, max_bytes=6)
+        cache.set('a', 'aaa')
+        cache.set('b', 'bbb')
+        cache.set('c', 'cc')
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.get('b'), 'bbb')
+        self.assertEqual(cache.stats()['bytes'], 5)
+        cache.set('d', 'd' * 7)
+        self.assertIsNone(cache.get('d'))
+        self.assertEqual(cache.get('c'), 'cc')
+        self.assertEqual(cache.stats()['bytes'], 5)
+
+    def test_can_invalidate_and_clear(self):
+        cache = utilities.LRUCache(2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.invalidate('a')
+        self.assertIsNone(cache.get('a'))
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.stats()['hits'], 0)
+
+
+class ServiceManagerCacheTests(BaseTestCase):
+    """Test that service managers are re-used across requests
+
+    """
+    def setUp(self):
+        super(ServiceManagerCacheTests, self).setUp()
+        self.url = '/api/v1/assessment/banks'
+
+    def tearDown(self):
+        super(ServiceManagerCacheTests, self).tearDown()
+
+    def test_repeat_requests_hit_the_manager_cache(self):
+        utilities.SERVICE_MANAGER_CACHE.clear()
+        self.ok(self.app.get(self.url))
+        self.ok(self.app.get(self.url))
+        req = self.app.get('/cache_stats')
+        self.ok(req)
+        stats = self.json(req)['serviceManagers']
+        self.assertEqual(stats['misses'], 1)
+        self.assertTrue(stats['hits'] >= 1)
+        self.assertEqual(stats['size'], 1)
+
+    def test_managers_are_cached_per_proxy_user_and_locale(self):
+        utilities.SERVICE_MANAGER_CACHE.clear()
+        self.ok(self.app.get(self.url))
+        self.ok(self.app.get(self.url,
+                             headers={'x-api-locale': 'hi'}))
+        self.assertEqual(utilities.SERVICE_MANAGER_CACHE.stats()['size'], 2)
+
+    def test_cached_manager_is_not_shared_with_other_users(self):
+        utilities.SERVICE_MANAGER_CACHE.clear()
+        self.ok(self.app.get(self.url))
+        req = self.app.get(self.url,
+                           headers={'x-api-proxy': 'unknown@tiss.edu'},
+                           expect_errors=True)
+        self.code(req, 403)
+        self.assertEqual(utilities.SERVICE_MANAGER_CACHE.stats()['size'], 2)
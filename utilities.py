@@ -1,17 +1,28 @@
+import base64
+import datetime
 import functools
+import hashlib
+import itertools
 import json
+import threading
+import time
 import traceback
 import web
 import os
+import urlparse
+import zlib
 
-from urllib import quote
+from collections import OrderedDict
+from urllib import quote, urlencode
 
 from dlkit.json_ import types
 
+from dlkit.runtime import PROXY_SESSION, RUNTIME
 from dlkit.runtime.errors import PermissionDenied, IllegalState,\
-    OperationFailed
+    OperationFailed, InvalidArgument
 from dlkit.runtime.primitives import InitializableLocale
 from dlkit.runtime.primordium import Id, Type, DisplayText
+from dlkit.runtime.proxy_example import SimpleRequest
 
 DEFAULT_LANGUAGE_TYPE = Type(**types.Language().get_type_data('DEFAULT'))
 DEFAULT_SCRIPT_TYPE = Type(**types.Script().get_type_data('DEFAULT'))
@@ -20,6 +31,20 @@ DEFAULT_FORMAT_TYPE = Type(**types.Format().get_type_data('DEFAULT'))
 
 CORS_HEADERS = "Content-Type,Authorization,X-Api-Proxy,X-Api-Key,request-line,X-Api-Locale"
 
+DEFAULT_PROXY_USERNAME = 'student@tiss.edu'
+
+# web.ctx key for the request body parsed by BaseClass.data()
+PARSED_DATA_KEY = '_qbank_parsed_data'
+
+# upper bound for the ``limit`` query parameter of paginated lists
+MAX_PAGE_SIZE = 1000
+
+# Fully-built service managers are re-used across requests for the
+# same (service, proxy user, locale). The TTL bounds how long an
+# authz change can take to show up for a cached manager.
+SERVICE_MANAGER_CACHE_SIZE = 128
+SERVICE_MANAGER_CACHE_TTL = 300  # seconds
+
 
 class BaseClass:
     def OPTIONS(self, *args, **kwargs):
@@ -33,6 +58,17 @@ class BaseClass:
 
     @staticmethod
     def data():
+        # Handlers call this many times per request, so parse the body
+        # once and keep the result on web.ctx, which web.py resets for
+        # every request. For multipart requests, web.input() re-uses the
+        # FieldStorage that web.py keeps on web.ctx, so file fields
+        # (i.e. web.input(qtiFile={})) can still be read afterwards.
+        if PARSED_DATA_KEY not in web.ctx:
+            web.ctx[PARSED_DATA_KEY] = BaseClass._parse_data()
+        return web.ctx[PARSED_DATA_KEY]
+
+    @staticmethod
+    def _parse_data():
         # merge web.data() (url params) and web.input() (form)
         form_data = web.input()
 
@@ -48,6 +84,110 @@ class BaseClass:
         return url_data
 
 
+class LRUCache(object):
+    """Thread-safe, size-bounded LRU cache whose entries expire after
+    ``ttl`` seconds (``ttl=None`` means they never expire). With
+    ``max_bytes``, the ``len()`` of the cached values is bounded too, for
+    caches of strings. Keeps hit / miss counters so that they can be
+    reported via ``/cache_stats``.
+    """
+    def __init__(self, max_size, ttl=None, max_bytes=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._bytes = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+            self.hits = 0
+            self.misses = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                stored_at, value = self._entries.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            if self.ttl is not None and time.time() - stored_at > self.ttl:
+                self._forget(value)
+                self.misses += 1
+                return default
+            # re-insert so that this key becomes the most recently used
+            self._entries[key] = (stored_at, value)
+            self.hits += 1
+            return value
+
+    def invalidate(self, key):
+        with self._lock:
+            if key in self._entries:
+                self._forget(self._entries.pop(key)[1])
+
+    def invalidate_where(self, predicate):
+        with self._lock:
+            for key in [k for k in self._entries if predicate(k)]:
+                self._forget(self._entries.pop(key)[1])
+
+    def set(self, key, value):
+        with self._lock:
+            if key in self._entries:
+                self._forget(self._entries.pop(key)[1])
+            if self.max_bytes is not None and len(value) > self.max_bytes:
+                # would push everything else out
+                return
+            self._entries[key] = (time.time(), value)
+            if self.max_bytes is not None:
+                self._bytes += len(value)
+            while (len(self._entries) > self.max_size or
+                   (self.max_bytes is not None and self._bytes > self.max_bytes)):
+                self._forget(self._entries.popitem(last=False)[1][1])
+
+    def stats(self):
+        stats = {
+            'hits': self.hits,
+            'misses': self.misses,
+            'size': len(self._entries),
+            'maxSize': self.max_size,
+            'ttl': self.ttl
+        }
+        if self.max_bytes is not None:
+            stats['bytes'] = self._bytes
+            stats['maxBytes'] = self.max_bytes
+        return stats
+
+    def _forget(self, value):
+        """Account for a value leaving the cache. Call with the lock held."""
+        if self.max_bytes is not None:
+            self._bytes -= len(value)
+
+
+SERVICE_MANAGER_CACHE = LRUCache(SERVICE_MANAGER_CACHE_SIZE,
+                                 ttl=SERVICE_MANAGER_CACHE_TTL)
+
+# name -> LRUCache, for reporting and for resetting between tests
+CACHES = {
+    'serviceManagers': SERVICE_MANAGER_CACHE
+}
+
+
+def clear_caches():
+    for cache in CACHES.values():
+        cache.clear()
+
+
 def create_agent_id(username, authority='MIT-ODL'):
     return Id(identifier=username,
               namespace='osid.agent.Agent',
@@ -148,7 +288,9 @@ def format_xml_response(func):
     @functools.wraps(func)
     def wrapper(self, *args):
         results = func(self, *args)
-        web.header('Content-type', 'application/xml')
+        if not web.ctx.status.startswith('304'):
+            # a 304 carries no body, so no content type either
+            web.header('Content-type', 'application/xml')
         web.header("Access-Control-Allow-Origin", "*")
         web.header("Access-Control-Allow-Credentials", "true")
         web.header("Access-Control-Allow-Headers", CORS_HEADERS)
@@ -205,15 +347,15 @@ def construct_qti_id(qti_id, namespace='assessment.Item'):
               authority='QTI.IMS.COM')
 
 
-def convert_dl_object(obj):
+def convert_dl_object(obj, fields=None):
     """
     convert a DLKit object into a "real" json-able object
     """
     try:
         # return json.loads(json.loads(json.dumps(obj, cls=DLEncoder)))
-        return json.dumps(obj.object_map)
+        return json.dumps(project_fields(obj.object_map, fields))
     except:
-        return json.dumps(obj)
+        return json.dumps(project_fields(obj, fields))
 
 
 def convert_two_digit_lang_code_to_locale_object(language_code):
@@ -232,7 +374,7 @@ def convert_two_digit_lang_code_to_locale_object(language_code):
     return None
 
 
-def extract_items(item_list):
+def extract_items(item_list, fields=None):
     try:
         if item_list.available() > 0:
             # so we don't list the items because it's a generator
@@ -241,28 +383,179 @@ def extract_items(item_list):
                 results = []
                 for item in orig_list:
                     try:
-                        results.append(item.object_map)
+                        results.append(project_fields(item.object_map, fields))
                     except AttributeError:
                         # Hierarchy Nodes do not have .object_map
-                        results.append(item.get_node_map())
+                        results.append(project_fields(item.get_node_map(), fields))
                     except Exception:  # yes, this is overly broad and violets PEP8
                         # but we are suppressing all errors that might happen
                         # due to bad items
                         pass
                 return json.dumps(results)
             except OperationFailed:
-                return json.dumps([i.object_map for i in item_list])
+                return json.dumps([project_fields(i.object_map, fields) for i in item_list])
         else:
             return json.dumps([])
     except AttributeError:
         if len(item_list) > 0:
             try:
-                return json.dumps([i.object_map for i in item_list])
+                return json.dumps([project_fields(i.object_map, fields) for i in item_list])
             except AttributeError:
-                return json.dumps(item_list)
+                return json.dumps([project_fields(i, fields) for i in item_list])
         return json.dumps([])
 
 
+def field_requested(fields, field):
+    """True if ``field`` should be in the response, for the given
+    ``fields`` (from get_requested_fields()). Use it to skip work
+    that only fills in fields that were not asked for."""
+    return fields is None or field in fields
+
+
+def get_requested_fields(params):
+    """Get the set of top-level keys asked for with the ``fields``
+    URL parameter (comma-separated), or None if all fields are wanted.
+    ``id`` is always included."""
+    if 'fields' not in params or not params['fields']:
+        return None
+    fields = params['fields']
+    if isinstance(fields, basestring):
+        fields = fields.split(',')
+    fields = set(field.strip() for field in fields if field.strip())
+    fields.add('id')
+    return fields
+
+
+def iter_object_maps(item_list, fields=None):
+    """Lazily yield the object maps of an OSID list, one at a time.
+    Bad items are skipped, like in extract_items()."""
+    for item in item_list:
+        try:
+            object_map = item.object_map
+        except AttributeError:
+            # Hierarchy Nodes do not have .object_map
+            object_map = item.get_node_map()
+        except Exception:  # same broad suppression as extract_items()
+            continue
+        yield project_fields(object_map, fields)
+
+
+def project_fields(obj_map, fields):
+    """Drop the keys of ``obj_map`` that are not in ``fields``.
+    ``fields=None`` returns the map untouched."""
+    if fields is None or not isinstance(obj_map, dict):
+        return obj_map
+    return dict((key, value) for key, value in obj_map.iteritems() if key in fields)
+
+
+def stream_items(item_list, fields=None):
+    """Streaming version of extract_items()"""
+    return stream_json_list(iter_object_maps(item_list, fields=fields))
+
+
+def stream_json_list(objects, convert=None):
+    """Serialize an iterable of maps as a JSON array, one element at a
+    time. Return the generator from a handler and web.py sends each chunk
+    as it is produced, so the full list is never built in memory.
+    ``convert``, if given, turns each object into its map.
+
+    Headers and the status are sent with the opening ``[``, so the first
+    element is fetched and converted before this returns: do any other
+    lookups that may fail (and should return an error code) before it
+    too. After that, an error from the objects or from ``convert`` is
+    raised from the generator, which aborts the response without closing
+    the array, so the client sees a broken transfer, not a short list."""
+    objects = iter(objects)
+    first = []
+    for obj in objects:
+        first.append(obj if convert is None else convert(obj))
+        break
+    return _stream_json_list(first, objects, convert)
+
+
+def _stream_json_list(first, objects, convert):
+    yield '['
+    separator = ''
+    for obj in first:
+        yield json.dumps(obj)
+        separator = ','
+    for obj in objects:
+        if convert is not None:
+            obj = convert(obj)
+        yield separator + json.dumps(obj)
+        separator = ','
+    yield ']'
+
+
+def accepts_gzip():
+    """Whether the client sent ``Accept-Encoding: gzip``"""
+    accept_encoding = web.ctx.env.get('HTTP_ACCEPT_ENCODING', '')
+    return 'gzip' in [coding.split(';')[0].strip() for coding in accept_encoding.split(',')]
+
+
+def gzip_chunks(chunks):
+    """Gzip a streamed response body as it is sent"""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+def get_service_manager(service_name, with_locale=True, username=None, language_code=None):
+    """Get a dlkit service manager for the current request's proxy user
+    (the X-Api-Proxy header, unless ``username`` is given) and, if
+    ``with_locale``, the X-Api-Locale header (unless ``language_code``, as
+    get_locale_code() returns it, is given).
+    Managers are cached in SERVICE_MANAGER_CACHE, so repeat calls within
+    and across requests skip building the proxy and the authz adapters."""
+    if username is None:
+        username = get_proxy_username()
+
+    if not with_locale:
+        language_code = None
+    elif language_code is None:
+        language_code = get_locale_code()
+
+    cache_key = (service_name, username, language_code)
+    manager = SERVICE_MANAGER_CACHE.get(cache_key)
+    if manager is None:
+        condition = PROXY_SESSION.get_proxy_condition()
+        dummy_request = SimpleRequest(username=username,
+                                      authenticated=True)
+        condition.set_http_request(dummy_request)
+
+        if language_code is not None:
+            locale = convert_two_digit_lang_code_to_locale_object(language_code)
+            if locale is None:
+                locale = InitializableLocale(language_type_identifier=DEFAULT_LANGUAGE_TYPE.identifier,
+                                             script_type_identifier=DEFAULT_SCRIPT_TYPE.identifier)
+            condition.set_locale(locale)
+
+        proxy = PROXY_SESSION.get_proxy(condition)
+        manager = RUNTIME.get_service_manager(service_name,
+                                              proxy=proxy)
+        SERVICE_MANAGER_CACHE.set(cache_key, manager)
+    return manager
+
+
+def get_locale_code():
+    """The current request's language (the X-Api-Locale header) as one of
+    en, hi, te or default, or None if the request does not set one"""
+    if 'HTTP_X_API_LOCALE' not in web.ctx.env:
+        return None
+    language_code = web.ctx.env['HTTP_X_API_LOCALE'].lower()
+    if language_code not in ['en', 'hi', 'te']:
+        language_code = 'default'
+    return language_code
+
+
+def get_proxy_username():
+    """The user the current request acts for (the X-Api-Proxy header)"""
+    return web.ctx.env.get('HTTP_X_API_PROXY', DEFAULT_PROXY_USERNAME)
+
+
 def handle_exceptions(ex):
     message = str(ex)
     if 'WEBENV' in os.environ and os.environ['WEBENV'] == 'test':
@@ -286,6 +579,126 @@ def handle_exceptions(ex):
         raise web.InternalError(message)
 
 
+def decode_cursor(cursor):
+    """Get the list offset stored in a pagination cursor"""
+    try:
+        label, offset = base64.urlsafe_b64decode(str(cursor)).split(':')
+        offset = int(offset)
+    except (TypeError, ValueError):
+        raise InvalidArgument('Invalid cursor: {0}'.format(cursor))
+    if label != 'offset' or offset < 0:
+        raise InvalidArgument('Invalid cursor: {0}'.format(cursor))
+    return offset
+
+
+def encode_cursor(offset):
+    """Build the opaque pagination cursor for the given list offset"""
+    return base64.urlsafe_b64encode('offset:{0}'.format(offset))
+
+
+def paginate(item_list, params):
+    """Apply the ``limit`` and ``cursor`` URL parameters to an OSID list.
+
+    Without ``limit`` the list is returned untouched. Otherwise the list
+    is skipped to the cursor's offset (via the OSID ``skip()``, which dlkit
+    pushes down to the database cursor where it can), only the requested
+    page of objects is built, and if there are more objects, a
+    ``Link: <...>; rel="next"`` header with the next page's URL is set.
+    """
+    if 'limit' not in params:
+        return item_list
+
+    try:
+        limit = int(params['limit'])
+    except (TypeError, ValueError):
+        raise InvalidArgument('limit must be an integer')
+    if limit < 1 or limit > MAX_PAGE_SIZE:
+        raise InvalidArgument('limit must be between 1 and {0}'.format(MAX_PAGE_SIZE))
+
+    offset = 0
+    if 'cursor' in params and params['cursor']:
+        offset = decode_cursor(params['cursor'])
+
+    if offset > 0:
+        try:
+            item_list.skip(offset)
+        except AttributeError:
+            # plain Python lists / iterators
+            item_list = itertools.islice(item_list, offset, None)
+        except StopIteration:
+            # skipped past the end of the list
+            return []
+
+    # get one extra object to know if there is a next page
+    page = list(itertools.islice(item_list, limit + 1))
+    if len(page) > limit:
+        page = page[:limit]
+        set_next_link(encode_cursor(offset + limit))
+    return page
+
+
+def set_next_link(cursor):
+    """Point the ``Link`` header at the current URL, with the given cursor"""
+    query = [(key, value)
+             for key, value in urlparse.parse_qsl(web.ctx.env.get('QUERY_STRING', ''),
+                                                  keep_blank_values=True)
+             if key != 'cursor']
+    query.append(('cursor', cursor))
+    next_url = '{0}{1}?{2}'.format(web.ctx.home,
+                                   web.ctx.path,
+                                   urlencode(query))
+    web.header('Link', '<{0}>; rel="next"'.format(next_url))
+    web.header('Access-Control-Expose-Headers', 'Link')
+
+
+def get_etag(content):
+    """A strong ETag for a response body"""
+    if isinstance(content, unicode):
+        content = content.encode('utf-8')
+    return '"{0}"'.format(hashlib.md5(content).hexdigest())
+
+
+def set_cache_validators(etag, last_modified=None, cache_control='no-cache'):
+    """Send the ``ETag`` (already quoted), ``Last-Modified`` (a unix
+    timestamp) and ``Cache-Control`` headers for the response"""
+    web.header('ETag', etag)
+    if last_modified is not None:
+        web.header('Last-Modified', web.httpdate(datetime.datetime.utcfromtimestamp(int(last_modified))))
+    web.header('Cache-Control', cache_control)
+
+
+def is_not_modified(etag, last_modified=None):
+    """Whether the request's ``If-None-Match`` or ``If-Modified-Since``
+    shows that the client has this version already, so a 304 will do.
+    ``If-None-Match`` wins when both are sent (RFC 7232, section 6)"""
+    if_none_match = web.ctx.env.get('HTTP_IF_NONE_MATCH')
+    if if_none_match is not None:
+        # weak comparison, i.e. W/"foo" matches "foo"
+        etags = [e.strip().replace('W/', '', 1) for e in if_none_match.split(',')]
+        return '*' in etags or etag in etags
+    if last_modified is not None:
+        if_modified_since = web.parsehttpdate(web.ctx.env.get('HTTP_IF_MODIFIED_SINCE', '').split(';')[0])
+        if if_modified_since is not None:
+            return datetime.datetime.utcfromtimestamp(int(last_modified)) <= if_modified_since
+    return False
+
+
+def if_range_matches(etag, last_modified=None):
+    """Whether a ``Range`` request should be honored, i.e. it has no
+    ``If-Range``, or its ``If-Range`` names the current version. Otherwise
+    the client's partial copy is stale and it gets the whole entity"""
+    if_range = web.ctx.env.get('HTTP_IF_RANGE')
+    if if_range is None:
+        return True
+    if_range = if_range.strip()
+    if if_range.startswith('"') or if_range.startswith('W/'):
+        # strong comparison, so weak ETags never match
+        return etag is not None and if_range == etag
+    if last_modified is None:
+        return False
+    return web.parsehttpdate(if_range) == datetime.datetime.utcfromtimestamp(int(last_modified))
+
+
 def set_form_basics(form, data):
     def _grab_first_match(keys):
         # filtered = {k:v for k, v in data.iteritems() if k in keys}